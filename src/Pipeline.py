@@ -1,48 +1,198 @@
 # Proof of concept pipleine
+import timeit
+_import_start = timeit.default_timer()
 
 # Import modules
-from modules.SourceManager import SourceManager
-from modules.VectorDBManager import VectorDBManager
-from modules.CustomParentDocumentRetriever import CustomParentDocRetriever
+# Components and their SDKs are imported on first use, see RAGPipeline.LAZY_COMPONENTS
+from modules.utils import batched, estimate_tokens, load_config, STARTUP
+from modules.Metrics import METRICS
+from modules.ContextPacker import ContextPacker
 
-from langchain_experimental.text_splitter import SemanticChunker
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain.storage import InMemoryStore
-store = InMemoryStore()
+from pathlib import Path
+from typing import AsyncIterator
+from concurrent.futures import ThreadPoolExecutor
+from threading import RLock
+import asyncio
 
-from langchain.retrievers.self_query.base import SelfQueryRetriever
-from langchain.retrievers.self_query.chroma import ChromaTranslator
+STARTUP.record("imports", "Pipeline", timeit.default_timer() - _import_start)
 
-from langchain.retrievers import ContextualCompressionRetriever
-from langchain.retrievers.document_compressors import FlashrankRerank
+class RAGPipeline:
+    # Attributes built on first use, by the method that initializes them
+    LAZY_COMPONENTS = {
+        "vector_manager": "init_vector_manager",
+        "source_manager": "init_source_manager",
+        "llm": "init_llm",
+        "splitter": "init_retriever",
+        "docstore": "init_retriever",
+        "lexical_index": "init_retriever",
+        "retriever": "init_retriever",
+        "query_cache": "init_retriever",
+        "compressor": "init_compressor",
+        "rerank_retriever": "init_compressor",
+    }
+    _init_lock = RLock()
+
+    def __init__(
+        self,
+        docstore_path: Path = None,
+        read_only: bool = False,
+        chunk_workers: int = 1,
+        embed_once: bool = False,
+        bm25_path: Path = None,
+        retrieval_mode: str = "vector",
+        cache_queries: bool = True,
+        semantic_cache_threshold: float = None,
+        context_tokens: int = 2048,
+        vector_backend: str = "chroma",
+        warm_up: bool = False
+    ) -> None:
+        """
+        Constructor for RAGPipeline class.
 
-from langchain_google_genai import GoogleGenerativeAI
+        Nothing heavy is imported or loaded here: the LLM, vectorstore, embedding model and
+        reranker are built when first used, or all at once by `warm_up`.
 
-class RAGPipeline:
-    def __init__(self) -> None:
+        Args:
+            docstore_path (Path, optional): The SQLite file parent documents are persisted in.
+                Defaults to DOCSTORE_FILE.
+            read_only (bool, optional): Open the docstore read only, for query workers sharing it.
+            chunk_workers (int, optional): Processes splitting sentences and assembling chunks. Defaults to 1.
+            embed_once (bool, optional): Store chunks with vectors pooled from the sentence embeddings of
+                the semantic chunker instead of embedding them again with OpenAI. Defaults to False.
+            bm25_path (Path, optional): The SQLite file of the BM25 index over the parent documents.
+                Defaults to BM25_FILE.
+            retrieval_mode (str, optional): "vector", "lexical" (BM25 only) or "hybrid" (both, fused
+                with reciprocal rank fusion). Defaults to "vector".
+            cache_queries (bool, optional): Answer repeated queries from a cache, see QueryCache. Defaults to True.
+            semantic_cache_threshold (float, optional): Also answer reworded queries with the same key terms
+                from the cache when their embeddings are this similar, e.g. 0.95. Defaults to None, off.
+            context_tokens (int, optional): The estimated tokens of reranked documents put in the
+                prompt, see ContextPacker. Defaults to 2048.
+            vector_backend (str, optional): "chroma", or "compact" for read-only workers searching a
+                collection exported by VectorDBManager.export_compact without Chroma. Defaults to "chroma".
+            warm_up (bool, optional): Build every component now instead of on first use. Defaults to False.
+        """
+        self.docstore_path = docstore_path
+        self.read_only = read_only
+        self.chunk_workers = chunk_workers
+        self.embed_once = embed_once
+        self.bm25_path = bm25_path
+        self.retrieval_mode = retrieval_mode
+        self.cache_queries = cache_queries
+        self.semantic_cache_threshold = semantic_cache_threshold
+        self.context_packer = ContextPacker(max_tokens=context_tokens)
+        self.vector_backend = vector_backend
+        # Loaded once here and passed to the components that need it
+        self.config = load_config()
+        if warm_up:
+            self.warm_up()
+
+    def __getattr__(self, name: str):
+        # Only called for attributes that are not set yet
+        init = self.LAZY_COMPONENTS.get(name)
+        if init is None:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        with self._init_lock:
+            if name not in self.__dict__:
+                getattr(self, init)()
+        return self.__dict__[name]
+
+    def warm_up(self) -> dict:
+        """
+        Builds every component and loads every model now, so the first query is not slowed down.
+
+        Returns:
+            dict: The startup report, see `startup_report`.
+        """
+        for name in self.LAZY_COMPONENTS:
+            getattr(self, name)
+        return self.startup_report()
+
+    @staticmethod
+    def startup_report() -> dict:
+        """
+        Seconds spent so far importing modules and loading models or clients, by name and in total.
+        """
+        return STARTUP.report()
+
+    def init_vector_manager(self) -> None:
+        with STARTUP.time("imports", "modules.VectorDBManager"):
+            from modules.VectorDBManager import VectorDBManager
+        self.vector_manager = VectorDBManager(config=self.config)
+
+    def init_source_manager(self) -> None:
+        with STARTUP.time("imports", "modules.SourceManager"):
+            from modules.SourceManager import SourceManager
         self.source_manager = SourceManager()
-        # Init vector_manager
-        self.vector_manager = VectorDBManager()
-        self.llm = GoogleGenerativeAI(model="gemini-1.5-flash")
+        self.source_manager.keyword_extractor = self.vector_manager.keyword_extractor
 
-        self.init_retriever()
-        self.init_compressor()
+    def init_llm(self) -> None:
+        with STARTUP.time("imports", "langchain_google_genai"):
+            from langchain_google_genai import GoogleGenerativeAI
+        with STARTUP.time("models", "llm"):
+            self.llm = GoogleGenerativeAI(model="gemini-1.5-flash")
 
     # Check for new pages
 
     # If new pages, process pages
-    def load_processed_pages(self):
+    def load_processed_pages(self, filename: str = "processed_articles.jsonl", batch_size: int = 100):
         """
         Load processed pages from the source manager and ingest them into the vector manager.
+
+        Args:
+            filename (str, optional): The processed pages, optionally .gz or .zst compressed.
+                Defaults to "processed_articles.jsonl".
+            batch_size (int, optional): The number of articles held in memory and ingested at once.
+                Defaults to 100.
         """
         # Load processed pages
-        # This method loads the processed pages from the source manager
+        # This method streams the processed pages from the source manager
         # and ingests them into the vector manager.
-        # The processed pages are loaded from the file "processed_articles.jsonl"
-        # using the `load_json` method of the `source_manager` object.
-        # The loaded data is then passed to the `ingest_articles` method of the `vector_manager` object.
-        data = self.source_manager.load_json("processed_articles.jsonl")
-        self.vector_manager.ingest_articles(data)
+        # The processed pages are read lazily from the file "processed_articles.jsonl"
+        # using the `iter_json` method of the `source_manager` object.
+        # Every batch is then passed to the `ingest_articles` method of the `vector_manager` object.
+        for batch in batched(self.source_manager.iter_json(filename), batch_size):
+            self.vector_manager.ingest_articles(batch)
+
+    def sync_pages(self, page_titles: list[str], manifest_file: str = "manifest.jsonl") -> tuple[list[str], list[str]]:
+        """
+        Re-ingests only the pages that are new or changed since the last sync.
+
+        Old chunks and parent documents of changed or deleted pages are removed from the
+        vectorstore and docstore before the new sections are added, and the manifest is
+        saved once ingestion has finished.
+
+        Args:
+            page_titles (list[str]): The titles of the pages to sync.
+            manifest_file (str, optional): The manifest of ingested pages. Defaults to "manifest.jsonl".
+
+        Returns:
+            tuple[list[str], list[str]]: The titles that were (re-)ingested and the titles that were deleted.
+        """
+        manifest = self.source_manager.load_manifest(manifest_file)
+        changed, deleted, entries = self.source_manager.sync_pages(page_titles, manifest)
+
+        # Remove what the manifest recorded for changed and deleted pages
+        stale = [title for title in list(changed) + deleted if title in manifest]
+        self.retriever.delete_documents(
+            [doc_id for title in stale for doc_id in manifest[title].get('doc_ids', [])]
+        )
+
+        sections = [section for title in changed for section in changed[title]]
+        doc_ids = []
+        if sections:
+            doc_ids = self.retriever.add_documents(self.source_manager.to_documents(sections), save=False)
+
+        # Parent ids come back in document order
+        offset = 0
+        for title, sections in changed.items():
+            entries[title]['doc_ids'] = doc_ids[offset:offset + len(sections)]
+            offset += len(sections)
+        for title in deleted:
+            manifest.pop(title, None)
+        manifest.update(entries)
+        self.source_manager.save_manifest(manifest, manifest_file)
+        return list(changed), deleted
 
     # Init retriever
     def init_retriever(self) -> None:
@@ -57,8 +207,35 @@ class RAGPipeline:
         Returns:
             None
         """
+        with STARTUP.time("imports", "retriever"):
+            from langchain_huggingface import HuggingFaceEmbeddings
+            from modules.CustomParentDocumentRetriever import CustomParentDocRetriever
+            from modules.BatchedSemanticChunker import BatchedSemanticChunker
+            from modules.EmbeddingCache import CachedEmbeddings
+            from modules.DocStore import SQLiteDocStore, DOCSTORE_FILE
+            from modules.BM25Index import BM25Index, BM25_FILE
+            from modules.QueryCache import QueryCache
+        with STARTUP.time("models", "sentence_embeddings"):
+            sentence_embeddings = CachedEmbeddings(HuggingFaceEmbeddings(), self.vector_manager.embedding_cache)
+        chunk_embeddings = None
         # Initialize LangchainDB
-        self.vector_manager._init_langchaindb()
+        if self.embed_once:
+            # Chunks are stored with the pooled vectors of their sentences and queries are embedded by
+            # the same model, in a collection of its own as the dimensions differ from OpenAI's
+            chunk_embeddings = CachedEmbeddings(
+                sentence_embeddings.embeddings, self.vector_manager.embedding_cache,
+                model=f"{sentence_embeddings.model}:pooled"
+            )
+            if self.vector_backend == "compact":
+                self.vector_manager._init_compactdb(chunk_embeddings, collection_name="coppermind_pooled")
+            else:
+                self.vector_manager._init_langchaindb(
+                    chunk_embeddings, collection_name="coppermind_pooled", collection_metadata={"hnsw:space": "cosine"}
+                )
+        elif self.vector_backend == "compact":
+            self.vector_manager._init_compactdb()
+        else:
+            self.vector_manager._init_langchaindb()
         # Initialize metadata field info
         # self.vector_manager._init_metadata_field_info()
         # Create SelfQueryRetriever object
@@ -69,13 +246,25 @@ class RAGPipeline:
         #     metadata_field_info=self.vector_manager.metadata_field_info,  # Metadata field info
         #     structured_query_translator=ChromaTranslator()  # ChromaTranslator object
         # )
-        self.splitter = SemanticChunker(HuggingFaceEmbeddings())
-        self.docstore = InMemoryStore()
+        # Embeds the sentences of all documents added together in large batches
+        self.splitter = BatchedSemanticChunker(sentence_embeddings, max_workers=self.chunk_workers)
+        # Parents persist across runs and are loaded lazily, so nothing needs repopulating on start
+        self.docstore = SQLiteDocStore(self.docstore_path or DOCSTORE_FILE, read_only=self.read_only)
+        # Built alongside the docstore as parents are added
+        self.lexical_index = BM25Index(self.bm25_path or BM25_FILE, read_only=self.read_only)
         self.retriever = CustomParentDocRetriever(
             vectorstore=self.vector_manager.langdb,
             docstore=self.docstore,
-            child_splitter=self.splitter
+            child_splitter=self.splitter,
+            chunk_embeddings=chunk_embeddings,
+            lexical_index=self.lexical_index,
+            retrieval_mode=self.retrieval_mode
         )
+        # Shares the query embeddings with the vectorstore and is dropped whenever parents change
+        self.query_cache = QueryCache(
+            self.vector_manager.langdb.embeddings.embed_query, version=self.docstore.version,
+            threshold=self.semantic_cache_threshold
+        ) if self.cache_queries else None
 
     # Init compressor
     def init_compressor(self) -> None:
@@ -85,8 +274,16 @@ class RAGPipeline:
         Returns:
             None
         """
-        self.compressor: FlashrankRerank = FlashrankRerank()
-        self.rerank_retriever: ContextualCompressionRetriever = ContextualCompressionRetriever(
+        with STARTUP.time("imports", "reranker"):
+            from langchain.retrievers import ContextualCompressionRetriever
+            from modules.Reranker import BatchedFlashrankRerank
+        # Reranks the candidates of many queries per model run, in perform_rag_batch and for concurrent
+        # perform_rag calls. Pipelines share one warm model, the cap only bounds unusually large k, and
+        # queries whose closest parent is 20% closer than the next keep their vector order (see
+        # benchmarks/rerank.py for what that changes)
+        with STARTUP.time("models", "reranker"):
+            self.compressor = BatchedFlashrankRerank.shared(max_candidates=20, skip_margin=0.2)
+        self.rerank_retriever = ContextualCompressionRetriever(
             base_compressor=self.compressor, 
             base_retriever=self.retriever
         )
@@ -104,44 +301,222 @@ class RAGPipeline:
         Returns:
             str: The generated response from the language model.
         """
-        if not self.compressor:
-            self._init_retriever()
-            self._init_compressor()
+        with METRICS.span("rag.total"):
+            METRICS.count("rag.queries")
+            # Repeated and near-identical queries skip retrieval, reranking and the LLM
+            with METRICS.span("rag.cache"):
+                cached = self.query_cache.get(query) if self.query_cache is not None else None
+            if cached is not None:
+                METRICS.count("rag.cache_hits")
+                llm_docs, llm_response = cached
+            else:
+                llm_docs, llm_response = self._answer(query, verbose)
+                if self.query_cache is not None:
+                    self.query_cache.put(query, llm_docs, llm_response)
+
+        formatted = f"""
+{llm_response}
+
+Sources:"""
+        
+        print(formatted)
+        for i, source in enumerate(llm_docs,1):
+            print(f"{i} - {source.page_content}")
+
+        # Return the generated response
+        return llm_response, llm_docs
 
-        # Retrieve documents using the rerank retriever
-        llm_docs = self.rerank_retriever.invoke(query)
+    def _answer(self, query: str, verbose: bool = False) -> tuple[list, str]:
+        """
+        Retrieves and reranks the documents for a query and asks the LLM, bypassing the query cache.
+        """
+        # What the rerank retriever does, in two steps so each is timed
+        with METRICS.span("rag.retrieve"):
+            docs = self.retriever.invoke(query)
+        with METRICS.span("rag.rerank"):
+            llm_docs = list(self.compressor.compress_documents(docs, query))
+        METRICS.count("rag.documents_retrieved", len(docs))
 
         # Print the retrieved documents if verbose is True
         if verbose:
             print(llm_docs)
 
-        # Prepare the prompt for the language model
-        prompt = (
-            f"""
-            Use the below context to assist in answering this question: {query}
-
-            context
-            {llm_docs}
-            """
-        )
-
-        # Invoke the language model with the prompt
-        llm_response = self.llm.invoke(prompt)
+        # Invoke the language model with the prompt, the sources are the documents that fit in it
+        prompt, llm_docs = self._prompt(query, llm_docs)
+        with METRICS.span("rag.llm"):
+            llm_response = self.llm.invoke(prompt)
+        self._count_tokens(prompt, llm_response)
 
         # Print the generated response if verbose is True
         if verbose:
             print(llm_response)
         
         # Format response
-        llm_response = llm_response.strip()
-        formatted = f"""
-{llm_response}
+        return llm_docs, llm_response.strip()
 
-Sources:"""
-        
-        print(formatted)
-        for i, source in enumerate(llm_docs,1):
-            print(f"{i} - {source.page_content}")
+    def perform_rag_batch(self, queries: list[str], max_concurrency: int = 8) -> list[tuple]:
+        """
+        Performs RAG queries in bulk, e.g. for evaluation sets.
 
-        # Return the generated response
-        return llm_response, llm_docs
+        The queries are embedded in one call, searched with one vectorstore query, their
+        candidates reranked together and the LLM called for up to `max_concurrency` of them
+        at a time. Cached queries skip all of it, like in perform_rag.
+
+        Args:
+            queries (list[str]): The query strings to perform the RAG on.
+            max_concurrency (int, optional): The number of LLM calls in flight. Defaults to 8.
+
+        Returns:
+            list[tuple]: The `(llm_response, llm_docs)` of every query, in the order of `queries`.
+                A query whose LLM call failed has the exception in place of its response.
+        """
+        results = [None] * len(queries)
+        embeddings = self.retriever.vectorstore.embeddings
+        query_vectors = None
+        if self.retrieval_mode != "lexical" and hasattr(embeddings, "embed_queries"):
+            # Also fills the embedding cache the query cache looks near-duplicates up with
+            query_vectors = embeddings.embed_queries(queries)
+        pending = []
+        METRICS.count("rag.queries", len(queries))
+        with METRICS.span("rag.cache"):
+            for i, query in enumerate(queries):
+                cached = self.query_cache.get(query) if self.query_cache is not None else None
+                if cached is not None:
+                    results[i] = (cached[1], cached[0])
+                else:
+                    pending.append(i)
+        METRICS.count("rag.cache_hits", len(queries) - len(pending))
+        if not pending:
+            return results
+
+        pending_queries = [queries[i] for i in pending]
+        with METRICS.span("rag.retrieve"):
+            candidates = self.retriever.batch_relevant_documents(
+                pending_queries, [query_vectors[i] for i in pending] if query_vectors is not None else None
+            )
+        METRICS.count("rag.documents_retrieved", sum(len(docs) for docs in candidates))
+        with METRICS.span("rag.rerank"):
+            if hasattr(self.compressor, "compress_documents_batch"):
+                reranked = self.compressor.compress_documents_batch(candidates, pending_queries)
+            else:
+                reranked = [list(self.compressor.compress_documents(docs, query)) for docs, query in zip(candidates, pending_queries)]
+
+        # LLM.batch runs the prompts of a batch one after the other, so the calls get threads of their own
+        def invoke(prompt: str):
+            try:
+                with METRICS.span("rag.llm"):
+                    llm_response = self.llm.invoke(prompt)
+            except Exception as e:
+                return e
+            self._count_tokens(prompt, llm_response)
+            return llm_response
+
+        prompts, reranked = zip(*(self._prompt(query, llm_docs) for query, llm_docs in zip(pending_queries, reranked)))
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            llm_responses = list(executor.map(invoke, prompts))
+        for i, query, llm_docs, llm_response in zip(pending, pending_queries, reranked, llm_responses):
+            if isinstance(llm_response, Exception):
+                results[i] = (llm_response, llm_docs)
+                continue
+            results[i] = (llm_response.strip(), llm_docs)
+            if self.query_cache is not None:
+                self.query_cache.put(query, llm_docs, results[i][0])
+        return results
+
+    @staticmethod
+    def _count_tokens(prompt: str, llm_response: str) -> None:
+        # Estimated, only worth the work while metrics are collected
+        if METRICS.enabled:
+            METRICS.count("rag.tokens_sent", estimate_tokens(prompt))
+            METRICS.count("rag.tokens_received", estimate_tokens(llm_response))
+
+    @staticmethod
+    def metrics(format: str = "json"):
+        """
+        The stage timings and counters collected since metrics were enabled, see modules.Metrics.
+
+        Collecting is off by default, turn it on with `METRICS.enable()` or the KB_CHAT_METRICS
+        environment variable set to 1.
+
+        Args:
+            format (str, optional): "json" for a dict, or "prometheus" for the Prometheus text format.
+                Defaults to "json".
+
+        Returns:
+            dict | str: The spans and counters.
+        """
+        if format == "prometheus":
+            return METRICS.to_prometheus()
+        return METRICS.to_json()
+
+    def _prompt(self, query: str, llm_docs: list) -> tuple[str, list]:
+        # Prepare the prompt for the language model, with the documents that fit in the context budget
+        context, llm_docs = self.context_packer.pack(llm_docs)
+        prompt = (
+            f"Use the below context to assist in answering this question: {query}\n\n"
+            f"context\n{context}\n"
+        )
+        return prompt, llm_docs
+
+    @staticmethod
+    def sources(llm_docs: list) -> list[dict]:
+        """
+        The reranked documents as structured sources, in the order the prompt numbers them.
+
+        Args:
+            llm_docs (list): The documents in the prompt context, see `_prompt`.
+
+        Returns:
+            list[dict]: The rank, article, heading, rerank score and content of every document.
+        """
+        return [
+            {
+                "rank": i,
+                "article": doc.metadata.get("parent_article"),
+                "heading": doc.metadata.get("heading"),
+                "relevance_score": doc.metadata.get("relevance_score"),
+                "content": doc.page_content,
+            }
+            for i, doc in enumerate(llm_docs, 1)
+        ]
+
+    async def astream_rag(self, query: str) -> AsyncIterator[dict]:
+        """
+        Performs a RAG query without blocking the event loop, streaming the answer as it is generated.
+
+        Yields events, in this order:
+            {"type": "sources", "sources": [...]}: The reranked documents in the prompt, see `sources`.
+            {"type": "token", "text": str}: A piece of the answer, as the LLM produces it.
+            {"type": "answer", "text": str, "cached": bool}: The whole answer.
+
+        Args:
+            query (str): The query string to perform the RAG on.
+
+        Returns:
+            AsyncIterator[dict]: The events.
+        """
+        cached = None
+        if self.query_cache is not None:
+            # The cache may embed the query, a blocking call
+            cached = await asyncio.to_thread(self.query_cache.get, query)
+        if cached is not None:
+            llm_docs, llm_response = cached
+            yield {"type": "sources", "sources": self.sources(llm_docs)}
+            yield {"type": "token", "text": llm_response}
+            yield {"type": "answer", "text": llm_response, "cached": True}
+            return
+
+        # Chroma, the docstore and Flashrank are synchronous, the async path runs them in executor threads
+        llm_docs = await self.rerank_retriever.ainvoke(query)
+        prompt, llm_docs = self._prompt(query, llm_docs)
+        yield {"type": "sources", "sources": self.sources(llm_docs)}
+
+        chunks = []
+        async for chunk in self.llm.astream(prompt):
+            chunks.append(chunk)
+            yield {"type": "token", "text": chunk}
+        llm_response = "".join(chunks).strip()
+
+        if self.query_cache is not None:
+            await asyncio.to_thread(self.query_cache.put, query, llm_docs, llm_response)
+        yield {"type": "answer", "text": llm_response, "cached": False}
@@ -0,0 +1,5 @@
+"""
+Benchmarks for the KB Chat pipeline.
+
+Run from the src directory, e.g. `python -m benchmarks.get_sections`.
+"""
@@ -0,0 +1,185 @@
+# Index size and query payload with article data copied into every paragraph, and with the article store
+import argparse
+import json
+import random
+import tempfile
+import timeit
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+from benchmarks.stubs import FIXTURE_FILE, FakeEmbeddings
+from modules.VectorDBManager import VectorDBManager
+
+
+def corpus(copies: int, extra_links: int, seed: int = 0) -> list[dict]:
+    """
+    The fixture articles `copies` times under new titles, with `extra_links` more links each,
+    as real wiki pages link to far more articles than the fixture keeps.
+    """
+    rng = random.Random(seed)
+    with open(FIXTURE_FILE, "r") as file:
+        fixture = [json.loads(line) for line in file]
+    titles = [f"{article['title']} {i}" for i in range(copies) for article in fixture]
+    articles = []
+    for i in range(copies):
+        for article in fixture:
+            article = dict(article, title=f"{article['title']} {i}")
+            if article["sections"] is not None:
+                article["links"] = article["links"] + rng.sample(titles, min(extra_links, len(titles)))
+            articles.append(article)
+    return articles
+
+
+def manager(directory: Path, embeddings: FakeEmbeddings) -> VectorDBManager:
+    # A manager over a local Chroma, embedding with the fake model instead of OpenAI
+    db = object.__new__(VectorDBManager)
+    db.__dict__.update(db_dir=directory / "chroma", articles_file=directory / "articles.sqlite")
+    db.__dict__["chroma_embedding_function"] = embeddings.embed_documents
+    db.__dict__["collection"] = db.chroma_client.get_or_create_collection("coppermind")
+    return db
+
+
+def ingest_legacy(db: VectorDBManager, articles: list[dict], embeddings: FakeEmbeddings) -> None:
+    # How ingest_articles stored paragraphs before the article store
+    rows = [
+        (db.paragraph_id(article["title"], paragraph), paragraph["content"], {
+            "article_title": article["title"],
+            "paragraph_header": paragraph["title"],
+            "paragraph_order": paragraph["order"],
+            "links": ", ".join(article["links"]),
+            "keywords": "",
+        })
+        for article in articles if article["sections"] is not None for paragraph in article["sections"]
+    ]
+    for i in range(0, len(rows), 5000):
+        ids, documents, metadatas = zip(*rows[i:i + 5000])
+        db.collection.upsert(ids=list(ids), documents=list(documents), metadatas=list(metadatas),
+                             embeddings=embeddings.embed_documents(list(documents)))
+
+
+def directory_bytes(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+
+def measure(name: str, db: VectorDBManager, queries: list[list[float]], k: int) -> dict:
+    metadata_bytes, payload_bytes, samples = [], [], []
+    for query in queries:
+        start_time = timeit.default_timer()
+        result = db.collection.query(query_embeddings=[query], n_results=k, include=["documents", "metadatas"])
+        samples.append(timeit.default_timer() - start_time)
+        metadata_bytes.append(len(json.dumps(result["metadatas"][0]).encode("utf-8")))
+        payload_bytes.append(metadata_bytes[-1] + len(json.dumps(result["documents"][0]).encode("utf-8")))
+    # Resolving the articles of k hits, what a caller needing the links now pays on top of the query
+    lookup_us = None
+    ids = [metadata["article_id"] for metadata in result["metadatas"][0] if "article_id" in metadata]
+    if ids:
+        db.articles.mget(ids)
+        start_time = timeit.default_timer()
+        for _ in range(1000):
+            db.articles.mget(ids)
+        lookup_us = round((timeit.default_timer() - start_time) / 1000 * 1e6, 2)
+    articles_bytes = sum(file.stat().st_size for file in db.articles_file.parent.glob(db.articles_file.name + "*"))
+    return {
+        "layout": name,
+        "paragraphs": db.collection.count(),
+        "chroma_bytes": directory_bytes(db.db_dir),
+        "article_store_bytes": articles_bytes,
+        "metadata_bytes_per_query": round(float(np.mean(metadata_bytes)), 1),
+        "payload_bytes_per_query": round(float(np.mean(payload_bytes)), 1),
+        "query_p50_ms": round(float(np.percentile(samples, 50)) * 1000, 3),
+        "article_lookup_us": lookup_us,
+    }
+
+
+def check_reingest(embeddings: FakeEmbeddings) -> dict:
+    """
+    Re-ingesting an article with an edited section replaces the old paragraph instead of keeping both.
+    """
+    db = manager(Path(tempfile.mkdtemp()), embeddings)
+    article = {"title": "Kaladin", "links": [], "sections": [
+        {"title": "Kaladin", "order": 0, "content": "Kaladin is a Windrunner."},
+        {"title": "History", "order": 1, "content": "He was a slave."},
+    ]}
+    db.ingest_articles([article])
+    history = dict(article["sections"][1], content="He was a soldier, then a slave.")
+    edited = dict(article, sections=[article["sections"][0], history])
+    db.ingest_articles([edited])
+    documents = sorted(db.collection.get(include=["documents"])["documents"])
+    assert documents == ["He was a soldier, then a slave.", "Kaladin is a Windrunner."], documents
+    db.ingest_articles([dict(article, sections=None, links=["Stormblessed"])])
+    assert db.collection.count() == 0, db.collection.count()
+    return {"check": "reingest", "documents": documents}
+
+
+def check_interrupted_migration(embeddings: FakeEmbeddings) -> dict:
+    """
+    A migration interrupted between deleting and adding back a batch loses no paragraph, the next run adds it back.
+    """
+    db = manager(Path(tempfile.mkdtemp()), embeddings)
+    ingest_legacy(db, corpus(1, 0), embeddings)
+    expected = db.collection.count()
+    collection = db.collection
+
+    class Interrupted(Exception):
+        pass
+
+    def add(**kwargs):
+        raise Interrupted
+
+    db.__dict__["collection"] = SimpleNamespace(get=collection.get, delete=collection.delete, add=add)
+    try:
+        db.normalize_articles(batch_size=100)
+    except Interrupted:
+        pass
+    lost = expected - collection.count()
+    db.__dict__["collection"] = collection
+    db.normalize_articles(batch_size=100)
+    metadatas = collection.get(include=["metadatas"])["metadatas"]
+    assert lost and len(metadatas) == expected, (lost, len(metadatas), expected)
+    assert all("article_id" in metadata and "article_title" not in metadata for metadata in metadatas)
+    return {"check": "interrupted_migration", "paragraphs": expected, "missing_after_interrupt": lost}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare per-paragraph article metadata with the article store")
+    parser.add_argument("--copies", type=int, default=10, help="copies of the fixture articles under new titles")
+    parser.add_argument("--links", type=int, nargs="+", default=[0, 100], help="extra links per article")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=4)
+    args = parser.parse_args()
+
+    embeddings = FakeEmbeddings()
+    print(json.dumps(check_reingest(embeddings)))
+    print(json.dumps(check_interrupted_migration(embeddings)))
+    for extra_links in args.links:
+        articles = corpus(args.copies, extra_links)
+        texts = [paragraph["content"] for article in articles if article["sections"] for paragraph in article["sections"]]
+        queries = embeddings.embed_documents(random.Random(1).sample(texts, args.queries))
+        links = float(np.mean([len(article["links"]) for article in articles]))
+
+        legacy = manager(Path(tempfile.mkdtemp()), embeddings)
+        ingest_legacy(legacy, articles, embeddings)
+        before = measure("per_paragraph", legacy, queries, args.k)
+
+        normalized = manager(Path(tempfile.mkdtemp()), embeddings)
+        normalized.ingest_articles(articles)
+        after = measure("article_store", normalized, queries, args.k)
+
+        # Migrating the legacy collection gives the same metadata as ingesting afresh, bar the redirects
+        # the legacy layout never stored
+        rewritten = legacy.normalize_articles()
+        fresh, migrated = (db.collection.get(include=["metadatas"]) for db in (normalized, legacy))
+        same = dict(zip(fresh["ids"], fresh["metadatas"])) == dict(zip(migrated["ids"], migrated["metadatas"]))
+        same = same and all(
+            dict(normalized.articles.by_title(article["title"]), redirects=[]) == legacy.articles.by_title(article["title"])
+            for article in articles if article["sections"]
+        )
+        for record in (before, after):
+            print(json.dumps({"articles": len(articles), "links_per_article": round(links, 1), **record}))
+        print(json.dumps({"migration": {"rewritten": rewritten, "matches_fresh_ingest": same}}))
+
+
+if __name__ == "__main__":
+    main()
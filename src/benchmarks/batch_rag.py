@@ -0,0 +1,107 @@
+# Throughput of RAGPipeline.perform_rag_batch against perform_rag in a loop
+import argparse
+import contextlib
+import io
+import json
+import tempfile
+import timeit
+from pathlib import Path
+
+from langchain_core.documents import Document
+
+from benchmarks.retrieval import entity_queries, load_sections
+from benchmarks.stubs import FakeEmbeddings, FakeLLM, FakeRanker, offline_pipeline
+from modules.EmbeddingCache import CachedEmbeddings, EmbeddingCache
+from Pipeline import RAGPipeline
+
+
+def build(documents, args) -> tuple[RAGPipeline, FakeEmbeddings, FakeRanker]:
+    """
+    An offline pipeline with the fixture sections ingested, without the query cache.
+    """
+    fake = FakeEmbeddings()
+    ranker = FakeRanker(latency=args.rerank_latency, per_pair=args.rerank_per_pair)
+    pipeline = offline_pipeline(Path(tempfile.mkdtemp()), fake, ranker, FakeLLM(latency=args.llm_latency), k=args.k)
+    pipeline.retriever.add_documents(documents, save=False)
+    fake.latency = args.embed_latency
+    return pipeline, fake, ranker
+
+
+def check_parent_ids(pipeline: RAGPipeline, queries: list[str]) -> dict:
+    """
+    Retrieved parents carry the docstore id ContextPacker dedupes on, in every retrieval mode.
+    """
+    packed_duplicates = 0
+    for mode in ("vector", "lexical", "hybrid"):
+        pipeline.retriever.retrieval_mode = mode
+        for query in queries:
+            docs = pipeline.rerank_retriever.invoke(query)
+            ids = [doc.metadata.get("doc_id") for doc in docs]
+            assert None not in ids and len(set(ids)) == len(ids), ids
+            assert [doc.page_content for doc in pipeline.docstore.mget(ids)] == [doc.page_content for doc in docs]
+            # The same parent again with other content, e.g. cut differently, is packed once
+            duplicate = Document(page_content=docs[0].page_content[:100], metadata=dict(docs[0].metadata))
+            _, packed = pipeline.context_packer.pack(docs + [duplicate])
+            packed_duplicates += sum(doc.metadata["doc_id"] == ids[0] for doc in packed) - 1
+    pipeline.retriever.retrieval_mode = "vector"
+    assert packed_duplicates == 0, packed_duplicates
+    return {"check": "parent_ids", "queries": len(queries)}
+
+
+def run(name: str, fn, pipeline, fake, ranker, queries) -> tuple[dict, list]:
+    # A cold query embedding cache and reranker score cache for every run
+    pipeline.vector_manager.langdb._embedding_function = CachedEmbeddings(fake, EmbeddingCache(tempfile.mkdtemp()))
+    pipeline.compressor.clear_scores()
+    calls, runs = fake.calls, ranker.runs
+    start_time = timeit.default_timer()
+    results = fn(queries)
+    elapsed = timeit.default_timer() - start_time
+    return {
+        "mode": name,
+        "queries": len(queries),
+        "seconds": round(elapsed, 2),
+        "queries_per_second": round(len(queries) / elapsed, 1),
+        "embedding_calls": fake.calls - calls,
+        "rerank_runs": ranker.runs - runs,
+    }, results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare perform_rag_batch with perform_rag in a loop")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--serial", type=int, default=100, help="queries answered one by one with perform_rag")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="simulated seconds per embedding call")
+    parser.add_argument("--rerank-latency", type=float, default=0.005, help="simulated seconds per reranker run")
+    parser.add_argument("--rerank-per-pair", type=float, default=0.0002, help="simulated seconds per reranked pair")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="simulated seconds per LLM call")
+    args = parser.parse_args()
+
+    documents = load_sections()
+    queries = [query for _, query in entity_queries(documents, args.queries)]
+    pipeline, fake, ranker = build(documents, args)
+    print(json.dumps(check_parent_ids(pipeline, queries[:20])))
+
+    def serial(queries):
+        # perform_rag prints every answer
+        with contextlib.redirect_stdout(io.StringIO()):
+            return [pipeline.perform_rag(query) for query in queries]
+
+    report, expected = run("serial", serial, pipeline, fake, ranker, queries[:args.serial])
+    print(json.dumps(report))
+    for concurrency in args.concurrency:
+        report, results = run(
+            f"batch_{concurrency}", lambda queries: pipeline.perform_rag_batch(queries, max_concurrency=concurrency),
+            pipeline, fake, ranker, queries
+        )
+        # Same answers and sources, in query order
+        report["matches_serial"] = all(
+            answer == expected_answer and [d.page_content for d in docs] == [d.page_content for d in expected_docs]
+            for (answer, docs), (expected_answer, expected_docs) in zip(results, expected)
+        )
+        print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Per-document SemanticChunker against BatchedSemanticChunker on the fixture sections
+import argparse
+import json
+import timeit
+
+from langchain_core.documents import Document
+from langchain_experimental.text_splitter import SemanticChunker
+
+from benchmarks.stubs import FIXTURE_FILE, FakeEmbeddings
+from modules.BatchedSemanticChunker import BatchedSemanticChunker
+
+
+def load_documents(copies: int = 1) -> list[Document]:
+    with open(FIXTURE_FILE, "r") as file:
+        articles = [json.loads(line) for line in file]
+    return [
+        Document(page_content=section["content"], metadata={"parent_article": article["title"], "copy": i})
+        for i in range(copies) for article in articles if article["sections"] for section in article["sections"]
+    ]
+
+
+def run(name: str, split, embeddings: FakeEmbeddings, documents: list[Document]) -> tuple[dict, list]:
+    start_time = timeit.default_timer()
+    chunks = split(documents)
+    elapsed = timeit.default_timer() - start_time
+    return {
+        "splitter": name,
+        "documents": len(documents),
+        "chunks": len(chunks),
+        "embedding_calls": embeddings.calls,
+        "seconds": round(elapsed, 2),
+        "documents_per_second": round(len(documents) / elapsed, 1),
+    }, chunks
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare per-document and batched semantic chunking")
+    parser.add_argument("--copies", type=int, default=1, help="times the fixture sections are repeated")
+    parser.add_argument("--latency", type=float, default=0.005, help="simulated seconds per embedding call")
+    parser.add_argument("--per-text", type=float, default=0.0001, help="simulated seconds per embedded text")
+    parser.add_argument("--workers", type=int, nargs="*", default=[1, 4])
+    args = parser.parse_args()
+
+    documents = load_documents(args.copies)
+    embeddings = FakeEmbeddings(latency=args.latency, per_text=args.per_text)
+    chunker = SemanticChunker(embeddings)
+    # The loop _split_docs_for_adding used to run
+    result, expected = run("semantic", lambda docs: [c for doc in docs for c in chunker.split_documents([doc])],
+                           embeddings, documents)
+    print(json.dumps(result))
+    for workers in args.workers:
+        embeddings = FakeEmbeddings(latency=args.latency, per_text=args.per_text)
+        chunker = BatchedSemanticChunker(embeddings, max_workers=workers)
+        result, chunks = run(f"batched_{workers}", chunker.split_documents, embeddings, documents)
+        result["identical"] = chunks == expected
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# Size, startup, memory, latency and recall of the compact vector backend against Chroma
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+
+import numpy as np
+from langchain_core.documents import Document
+
+from benchmarks.retrieval import entity_queries, load_sections
+from benchmarks.stats import percentiles
+from benchmarks.stubs import FakeEmbeddings
+from modules.CompactVectorStore import CompactVectorStore
+from modules.CustomParentDocumentRetriever import CustomParentDocRetriever
+from modules.DocStore import SQLiteDocStore
+from modules.VectorDBManager import VectorDBManager
+
+# Runs in the child, so only what opening the backend behind the langchain interface needs is imported
+# and resident. Both import langchain_core, which the pipeline imports anyway
+PROBE = """
+import json, resource, sys, timeit
+sys.path.insert(0, {src!r})
+start_time = timeit.default_timer()
+if {backend!r} == "chroma":
+    import chromadb
+    from langchain_chroma import Chroma
+    store = Chroma(collection_name="coppermind", client=chromadb.PersistentClient(path={path!r}))
+else:
+    from modules.CompactVectorStore import CompactVectorStore
+    store = CompactVectorStore({path!r})
+opened = timeit.default_timer()
+store.similarity_search_by_vector({vector!r}, k=4)
+first_query = timeit.default_timer() - opened
+# ru_maxrss carries the parent's peak over on Linux, VmHWM starts afresh with the new program
+with open("/proc/self/status") as file:
+    peak = next((int(line.split()[1]) for line in file if line.startswith("VmHWM")), None)
+print(json.dumps({{
+    "open_seconds": round(opened - start_time, 3),
+    "first_query_seconds": round(first_query, 3),
+    "peak_rss_mb": round((peak or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024, 1),
+}}))
+"""
+
+
+def probe(backend: str, path: Path, vector: list[float]) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-W", "ignore", "-c", PROBE.format(src=str(Path(__file__).parent.parent), backend=backend,
+                                                             path=str(path), vector=vector)],
+        capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def check_interface(store: CompactVectorStore, collection, queries: list[list[float]], directory: Path) -> dict:
+    """
+    `get` matches Chroma's, batched search matches one query at a time, and writes through the
+    retriever fail before the docstore is touched.
+    """
+    where = {"$or": [{"parent_article": {"$in": ["Kaladin", "Hoid"]}}, {"heading": "Appearance"}]}
+    assert sorted(store.get(where=where)["ids"]) == sorted(collection.get(where=where)["ids"])
+    ids = collection.get(limit=1200, include=[])["ids"]
+    assert sorted(store.get(ids=ids, include=[])["ids"]) == sorted(ids)
+    page = store.get(ids=ids[:5], limit=2, offset=1)
+    assert len(page["ids"]) == len(page["documents"]) == len(page["metadatas"]) == 2, page
+    assert len(store.get_by_ids(ids)) == len(ids)
+    batch = store.similarity_search_with_score_by_vectors(queries, k=4)
+    single = [store.similarity_search_with_score_by_vector(query, k=4) for query in queries]
+    # Matrix products of many queries round differently from one at a time
+    assert [[doc for doc, _ in hits] for hits in batch] == [[doc for doc, _ in hits] for hits in single]
+    assert np.allclose([d for hits in batch for _, d in hits], [d for hits in single for _, d in hits], atol=1e-4)
+
+    docstore = SQLiteDocStore(directory / "docstore.sqlite")
+    docstore.mset([("parent", Document(page_content="Kaladin - A parent section."))])
+    retriever = CustomParentDocRetriever(vectorstore=store, docstore=docstore, child_splitter=None)
+    for write in (lambda: retriever.delete_documents(["parent"]), lambda: retriever.add_documents([Document("new")], save=False)):
+        try:
+            write()
+        except NotImplementedError:
+            continue
+        raise AssertionError("a write to the read-only store went through")
+    assert docstore.mget(["parent"])[0] is not None
+    return {"check": "interface", "ids": len(ids), "queries": len(queries)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the compact vector backend with Chroma")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--extra", type=int, default=20000, help="synthetic chunks added to the fixture ones")
+    parser.add_argument("--nlist", type=int, default=0, help="IVF lists, 0 for about sqrt of the rows")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[4, 16])
+    args = parser.parse_args()
+
+    directory = Path(tempfile.mkdtemp())
+    embeddings = FakeEmbeddings()
+    manager = object.__new__(VectorDBManager)
+    manager.__dict__.update(db_dir=directory / "chroma", cache_dir=directory / "cache", compact_dir=directory / "compact")
+    manager._init_langchaindb(embeddings)
+    documents = load_sections()
+    manager.langdb.add_texts([doc.page_content for doc in documents], [doc.metadata for doc in documents])
+    # Perturbed copies of fixture chunks, so the extra rows crowd the neighbourhoods queries land in
+    rng = np.random.default_rng(0)
+    base = np.array(embeddings.embed_documents([doc.page_content for doc in documents]), dtype=np.float32)
+    collection = manager.langdb._collection
+    for start in range(0, args.extra, 5000):
+        size = min(5000, args.extra - start)
+        vectors = base[rng.integers(len(base), size=size)] + rng.normal(0, 0.05, (size, base.shape[1])).astype(np.float32)
+        collection.add(
+            ids=[f"extra-{start + i}" for i in range(size)], embeddings=vectors.tolist(),
+            documents=[f"extra {start + i}" for i in range(size)], metadatas=[{"parent_article": "extra"}] * size,
+        )
+
+    stored = collection.get(include=["embeddings"])
+    index = {id: i for i, id in enumerate(stored["ids"])}
+    exact = np.array(stored["embeddings"], dtype=np.float32)
+    queries = [embeddings.embed_query(query) for _, query in entity_queries(documents, args.queries)]
+    kth = [np.partition(((exact - query) ** 2).sum(axis=1), args.k - 1)[args.k - 1] for query in queries]
+
+    def recall(found_ids: list[list[str]]) -> float:
+        # Share of the hits that are truly among the k closest, counting ties at the k-th distance
+        hits = [
+            sum(((exact[index[id]] - query) ** 2).sum() <= bound + 1e-5 for id in ids)
+            for ids, query, bound in zip(found_ids, queries, kth)
+        ]
+        return round(sum(hits) / (len(queries) * args.k), 4)
+
+    def measure(name: str, search) -> dict:
+        samples, found = [], []
+        for query in queries:
+            start_time = timeit.default_timer()
+            docs = search(query)
+            samples.append(timeit.default_timer() - start_time)
+            found.append([doc.id for doc in docs])
+        return {"backend": name, **percentiles(samples), "recall": recall(found)}
+
+    rows = collection.count()
+    chroma_bytes = sum(file.stat().st_size for file in (directory / "chroma").rglob("*") if file.is_file())
+    print(json.dumps({"rows": rows, **measure("chroma", lambda q: [d for d, _ in manager.langdb.similarity_search_by_vector_with_relevance_scores(q, k=args.k)]),
+                      "bytes": chroma_bytes, **probe("chroma", directory / "chroma", queries[0])}))
+
+    nlist = args.nlist or int(np.sqrt(rows))
+    for dtype in ("float32", "float16", "int8"):
+        for lists in (0, nlist):
+            stats = manager.export_compact(dtype=dtype, nlist=lists)
+            path = directory / "compact" / "coppermind"
+            opened = probe("compact", path, queries[0])
+            for nprobe in (args.nprobe if lists else [None]):
+                store = CompactVectorStore(path, embeddings, nprobe=nprobe or 0)
+                result = measure("compact", lambda q: store.similarity_search_by_vector(q, k=args.k))
+                start_time = timeit.default_timer()
+                store.search_vectors(queries, k=args.k)
+                batch_seconds = timeit.default_timer() - start_time
+                print(json.dumps({
+                    **result, "dtype": dtype, "nlist": lists, "nprobe": nprobe,
+                    "batch_queries_per_second": round(len(queries) / batch_seconds, 1),
+                    "bytes": sum(stats["bytes"].values()), "vector_bytes": stats["bytes"]["vectors.npy"], **opened,
+                }))
+    print(json.dumps(check_interface(CompactVectorStore(path, embeddings), collection, queries[:20], directory)))
+
+
+if __name__ == "__main__":
+    main()
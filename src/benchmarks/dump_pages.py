@@ -0,0 +1,78 @@
+# Throughput and memory of streaming a MediaWiki XML dump through SourceManager.dump_pages
+import argparse
+import bz2
+import json
+import re
+import tempfile
+import timeit
+import tracemalloc
+from pathlib import Path
+
+from modules.SourceManager import SourceManager
+
+DUMP_FILE = Path(__file__).parent.parent.parent / "tests" / "coppermind-pages-articles.xml"
+
+
+def synthetic_dump(copies: int) -> Path:
+    """
+    The fixture dump with its pages repeated `copies` times under new titles, bz2 compressed.
+    """
+    text = DUMP_FILE.read_text()
+    head, rest = text.split("<page>", 1)
+    pages, tail = rest.rsplit("</page>", 1)
+    pages = "<page>" + pages + "</page>"
+    path = Path(tempfile.mkdtemp()) / "pages-articles.xml.bz2"
+    with bz2.open(path, "wt") as file:
+        file.write(head)
+        for i in range(copies):
+            file.write(re.sub(r"<title>(.*?)</title>", rf"<title>\1 {i}</title>", pages))
+        file.write(tail)
+    return path
+
+
+def check_titles(manager: SourceManager) -> dict:
+    """
+    Pages of every kept namespace come out under distinct, full titles.
+    """
+    titles = {namespaces: [page.name for page in manager.dump_pages(DUMP_FILE, namespaces)]
+              for namespaces in [(0,), (0, 1, 14)]}
+    everything = titles[(0, 1, 14)]
+    assert len(everything) == len(set(everything)), everything
+    assert "Talk:Tanavast" in everything and "Tanavast" in everything, everything
+    assert all(":" not in title for title in titles[(0,)]), titles[(0,)]
+    return {"check": "titles", **{",".join(map(str, ns)): found for ns, found in titles.items()}}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Stream and section the pages of a dump")
+    parser.add_argument("--copies", type=int, default=500, help="repeats of the fixture pages in the synthetic dump")
+    args = parser.parse_args()
+
+    manager = SourceManager()
+    print(json.dumps(check_titles(manager)))
+
+    path = synthetic_dump(args.copies)
+    for sections in (False, True):
+        tracemalloc.start()
+        start_time = timeit.default_timer()
+        pages = chunks = 0
+        for page in manager.dump_pages(path):
+            pages += 1
+            if sections:
+                chunks += len(manager.get_sections(page))
+        elapsed = timeit.default_timer() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(json.dumps({
+            "mode": "get_sections" if sections else "dump_pages",
+            "dump_mb": round(path.stat().st_size / 1024 / 1024, 2),
+            "pages": pages,
+            "sections": chunks,
+            "seconds": round(elapsed, 2),
+            "pages_per_second": round(pages / elapsed, 1),
+            "peak_traced_mb": round(peak / 1024 / 1024, 2),
+        }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# Embedding work and parent recall of two-pass chunk embedding against pooled, embed-once vectors
+import argparse
+import json
+import random
+import tempfile
+import timeit
+
+import chromadb
+from langchain_chroma import Chroma
+from langchain_core.stores import InMemoryStore
+
+from benchmarks.chunking import load_documents
+from benchmarks.stubs import FakeEmbeddings
+from modules.BatchedSemanticChunker import BatchedSemanticChunker
+from modules.CustomParentDocumentRetriever import CustomParentDocRetriever
+from modules.EmbeddingCache import CachedEmbeddings, EmbeddingCache
+
+
+def build(embed_once: bool, latency: float, per_text: float):
+    """
+    A retriever over an in-memory Chroma, with fresh fake embeddings and cache.
+    """
+    fake = FakeEmbeddings(latency=latency, per_text=per_text)
+    cache = EmbeddingCache(tempfile.mkdtemp())
+    sentence_embeddings = CachedEmbeddings(fake, cache)
+    chunk_embeddings = CachedEmbeddings(fake, cache, model=f"{sentence_embeddings.model}:pooled") if embed_once else None
+    vectorstore = Chroma(
+        collection_name="embed_once" if embed_once else "two_pass",
+        embedding_function=chunk_embeddings or sentence_embeddings,
+        client=chromadb.EphemeralClient(),
+        collection_metadata={"hnsw:space": "cosine"},
+    )
+    retriever = CustomParentDocRetriever(
+        vectorstore=vectorstore,
+        docstore=InMemoryStore(),
+        child_splitter=BatchedSemanticChunker(sentence_embeddings),
+        chunk_embeddings=chunk_embeddings,
+    )
+    return retriever, fake
+
+
+def run(embed_once: bool, documents, queries, args) -> dict:
+    retriever, fake = build(embed_once, args.latency, args.per_text)
+    start_time = timeit.default_timer()
+    parent_ids = retriever.add_documents(documents, save=False)
+    elapsed = timeit.default_timer() - start_time
+    texts = fake.texts
+
+    hits = 0
+    for i, query in queries:
+        found = retriever.vectorstore.similarity_search(query, k=args.k)
+        hits += any(doc.metadata["doc_id"] == parent_ids[i] for doc in found)
+    return {
+        "mode": "embed_once" if embed_once else "two_pass",
+        "documents": len(documents),
+        "embedded_texts": texts,
+        "seconds": round(elapsed, 2),
+        f"parent_recall_at_{args.k}": round(hits / len(queries), 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare two-pass and embed-once chunk vectors")
+    parser.add_argument("--limit", type=int, default=500, help="number of fixture sections")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.005, help="simulated seconds per embedding call")
+    parser.add_argument("--per-text", type=float, default=0.0001, help="simulated seconds per embedded text")
+    args = parser.parse_args()
+
+    documents = load_documents()[:args.limit]
+    rng = random.Random(0)
+    # A sentence of a section should find one of that section's chunks
+    queries = []
+    for i in rng.sample(range(len(documents)), min(args.queries, len(documents))):
+        sentences = [s for s in documents[i].page_content.split(". ") if len(s.split()) > 3]
+        if sentences:
+            queries.append((i, rng.choice(sentences)))
+    for embed_once in (False, True):
+        print(json.dumps(run(embed_once, documents, queries, args)))
+
+
+if __name__ == "__main__":
+    main()
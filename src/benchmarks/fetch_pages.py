@@ -0,0 +1,92 @@
+# Compare one-title-at-a-time retrieval with SourceManager.fetch_pages against the stub wiki
+import argparse
+import json
+import timeit
+
+from benchmarks.stubs import StubWikiServer, load_fixture_pages
+from modules.SourceManager import SourceManager
+
+
+def run(server: StubWikiServer, titles: list, batched: bool, max_workers: int) -> tuple:
+    """
+    Fetches and sections every title, counting the requests the stub wiki receives.
+
+    Returns:
+        tuple: The timing record and the section dicts that were produced.
+    """
+    manager = SourceManager(wiki_endpoint=server.endpoint, scheme="http", max_workers=max_workers, request_interval=0)
+    manager._init_mwclient()
+    server.requests = 0
+    start_time = timeit.default_timer()
+    if batched:
+        pages = manager.fetch_pages(titles)
+    else:
+        pages = (manager.site.pages[title] for title in titles)
+    data = [section for page in pages for section in manager.get_sections(page)]
+    elapsed = timeit.default_timer() - start_time
+    record = {
+        "batched": batched,
+        "max_workers": max_workers,
+        "pages": len(titles),
+        "requests": server.requests,
+        "seconds": round(elapsed, 3),
+        "pages_per_second": round(len(titles) / elapsed, 1),
+    }
+    return record, data
+
+
+def check_namespaces() -> dict:
+    """
+    Pages of other namespaces keep their prefix in the name, and map back to the titles that were requested.
+    """
+    pages = {**load_fixture_pages(), "Talk:Tanavast": "Discussion of the Tanavast article.\n\n== Sources ==\nThe Ars Arcanum."}
+    titles = ["Talk:Tanavast", "Tanavast", "talk:tanavast"]
+    with StubWikiServer(pages) as server:
+        manager = SourceManager(wiki_endpoint=server.endpoint, scheme="http", request_interval=0)
+        fetched = list(manager.fetch_pages(titles))
+    names = [page.name for page in fetched]
+    assert names == ["Talk:Tanavast", "Tanavast", "Talk:Tanavast"], names
+    assert [page.requested_title for page in fetched] == titles, fetched
+    assert [page.page_title for page in fetched] == ["Tanavast"] * 3, fetched
+    assert manager.get_sections(fetched[0])[0]["metadata"]["parent_article"] == "Talk:Tanavast"
+    return {"check": "namespaces", "names": names}
+
+
+def check_sync() -> dict:
+    """
+    sync_pages keys results on the requested titles, also outside the main namespace and when normalized.
+    """
+    pages = {**load_fixture_pages(), "Talk:Tanavast": "Discussion of the Tanavast article.\n\n== Sources ==\nThe Ars Arcanum."}
+    with StubWikiServer(pages) as server:
+        server.wiki.revisions["Talk:Tanavast"] = 10
+        manager = SourceManager(wiki_endpoint=server.endpoint, scheme="http", request_interval=0)
+        manifest = {
+            title: {"title": title, "revision": 1, "hash": ""} for title in ["Talk:Tanavast", "talk:Tanavast", "Gone Talk"]
+        }
+        changed, deleted, entries = manager.sync_pages(["Talk:Tanavast", "talk:Tanavast"], manifest)
+    assert list(changed) == ["Talk:Tanavast", "talk:Tanavast"], changed
+    assert deleted == ["Gone Talk"], deleted
+    assert {title: entry["revision"] for title, entry in entries.items()} == {"Talk:Tanavast": 10, "talk:Tanavast": 10}
+    return {"check": "sync", "changed": list(changed), "deleted": deleted}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark batched wiki retrieval against a local stub wiki")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated seconds per request")
+    parser.add_argument("--repeat", type=int, default=5, help="times to repeat the fixture titles")
+    parser.add_argument("--max-workers", type=int, default=4)
+    args = parser.parse_args()
+
+    print(json.dumps(check_namespaces()))
+    print(json.dumps(check_sync()))
+    with StubWikiServer(latency=args.latency) as server:
+        titles = list(server.wiki.pages) * args.repeat
+        serial, serial_data = run(server, titles, batched=False, max_workers=1)
+        batched, batched_data = run(server, titles, batched=True, max_workers=args.max_workers)
+    batched["same_output"] = serial_data == batched_data
+    print(json.dumps(serial))
+    print(json.dumps(batched))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Count wiki requests and wikitext parses per article in SourceManager.get_sections
+import argparse
+import json
+import timeit
+from unittest import mock
+
+import mwparserfromhell as mwp
+
+from modules.SourceManager import SourceManager
+
+PAGE_TITLES = [
+    "Kaladin",
+    "Allomancy",
+    "Hoid",
+    "Cephandrius",
+    "Knights Radiant",
+]
+
+
+def count_calls(manager: SourceManager, title: str, single_fetch: bool) -> dict:
+    """
+    Runs get_sections on a fresh page object and counts the calls it makes.
+
+    Args:
+        manager (SourceManager): A SourceManager with an initialized site.
+        title (str): The title of the page to process.
+        single_fetch (bool): The get_sections mode to measure.
+
+    Returns:
+        dict: The number of HTTP calls, parse calls, sections and the elapsed seconds.
+    """
+    # A new page object so the mwclient text cache starts empty
+    page = manager.site.pages[title]
+    site_call = mock.patch.object(manager.site, "raw_call", wraps=manager.site.raw_call)
+    parse_call = mock.patch.object(mwp, "parse", wraps=mwp.parse)
+    with site_call as http, parse_call as parse:
+        start_time = timeit.default_timer()
+        sections = manager.get_sections(page, single_fetch=single_fetch)
+        elapsed = timeit.default_timer() - start_time
+    return {
+        "title": title,
+        "single_fetch": single_fetch,
+        "http_calls": http.call_count,
+        "parse_calls": parse.call_count,
+        "sections": len(sections),
+        "seconds": round(elapsed, 3),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Count wiki requests and parses per article in get_sections")
+    parser.add_argument("titles", nargs="*", default=PAGE_TITLES)
+    parser.add_argument("--endpoint", default="coppermind.net")
+    args = parser.parse_args()
+
+    manager = SourceManager(wiki_endpoint=args.endpoint)
+    manager._init_mwclient()
+    for title in args.titles:
+        legacy = count_calls(manager, title, single_fetch=False)
+        single = count_calls(manager, title, single_fetch=True)
+        print(json.dumps(legacy))
+        print(json.dumps(single))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Throughput and peak memory of SourceManager's JSONL readers and writers on a synthetic corpus
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import timeit
+from pathlib import Path
+
+from modules.SourceManager import SourceManager
+from modules.utils import batched
+
+FIXTURE_FILE = Path(__file__).parent.parent.parent / "tests" / "processed_articles.jsonl"
+
+
+def synthetic_articles(size_mb: int, seed: int = 0):
+    """
+    Yields processed articles shaped like the fixture until roughly `size_mb` of JSON has been produced.
+    """
+    rng = random.Random(seed)
+    with open(FIXTURE_FILE, "r") as file:
+        articles = [json.loads(line) for line in file]
+    articles = [article for article in articles if article["sections"]]
+    produced, limit, i = 0, size_mb * 1024 * 1024, 0
+    while produced < limit:
+        article = dict(rng.choice(articles))
+        article["title"] = f"{article['title']} {i}"
+        produced += len(json.dumps(article))
+        i += 1
+        yield article
+
+
+def _measure(mode: str, filename: str, batch_size: int, queue) -> None:
+    # Runs in a fresh process so ru_maxrss only covers this mode
+    manager = SourceManager()
+    start_time = timeit.default_timer()
+    entries = 0
+    if mode == "load_json":
+        entries = len(manager.load_json(filename))
+    else:
+        for batch in batched(manager.iter_json(filename), batch_size):
+            entries += len(batch)
+    elapsed = timeit.default_timer() - start_time
+    queue.put((entries, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def measure(mode: str, filename: str, batch_size: int) -> dict:
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(mode, filename, batch_size, queue))
+    process.start()
+    entries, elapsed, peak_mb = queue.get()
+    process.join()
+    size_mb = os.path.getsize(filename) / 1024 / 1024
+    return {
+        "mode": mode,
+        "file": Path(filename).name,
+        "file_mb": round(size_mb, 1),
+        "entries": entries,
+        "seconds": round(elapsed, 2),
+        "entries_per_second": round(entries / elapsed),
+        "peak_rss_mb": round(peak_mb, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark streaming and compressed JSONL I/O")
+    parser.add_argument("--size-mb", type=int, default=2048, help="uncompressed size of the synthetic corpus")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--suffixes", nargs="*", default=[".jsonl", ".jsonl.gz", ".jsonl.zst"])
+    parser.add_argument("--dir", default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    manager = SourceManager()
+    for suffix in args.suffixes:
+        filename = str(Path(args.dir) / f"synthetic_articles{suffix}")
+        start_time = timeit.default_timer()
+        manager.save_json(synthetic_articles(args.size_mb), filename)
+        elapsed = timeit.default_timer() - start_time
+        print(json.dumps({"mode": "save_json", "file": Path(filename).name, "seconds": round(elapsed, 2),
+                          "mb_per_second": round(args.size_mb / elapsed, 1)}))
+        for mode in ("iter_json", "load_json"):
+            print(json.dumps(measure(mode, filename, args.batch_size)))
+        os.remove(filename)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# Throughput and retrieval quality of offline (TF-IDF) and Gemini keyword extraction
+import argparse
+import json
+import random
+import re
+import tempfile
+import timeit
+from pathlib import Path
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from modules.KeywordExtractor import KeywordExtractor, StatisticalKeywordExtractor
+
+FIXTURE_FILE = Path(__file__).parent.parent.parent / "tests" / "processed_articles.jsonl"
+
+
+def load_paragraphs(filename: Path = FIXTURE_FILE) -> list[str]:
+    with open(filename, "r") as file:
+        articles = [json.loads(line) for line in file]
+    return [paragraph["content"] for article in articles if article["sections"] for paragraph in article["sections"]]
+
+
+def keyword_retrieval(paragraphs: list[str], keywords: list[str], k: int = 5, seed: int = 0) -> dict:
+    """
+    Scores how well the keywords alone find their paragraph.
+
+    Each paragraph is queried with one of its own sentences, ranked by TF-IDF
+    cosine similarity against every paragraph's keywords.
+
+    Returns:
+        dict: Recall@k and mean reciprocal rank of the source paragraph.
+    """
+    rng = random.Random(seed)
+    queries = []
+    for paragraph in paragraphs:
+        sentences = [s for s in re.split(r"(?<=[.!?])\s+", paragraph) if len(s.split()) > 3] or [paragraph]
+        queries.append(rng.choice(sentences))
+    vectorizer = TfidfVectorizer(stop_words="english").fit(keywords + queries)
+    scores = (vectorizer.transform(queries) @ vectorizer.transform(keywords).T).toarray()
+    # Rank of the source paragraph, ties count against it
+    ranks = (scores > scores.diagonal()[:, None]).sum(axis=1) + (scores == scores.diagonal()[:, None]).sum(axis=1)
+    return {"recall_at_k": round(float(np.mean(ranks <= k)), 3), "k": k, "mrr": round(float(np.mean(1 / ranks)), 3)}
+
+
+def run(name: str, extractor, paragraphs: list[str]) -> dict:
+    start_time = timeit.default_timer()
+    keywords = extractor.extract(paragraphs)
+    elapsed = timeit.default_timer() - start_time
+    return {
+        "extractor": name,
+        "paragraphs": len(paragraphs),
+        "seconds": round(elapsed, 2),
+        "paragraphs_per_second": round(len(paragraphs) / elapsed, 1),
+        "empty": sum(not keyword for keyword in keywords),
+        **keyword_retrieval(paragraphs, keywords),
+    }
+
+
+def check_small_calls() -> dict:
+    """
+    A single paragraph, and paragraphs unlike the fitted corpus, still get keywords.
+    """
+    single = StatisticalKeywordExtractor().extract(["Kaladin bonds Syl the honorspren."])
+    extractor = StatisticalKeywordExtractor().fit(load_paragraphs()[:50])
+    unseen = extractor.extract(["Zorblax quuxes the flimflam.", "Grimbly wozzle sprockets."])
+    assert all(single) and all(unseen), (single, unseen)
+    return {"check": "small_calls", "single": single, "unseen": unseen}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare offline and Gemini keyword extraction")
+    parser.add_argument("--llm", action="store_true", help="also run the Gemini extractor, needs config.yml")
+    parser.add_argument("--limit", type=int, default=None, help="only use the first paragraphs")
+    args = parser.parse_args()
+
+    print(json.dumps(check_small_calls()))
+    paragraphs = load_paragraphs()[:args.limit]
+    print(json.dumps(run("tfidf", StatisticalKeywordExtractor(), paragraphs)))
+    if args.llm:
+        from modules.VectorDBManager import VectorDBManager
+        manager = VectorDBManager(db_dir=Path(tempfile.mkdtemp()))
+        # A fresh cache, so every paragraph pays for its LLM call
+        extractor = KeywordExtractor(manager.call_prompt_in_rate, cache_file=Path(tempfile.mkdtemp()) / "keywords.sqlite")
+        print(json.dumps(run("gemini", extractor, paragraphs)))
+
+
+if __name__ == "__main__":
+    main()
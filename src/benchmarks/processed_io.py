@@ -0,0 +1,125 @@
+# Load time and peak memory of processed documents saved as str()/eval() text or streamed msgpack
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import tempfile
+import timeit
+from pathlib import Path
+
+from langchain_core.documents import Document
+
+from modules.CustomParentDocumentRetriever import CustomParentDocRetriever
+
+FIXTURE_DIR = Path(__file__).parent.parent.parent / "tests"
+
+
+class Sink:
+    """
+    Stands in for the vectorstore and the docstore, counting what load_processed hands over.
+    """
+    def __init__(self) -> None:
+        self.count = 0
+
+    def add_documents(self, documents) -> None:
+        self.count += len(documents)
+
+    def mset(self, key_value_pairs) -> None:
+        self.count += len(key_value_pairs)
+
+
+def retriever() -> CustomParentDocRetriever:
+    return CustomParentDocRetriever.model_construct(vectorstore=Sink(), docstore=Sink(), child_splitter=None)
+
+
+def load_fixture(name: str) -> list:
+    with open(FIXTURE_DIR / f"{name}.txt", "r", encoding="cp1252") as file:
+        return eval(file.read(), {"__builtins__": {}, "Document": Document})
+
+
+def synthetic_corpus(copies: int):
+    """
+    Yields the chunks and parents of the fixture `copies` times, with distinct parent ids.
+    """
+    docs, full_docs = load_fixture("semantic_docs"), load_fixture("semantic_full_docs")
+    for i in range(copies):
+        ids = {id: f"{id}-{i}" for id, _ in full_docs}
+        chunks = [Document(page_content=doc.page_content, metadata={**doc.metadata, "doc_id": ids.get(doc.metadata["doc_id"])})
+                  for doc in docs]
+        yield chunks, [(ids[id], doc) for id, doc in full_docs]
+
+
+def write(prefix: str, suffix: str, copies: int) -> None:
+    if suffix == ".txt":
+        # The format written by save_txt before, one str() of the whole list per file
+        docs, full_docs = [], []
+        for chunks, parents in synthetic_corpus(copies):
+            docs.extend(chunks)
+            full_docs.extend(parents)
+        for name, data in ((f"{prefix}_docs", docs), (f"{prefix}_full_docs", full_docs)):
+            with open(name + suffix, "w", encoding="utf-8") as file:
+                file.write(str(data))
+        return
+    corpus = list(synthetic_corpus(copies))
+    manager = retriever()
+    manager.save_records(((None, doc) for chunks, _ in corpus for doc in chunks), f"{prefix}_docs{suffix}")
+    manager.save_records((pair for _, parents in corpus for pair in parents), f"{prefix}_full_docs{suffix}")
+
+
+def _measure(prefix: str, suffix: str, batch_size: int, queue) -> None:
+    # Runs in a fresh process so ru_maxrss only covers this format
+    manager = retriever()
+    start_time = timeit.default_timer()
+    if suffix == ".txt":
+        for name, store in ((f"{prefix}_docs", manager.vectorstore), (f"{prefix}_full_docs", manager.docstore)):
+            with open(name + suffix, "r", encoding="utf-8") as file:
+                data = eval(file.read())
+            store.add_documents(data) if store is manager.vectorstore else store.mset(data)
+    else:
+        manager.load_processed(prefix, suffix=suffix, batch_size=batch_size)
+    elapsed = timeit.default_timer() - start_time
+    entries = manager.vectorstore.count + manager.docstore.count
+    queue.put((entries, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def measure(prefix: str, suffix: str, batch_size: int) -> dict:
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(prefix, suffix, batch_size, queue))
+    process.start()
+    entries, elapsed, peak_mb = queue.get()
+    process.join()
+    size_mb = sum(os.path.getsize(f"{prefix}_{name}{suffix}") for name in ("docs", "full_docs")) / 1024 / 1024
+    return {
+        "format": suffix,
+        "file_mb": round(size_mb, 1),
+        "entries": entries,
+        "seconds": round(elapsed, 2),
+        "entries_per_second": round(entries / elapsed),
+        "peak_rss_mb": round(peak_mb, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark loading processed documents per storage format")
+    parser.add_argument("--copies", type=int, default=200, help="times the fixture is replicated, ~3.3 MB each")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--suffixes", nargs="*", default=[".txt", ".msgpack", ".msgpack.zst"])
+    parser.add_argument("--dir", default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    prefix = str(Path(args.dir) / "synthetic")
+    context = multiprocessing.get_context("spawn")
+    for suffix in args.suffixes:
+        # Written in its own process too, ru_maxrss survives into the processes this one starts
+        writer = context.Process(target=write, args=(prefix, suffix, args.copies))
+        writer.start()
+        writer.join()
+        print(json.dumps(measure(prefix, suffix, args.batch_size)))
+        for name in ("docs", "full_docs"):
+            os.remove(f"{prefix}_{name}{suffix}")
+
+
+if __name__ == "__main__":
+    main()
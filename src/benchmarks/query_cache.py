@@ -0,0 +1,92 @@
+# Hit rate of QueryCache on reworded questions, and false hits on questions about a different entity
+import argparse
+import json
+import random
+
+import numpy as np
+
+from benchmarks.retrieval import load_sections
+from benchmarks.stubs import FakeEmbeddings
+from modules.QueryCache import QueryCache
+
+# The same question, worded differently
+PARAPHRASES = [
+    ("What is {article}'s {heading}?", "Tell me about the {heading} of {article}"),
+    ("Who is {article}?", "tell me about {article}"),
+    ("Describe {article}'s {heading}", "What is the {heading} of {article}?"),
+    ("What does the article on {article} say about {heading}?", "what does the {article} article say about {heading}"),
+]
+# The same wording, asked about another article or section
+SWAPS = [
+    "What is {article}'s {heading}?",
+    "What does the article on {article} say about {heading}?",
+    "Tell me about the {heading} of {article} in the Cosmere",
+]
+
+
+def pairs(count: int, seed: int = 0) -> tuple[list, list]:
+    """
+    `count` paraphrase pairs and `count` entity-swap pairs, from the fixture articles and section headings.
+    """
+    rng = random.Random(seed)
+    sections = sorted({
+        (doc.metadata["parent_article"], doc.metadata["heading"]) for doc in load_sections()
+        if doc.metadata["heading"] != doc.metadata["parent_article"]
+    })
+    paraphrases, swaps = [], []
+    for _ in range(count):
+        article, heading = rng.choice(sections)
+        first, second = rng.choice(PARAPHRASES)
+        paraphrases.append((first.format(article=article, heading=heading), second.format(article=article, heading=heading)))
+        template = rng.choice(SWAPS)
+        other_article, other_heading = rng.choice([s for s in sections if s[0] != article or s[1] != heading])
+        # Swap the article, the heading, or both
+        other = rng.choice([(other_article, heading), (article, other_heading), (other_article, other_heading)])
+        if other == (article, heading):
+            other = (other_article, other_heading)
+        swaps.append((template.format(article=article, heading=heading), template.format(article=other[0], heading=other[1])))
+    return paraphrases, swaps
+
+
+def hit_rate(cache_options: dict, embeddings: FakeEmbeddings, question_pairs: list) -> float:
+    # Every pair in a fresh cache: the first question is answered and cached, the second looked up
+    hits = 0
+    for first, second in question_pairs:
+        cache = QueryCache(embeddings.embed_query, **cache_options)
+        cache.put(first, [], first)
+        hits += cache.get(second) is not None
+    return hits / len(question_pairs)
+
+
+def similarity_rate(embeddings: FakeEmbeddings, question_pairs: list, threshold: float) -> float:
+    # The near-duplicate level on embedding similarity alone, without the key term check
+    firsts, seconds = (np.array(embeddings.embed_documents(list(questions))) for questions in zip(*question_pairs))
+    return float(np.mean(np.sum(firsts * seconds, axis=1) >= threshold))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure QueryCache hits on paraphrases and false hits on entity swaps")
+    parser.add_argument("--pairs", type=int, default=500, help="pairs of each kind")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.9, 0.95])
+    args = parser.parse_args()
+
+    embeddings = FakeEmbeddings()
+    paraphrases, swaps = pairs(args.pairs)
+    configs = [("exact_only", None, {})]
+    for threshold in args.thresholds:
+        configs += [(f"similarity_only_{threshold}", threshold, None), (f"key_terms_{threshold}", threshold, {"threshold": threshold})]
+    for name, threshold, options in configs:
+        if options is None:
+            rates = [similarity_rate(embeddings, question_pairs, threshold) for question_pairs in (paraphrases, swaps)]
+        else:
+            rates = [hit_rate(options, embeddings, question_pairs) for question_pairs in (paraphrases, swaps)]
+        print(json.dumps({
+            "config": name,
+            "pairs": args.pairs,
+            "paraphrase_hit_rate": round(rates[0], 3),
+            "entity_swap_false_hit_rate": round(rates[1], 3),
+        }))
+
+
+if __name__ == "__main__":
+    main()
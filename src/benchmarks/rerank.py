@@ -0,0 +1,117 @@
+# Latency and ranking changes of the adaptive reranking options, against reranking every candidate
+import argparse
+import asyncio
+import json
+import tempfile
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.retrieval import entity_queries, load_sections
+from benchmarks.stats import percentiles
+from benchmarks.stubs import FakeEmbeddings, FakeLLM, FakeRanker, offline_pipeline
+from modules.Reranker import BatchedFlashrankRerank
+
+
+def rerank_all(reranker, candidates, queries, concurrency: int) -> tuple[list, list[float]]:
+    # Every query on its own, from `concurrency` threads like concurrent perform_rag calls
+    def timed(i: int):
+        start_time = timeit.default_timer()
+        docs = reranker.compress_documents(candidates[i], queries[i])
+        return docs, timeit.default_timer() - start_time
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, range(len(queries))))
+    return [docs for docs, _ in results], [seconds for _, seconds in results]
+
+
+def check_async(pipeline, queries: list[str]) -> dict:
+    """
+    The async retriever returns the vector distances of the sync one, so skip_margin applies to
+    ainvoke, and astream_rag, exactly as to invoke.
+    """
+    async def ainvoke_all(retriever):
+        return [await retriever.ainvoke(query) for query in queries]
+
+    candidates = asyncio.run(ainvoke_all(pipeline.retriever))
+    expected = [pipeline.retriever.invoke(query) for query in queries]
+    assert candidates == expected
+    assert all(doc.metadata.get("vector_distance") is not None for docs in candidates for doc in docs)
+    skipped = sum(pipeline.compressor._clear_lead(docs) for docs in candidates)
+    assert skipped, "no query has a clear lead, the margin is never applied"
+
+    pipeline.compressor.clear_scores()
+    runs = pipeline.compressor.client.runs
+    reranked = asyncio.run(ainvoke_all(pipeline.rerank_retriever))
+    async_runs = pipeline.compressor.client.runs - runs
+    pipeline.compressor.clear_scores()
+    runs = pipeline.compressor.client.runs
+    assert reranked == [pipeline.rerank_retriever.invoke(query) for query in queries]
+    assert async_runs == pipeline.compressor.client.runs - runs
+    return {"check": "async", "queries": len(queries), "skipped": skipped, "rerank_runs": async_runs}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure candidate caps, margin skips, shared runs and the score cache")
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--top-n", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8])
+    parser.add_argument("--max-candidates", type=int, default=6)
+    parser.add_argument("--skip-margin", type=float, nargs="+", default=[0.1, 0.2])
+    parser.add_argument("--rerank-latency", type=float, default=0.005, help="simulated seconds per reranker run")
+    parser.add_argument("--rerank-per-pair", type=float, default=0.0005, help="simulated seconds per reranked pair")
+    args = parser.parse_args()
+
+    documents = load_sections()
+    queries = entity_queries(documents, args.queries)
+    ranker = FakeRanker(latency=args.rerank_latency, per_pair=args.rerank_per_pair)
+    pipeline = offline_pipeline(Path(tempfile.mkdtemp()), FakeEmbeddings(), ranker, FakeLLM(), k=args.k)
+    pipeline.retriever.add_documents(documents, save=False)
+    candidates = [pipeline.retriever.invoke(query) for _, query in queries]
+    texts = [query for _, query in queries]
+    print(json.dumps(check_async(pipeline, texts[:50])))
+
+    # The score cache is off, so every query is scored like a first one
+    configs = [("full", {"share_runs": False}), ("shared_runs", {}), ("cap", {"max_candidates": args.max_candidates})]
+    configs += [(f"skip_{margin}", {"skip_margin": margin}) for margin in args.skip_margin]
+    configs += [(f"cap_skip_{margin}", {"max_candidates": args.max_candidates, "skip_margin": margin})
+                for margin in args.skip_margin]
+    baseline = None
+    for concurrency in args.concurrency:
+        for name, options in configs:
+            reranker = BatchedFlashrankRerank.model_construct(client=ranker, top_n=args.top_n, score_cache_size=0, **options)
+            runs = ranker.runs
+            results, samples = rerank_all(reranker, candidates, texts, concurrency)
+            if baseline is None:
+                baseline = results
+            # How far the answer context moves from reranking every candidate, and how often it holds the section asked about
+            overlap = np.mean([
+                len({d.page_content for d in a} & {d.page_content for d in b}) / max(len(b), 1)
+                for a, b in zip(results, baseline)
+            ])
+            same_top = np.mean([bool(a) and bool(b) and a[0].page_content == b[0].page_content for a, b in zip(results, baseline)])
+            hits = np.mean([any(d.page_content == documents[i].page_content for d in docs) for (i, _), docs in zip(queries, results)])
+            print(json.dumps({
+                "config": name,
+                "concurrency": concurrency,
+                "queries": len(texts),
+                "rerank_runs": ranker.runs - runs,
+                **percentiles(samples),
+                "overlap_with_full": round(float(overlap), 3),
+                "same_top_as_full": round(float(same_top), 3),
+                "hit_rate": round(float(hits), 3),
+            }))
+
+    # Repeated queries, e.g. retries or popular questions, only pay for pairs not scored before
+    reranker = BatchedFlashrankRerank.model_construct(client=ranker, top_n=args.top_n)
+    for repeat in range(2):
+        runs = ranker.runs
+        _, samples = rerank_all(reranker, candidates, texts, 1)
+        print(json.dumps({"config": "score_cache", "pass": repeat, "rerank_runs": ranker.runs - runs, **percentiles(samples)}))
+
+
+if __name__ == "__main__":
+    main()
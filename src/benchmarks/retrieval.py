@@ -0,0 +1,92 @@
+# Latency and hit rate of the lexical (BM25), vector and hybrid retrieval paths
+import argparse
+import json
+import random
+import tempfile
+import timeit
+from pathlib import Path
+
+import chromadb
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+
+from benchmarks.stats import percentiles
+from benchmarks.stubs import FIXTURE_FILE, FakeEmbeddings
+from modules.BatchedSemanticChunker import BatchedSemanticChunker
+from modules.BM25Index import BM25Index
+from modules.CustomParentDocumentRetriever import CustomParentDocRetriever
+from modules.DocStore import SQLiteDocStore
+
+
+def load_sections() -> list[Document]:
+    # Shaped like SourceManager.get_sections output
+    with open(FIXTURE_FILE, "r") as file:
+        articles = [json.loads(line) for line in file]
+    return [
+        Document(
+            page_content=f"{article['title']} - {section['content']}",
+            metadata={"heading": section["title"], "order": section["order"], "parent_article": article["title"]},
+        )
+        for article in articles if article["sections"] for section in article["sections"]
+    ]
+
+
+def entity_queries(documents: list[Document], count: int, seed: int = 0) -> list[tuple[int, str]]:
+    """
+    Queries like "Kaladin's Spren" built from an article title and one of its section headings.
+    """
+    rng = random.Random(seed)
+    candidates = [
+        i for i, doc in enumerate(documents)
+        if doc.metadata["heading"] != doc.metadata["parent_article"]
+    ]
+    return [
+        (i, f"{documents[i].metadata['parent_article']}'s {documents[i].metadata['heading']}")
+        for i in rng.sample(candidates, min(count, len(candidates)))
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare BM25, vector and hybrid retrieval latency")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per query embedding call")
+    args = parser.parse_args()
+
+    directory = Path(tempfile.mkdtemp())
+    documents = load_sections()
+    embeddings = FakeEmbeddings()
+    retriever = CustomParentDocRetriever(
+        vectorstore=Chroma(collection_name="retrieval", embedding_function=embeddings, client=chromadb.EphemeralClient()),
+        docstore=SQLiteDocStore(directory / "docstore.sqlite"),
+        child_splitter=BatchedSemanticChunker(embeddings),
+        lexical_index=BM25Index(directory / "bm25.sqlite"),
+        search_kwargs={"k": args.k},
+    )
+    start_time = timeit.default_timer()
+    parent_ids = retriever.add_documents(documents, save=False)
+    print(json.dumps({"stage": "ingest", "documents": len(documents),
+                      "seconds": round(timeit.default_timer() - start_time, 2), **retriever.lexical_index.stats()}))
+
+    queries = entity_queries(documents, args.queries)
+    embeddings.latency = args.latency
+    for mode in ("lexical", "vector", "hybrid"):
+        retriever.retrieval_mode = mode
+        calls = embeddings.calls
+        samples, hits = [], 0
+        for i, query in queries:
+            start_time = timeit.default_timer()
+            found = retriever.invoke(query)
+            samples.append(timeit.default_timer() - start_time)
+            hits += any(doc.page_content == documents[i].page_content for doc in found)
+        print(json.dumps({
+            "mode": mode,
+            "queries": len(queries),
+            "embedding_calls": embeddings.calls - calls,
+            **percentiles(samples),
+            "hit_rate": round(hits / len(queries), 3),
+        }))
+
+
+if __name__ == "__main__":
+    main()
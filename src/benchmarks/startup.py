@@ -0,0 +1,57 @@
+# Time to import Pipeline and construct a RAGPipeline, in fresh interpreters
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+# Runs in the child, so nothing is imported yet
+PROBE = """
+import json, timeit
+start_time = timeit.default_timer()
+from Pipeline import RAGPipeline
+imported = timeit.default_timer()
+pipeline = RAGPipeline()
+constructed = timeit.default_timer()
+if {warm_up}:
+    pipeline.warm_up()
+print(json.dumps({{
+    "import_seconds": round(imported - start_time, 3),
+    "construct_seconds": round(constructed - imported, 3),
+    "warm_up_seconds": round(timeit.default_timer() - constructed, 3) if {warm_up} else None,
+    "report": pipeline.startup_report(),
+}}))
+"""
+
+
+def check_lazy() -> dict:
+    """
+    The configuration is loaded once and shared, and the keyword cache is not opened until keywords are extracted.
+    """
+    from Pipeline import RAGPipeline
+
+    pipeline = RAGPipeline()
+    extractor = pipeline.source_manager.keyword_extractor
+    assert pipeline.vector_manager.config is pipeline.config
+    assert extractor is pipeline.vector_manager.keyword_extractor
+    assert "db" not in extractor.__dict__, "the keyword cache was opened"
+    return {"check": "lazy", "keyword_extractor": type(extractor).__name__, "keyword_cache_opened": False}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure RAGPipeline startup time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warm-up", action="store_true", help="also build every component, needs the models")
+    args = parser.parse_args()
+
+    print(json.dumps(check_lazy()))
+    for run in range(args.runs):
+        result = subprocess.run(
+            [sys.executable, "-W", "ignore", "-c", PROBE.format(warm_up=args.warm_up)],
+            cwd=Path(__file__).parent.parent, capture_output=True, text=True, check=True,
+        )
+        print(json.dumps({"run": run, **json.loads(result.stdout.strip().splitlines()[-1])}))
+
+
+if __name__ == "__main__":
+    main()
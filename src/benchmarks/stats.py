@@ -0,0 +1,18 @@
+# Latency summaries shared by the benchmarks
+import numpy as np
+
+
+def percentiles(samples: list[float]) -> dict:
+    """
+    The count, mean and p50/p95/p99 of latency samples in seconds, in milliseconds.
+    """
+    if not samples:
+        return {"count": 0}
+    p50, p95, p99 = np.percentile(np.array(samples) * 1000, [50, 95, 99])
+    return {
+        "count": len(samples),
+        "mean_ms": round(float(np.mean(samples)) * 1000, 3),
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(p95, 3),
+        "p99_ms": round(p99, 3),
+    }
@@ -0,0 +1,370 @@
+# Local stand-ins for the external services used by the pipeline
+import json
+import logging
+import re
+import time
+from hashlib import blake2b
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock, Thread
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import mwparserfromhell as mwp
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.llms import LLM
+
+FIXTURE_FILE = Path(__file__).parent.parent.parent / "tests" / "processed_articles.jsonl"
+
+# Redirect pages in the fixture have no sections, only their target
+REDIRECTS = {
+    "Cephandrius": "Hoid",
+    "Surgebinder": "Surgebinding",
+    "Shadesmar": "Rosharan subastral",
+}
+
+
+def load_fixture_pages(filename: Path = FIXTURE_FILE) -> dict:
+    """
+    Rebuilds wikitext for every article in a processed articles file.
+
+    Args:
+        filename (Path): The JSONLines file with title, links and sections per article.
+
+    Returns:
+        dict: The wikitext of every article, keyed by title.
+    """
+    pages = {}
+    with open(filename, "r") as file:
+        for line in file:
+            article = json.loads(line)
+            title = article["title"]
+            if article["sections"] is None:
+                target = REDIRECTS.get(title) or (article["links"] or [title])[0]
+                pages[title] = f"#REDIRECT [[{target}]]"
+                continue
+            heading = title
+            lines = []
+            for section in article["sections"]:
+                if section["title"] and section["title"] != heading:
+                    heading = section["title"]
+                    lines.append(f"== {heading} ==")
+                lines.append(section["content"])
+            lines.append("== Notes ==")
+            pages[title] = "\n\n".join(lines)
+    return pages
+
+
+class StubWiki:
+    """
+    Answers the subset of the MediaWiki query API that mwclient and SourceManager use.
+    """
+    NAMESPACES = {"Talk": 1, "Category": 14}
+
+    def __init__(self, pages: dict) -> None:
+        self.pages = pages
+        self.page_ids = {title: i for i, title in enumerate(pages, 1)}
+        # Revision ids that differ from the page id, set to simulate edits
+        self.revisions = {}
+
+    @classmethod
+    def normalize(cls, title: str) -> str:
+        title = title.replace("_", " ").strip()
+        prefix, _, rest = title.partition(":")
+        namespace = prefix.strip().capitalize()
+        if rest and namespace in cls.NAMESPACES:
+            rest = rest.strip()
+            return f"{namespace}:{rest[:1].upper()}{rest[1:]}"
+        return title[:1].upper() + title[1:]
+
+    @classmethod
+    def namespace(cls, title: str) -> int:
+        prefix, _, rest = title.partition(":")
+        return cls.NAMESPACES.get(prefix, 0) if rest else 0
+
+    def redirect_target(self, title: str):
+        text = self.pages.get(title, "")
+        if not text.upper().startswith("#REDIRECT"):
+            return None
+        return self.normalize(str(mwp.parse(text).filter_wikilinks()[0].title))
+
+    def query(self, params: dict) -> dict:
+        if "siteinfo" in params.get("meta", ""):
+            return {"query": {
+                "general": {"generator": "MediaWiki 1.39.0", "sitename": "Stub Wiki"},
+                "namespaces": {"0": {"id": 0, "*": ""}, **{
+                    str(id): {"id": id, "*": name} for name, id in self.NAMESPACES.items()
+                }},
+                "userinfo": {"id": 0, "name": "127.0.0.1", "groups": ["*"], "rights": ["read"]},
+            }}
+
+        query = {"normalized": [], "redirects": [], "pages": {}}
+        props = params.get("prop", "").split("|")
+        titles = params.get("titles", "").split("|")
+        for title in titles:
+            name = self.normalize(title)
+            if name != title:
+                query["normalized"].append({"from": title, "to": name})
+            target = self.redirect_target(name)
+            if "redirects" in params and target is not None:
+                query["redirects"].append({"from": name, "to": target})
+                name = target
+
+            if name not in self.pages:
+                query["pages"][str(-len(query["pages"]) - 1)] = {"ns": self.namespace(name), "title": name, "missing": ""}
+                continue
+            page_id = self.page_ids[name]
+            text = self.pages[name]
+            revision = self.revisions.get(name, page_id)
+            info = {"pageid": page_id, "ns": self.namespace(name), "title": name, "lastrevid": revision, "length": len(text)}
+            if self.redirect_target(name) is not None:
+                info["redirect"] = ""
+            if "revisions" in props:
+                if "rvsection" in params:
+                    text = str(mwp.parse(text).get_sections()[int(params["rvsection"])])
+                info["revisions"] = [{
+                    "revid": revision,
+                    "timestamp": "2024-01-01T00:00:00Z",
+                    "slots": {"main": {"contentmodel": "wikitext", "*": text}},
+                }]
+            query["pages"][str(page_id)] = info
+
+        for key in ("normalized", "redirects"):
+            if not query[key]:
+                del query[key]
+        return {"batchcomplete": "", "query": query}
+
+
+class StubWikiHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        self._respond(parse_qs(urlparse(self.path).query, keep_blank_values=True))
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        self._respond(parse_qs(self.rfile.read(length).decode(), keep_blank_values=True))
+
+    def _respond(self, params: dict) -> None:
+        self.server.count_request()
+        time.sleep(self.server.latency)
+        params = {key: values[0] for key, values in params.items()}
+        body = json.dumps(self.server.wiki.query(params)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class StubWikiServer(ThreadingHTTPServer):
+    """
+    A local MediaWiki API at http://<endpoint>/w/api.php, serving fixed pages with simulated latency.
+
+    Use with SourceManager(wiki_endpoint=server.endpoint, scheme="http").
+    """
+    daemon_threads = True
+
+    def __init__(self, pages: dict = None, latency: float = 0.0) -> None:
+        super().__init__(("127.0.0.1", 0), StubWikiHandler)
+        self.wiki = StubWiki(pages if pages is not None else load_fixture_pages())
+        self.latency = latency
+        self.requests = 0
+        self._lock = Lock()
+
+    @property
+    def endpoint(self) -> str:
+        return f"{self.server_address[0]}:{self.server_address[1]}"
+
+    def count_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def __enter__(self):
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic bag-of-words embeddings, so texts sharing words are similar.
+
+    Every call sleeps `latency` seconds plus `per_text` seconds per text, like a model
+    with fixed call overhead. `calls` and `texts` count what was embedded.
+    """
+    def __init__(self, dim: int = 384, latency: float = 0.0, per_text: float = 0.0) -> None:
+        self.dim = dim
+        self.latency = latency
+        self.per_text = per_text
+        self.model = f"fake-{dim}"
+        self.calls = 0
+        self.texts = 0
+        self._lock = Lock()
+
+    def _embed(self, text: str) -> list[float]:
+        vector = np.zeros(self.dim)
+        for word in re.findall(r"\w+", text.lower()):
+            digest = int.from_bytes(blake2b(word.encode(), digest_size=8).digest(), "little")
+            vector[digest % self.dim] += 1.0 if digest >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        with self._lock:
+            self.calls += 1
+            self.texts += len(texts)
+        time.sleep(self.latency + self.per_text * len(texts))
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+class FakeLLM(LLM):
+    """
+    Answers every prompt after `latency` seconds, like a remote model bound by network time.
+    """
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs) -> str:
+        time.sleep(self.latency)
+        match = re.search(r"answering this question: (.*)", prompt)
+        return f"An answer to {match.group(1).strip() if match else 'the question'}"
+
+
+class FakeRanker:
+    """
+    Stands in for flashrank.Ranker, so FlashrankRerank runs without downloading a model.
+
+    Its tokenizer hashes words to ids and pads pairs to the longest, and its session scores
+    the share of passage tokens found in the query. Every session run sleeps `latency`
+    seconds plus `per_pair` seconds per pair, like a cross-encoder with fixed call overhead.
+    Tokenizing and runs take turns, like a model that keeps every core busy.
+    """
+    llm_model = None
+
+    def __init__(self, latency: float = 0.0, per_pair: float = 0.0, max_length: int = 128) -> None:
+        self.latency = latency
+        self.per_pair = per_pair
+        self.max_length = max_length
+        self.tokenizer = self
+        self.session = self
+        self.runs = 0
+        self.pairs = 0
+        self.logger = logging.getLogger(__name__)
+        self._lock = Lock()
+
+    def _ids(self, text: str) -> list[int]:
+        # Words past max_length would be cut anyway
+        return [int.from_bytes(blake2b(word.encode(), digest_size=4).digest(), "little") % 30000 + 1
+                for word in re.findall(r"\w+", text.lower())[:self.max_length]]
+
+    def encode_batch(self, pairs: list[list[str]]) -> list[SimpleNamespace]:
+        encoded = []
+        with self._lock:
+            for query, passage in pairs:
+                query_ids = self._ids(query)
+                ids = (query_ids + self._ids(passage))[:self.max_length]
+                type_ids = [0] * min(len(query_ids), len(ids)) + [1] * max(len(ids) - len(query_ids), 0)
+                encoded.append((ids, type_ids))
+        length = max((len(ids) for ids, _ in encoded), default=0)
+        return [
+            SimpleNamespace(
+                ids=ids + [0] * (length - len(ids)),
+                type_ids=type_ids + [0] * (length - len(ids)),
+                attention_mask=[1] * len(ids) + [0] * (length - len(ids)),
+            )
+            for ids, type_ids in encoded
+        ]
+
+    def run(self, output_names, inputs: dict) -> list[np.ndarray]:
+        ids, mask = inputs["input_ids"], inputs["attention_mask"]
+        type_ids = inputs.get("token_type_ids", np.zeros_like(ids))
+        logits = []
+        with self._lock:
+            self.runs += 1
+            self.pairs += len(ids)
+            time.sleep(self.latency + self.per_pair * len(ids))
+            for row, row_mask, row_types in zip(ids, mask, type_ids):
+                query = set(row[(row_types == 0) & (row_mask == 1)].tolist())
+                passage = row[(row_types == 1) & (row_mask == 1)]
+                logits.append([8 * np.isin(passage, list(query)).mean() - 4 if len(passage) else -4.0])
+        return [np.array(logits, dtype=np.float32)]
+
+
+def offline_pipeline(
+    directory: Path,
+    embeddings: Embeddings,
+    ranker: FakeRanker,
+    llm: LLM,
+    k: int = 4,
+    retrieval_mode: str = "vector",
+    cache_queries: bool = False,
+    semantic_cache_threshold: float = None,
+):
+    """
+    A RAGPipeline over an in-memory Chroma and SQLite files in `directory`, with the given stand-ins.
+
+    Every lazy component is set up front, so nothing loads a model, reads config.yml or
+    opens a connection to an external service.
+    """
+    import chromadb
+    from langchain.retrievers import ContextualCompressionRetriever
+    from langchain_chroma import Chroma
+
+    from modules.BatchedSemanticChunker import BatchedSemanticChunker
+    from modules.BM25Index import BM25Index
+    from modules.ContextPacker import ContextPacker
+    from modules.CustomParentDocumentRetriever import CustomParentDocRetriever
+    from modules.DocStore import SQLiteDocStore
+    from modules.EmbeddingCache import CachedEmbeddings, EmbeddingCache
+    from modules.QueryCache import QueryCache
+    from modules.Reranker import BatchedFlashrankRerank
+    from Pipeline import RAGPipeline
+
+    directory = Path(directory)
+    cached = CachedEmbeddings(embeddings, EmbeddingCache(directory / "embedding_cache"))
+    vectorstore = Chroma(collection_name="offline", embedding_function=cached, client=chromadb.EphemeralClient())
+
+    pipeline = object.__new__(RAGPipeline)
+    pipeline.__dict__.update(
+        docstore_path=directory / "docstore.sqlite",
+        read_only=False,
+        chunk_workers=1,
+        embed_once=False,
+        bm25_path=directory / "bm25.sqlite",
+        retrieval_mode=retrieval_mode,
+        cache_queries=cache_queries,
+        context_packer=ContextPacker(),
+        vector_backend="chroma",
+    )
+    pipeline.vector_manager = SimpleNamespace(langdb=vectorstore, embedding_cache=cached.cache)
+    pipeline.splitter = BatchedSemanticChunker(cached)
+    pipeline.docstore = SQLiteDocStore(pipeline.docstore_path)
+    pipeline.lexical_index = BM25Index(pipeline.bm25_path)
+    pipeline.retriever = CustomParentDocRetriever(
+        vectorstore=vectorstore,
+        docstore=pipeline.docstore,
+        child_splitter=pipeline.splitter,
+        lexical_index=pipeline.lexical_index,
+        retrieval_mode=retrieval_mode,
+        search_kwargs={"k": k},
+    )
+    pipeline.query_cache = QueryCache(
+        cached.embed_query, version=pipeline.docstore.version, threshold=semantic_cache_threshold
+    ) if cache_queries else None
+    # Skips the check that the client is a flashrank Ranker
+    pipeline.compressor = BatchedFlashrankRerank.model_construct(client=ranker, top_n=3, max_candidates=20, skip_margin=0.2)
+    pipeline.rerank_retriever = ContextualCompressionRetriever(base_compressor=pipeline.compressor, base_retriever=pipeline.retriever)
+    pipeline.llm = llm
+    return pipeline
@@ -0,0 +1,198 @@
+# Offline benchmark suite: fetch, ingest and query the pipeline against local stand-ins
+import argparse
+import contextlib
+import io
+import json
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.retrieval import entity_queries
+from benchmarks.stats import percentiles
+from benchmarks.stubs import FakeEmbeddings, FakeLLM, FakeRanker, StubWikiServer, offline_pipeline
+from modules.EmbeddingCache import CachedEmbeddings, EmbeddingCache
+from modules.Metrics import METRICS
+from modules.SourceManager import SourceManager
+
+SUITE_VERSION = 2
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+@contextlib.contextmanager
+def phase(results: dict, name: str, trace: bool):
+    """
+    Records the stage spans and counters of a phase, the peak RSS of the process after it and,
+    with `trace`, the peak of Python allocations during it.
+    """
+    if trace:
+        tracemalloc.start()
+    METRICS.reset()
+    record = results.setdefault(name, {})
+    try:
+        yield record
+    finally:
+        if trace:
+            record["tracemalloc_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+            tracemalloc.stop()
+        record["peak_rss_mb"] = peak_rss_mb()
+        record.update(METRICS.to_json())
+
+
+def cold_query_embeddings(pipeline, embeddings) -> None:
+    # Queries are embedded again rather than read from the cache filled by a previous pass
+    pipeline.retriever.vectorstore._embedding_function = CachedEmbeddings(embeddings, EmbeddingCache(tempfile.mkdtemp()))
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=Path(__file__).parent
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def run_suite(args) -> dict:
+    results = {}
+    directory = Path(tempfile.mkdtemp())
+    embeddings = FakeEmbeddings(latency=args.embed_latency, per_text=args.embed_per_text)
+    ranker = FakeRanker(latency=args.rerank_latency, per_pair=args.rerank_per_pair)
+    llm = FakeLLM(latency=args.llm_latency)
+    pipeline = offline_pipeline(
+        directory, embeddings, ranker, llm, k=args.k, retrieval_mode=args.retrieval_mode, cache_queries=args.cache
+    )
+
+    # Every phase records its stages from the spans of the instrumented code
+    METRICS.enable()
+    with phase(results, "fetch", args.tracemalloc) as record, StubWikiServer(latency=args.wiki_latency) as server:
+        titles = list(server.wiki.pages) * args.repeat
+        manager = SourceManager(wiki_endpoint=server.endpoint, scheme="http", request_interval=0)
+        start_time = timeit.default_timer()
+        # SourceManager prints every page it processes
+        with contextlib.redirect_stdout(io.StringIO()):
+            sections = manager.prep_data_vector(titles)
+        elapsed = timeit.default_timer() - start_time
+        record.update({
+            "pages": len(titles),
+            "sections": len(sections),
+            "requests": server.requests,
+            "seconds": round(elapsed, 3),
+            "pages_per_second": round(len(titles) / elapsed, 1),
+        })
+
+    with phase(results, "ingest", args.tracemalloc) as record:
+        documents = manager.to_documents(sections)
+        calls, texts = embeddings.calls, embeddings.texts
+        start_time = timeit.default_timer()
+        pipeline.retriever.add_documents(documents, save=False)
+        elapsed = timeit.default_timer() - start_time
+        chunks = pipeline.retriever.vectorstore._collection.count()
+        record.update({
+            "pages": len(titles),
+            "sections": len(documents),
+            "chunks": chunks,
+            "embedding_calls": embeddings.calls - calls,
+            "embedded_texts": embeddings.texts - texts,
+            "seconds": round(elapsed, 3),
+            "pages_per_second": round(len(titles) / elapsed, 1),
+            "sections_per_second": round(len(documents) / elapsed, 1),
+            "chunks_per_second": round(chunks / elapsed, 1),
+        })
+
+    queries = [query for _, query in entity_queries(documents, args.queries, seed=args.seed)]
+    with phase(results, "query", args.tracemalloc) as record:
+        # perform_rag prints every answer
+        samples = []
+        cold_query_embeddings(pipeline, embeddings)
+        with contextlib.redirect_stdout(io.StringIO()):
+            for query in queries:
+                start_time = timeit.default_timer()
+                pipeline.perform_rag(query)
+                samples.append(timeit.default_timer() - start_time)
+        record.update({
+            "queries": len(queries),
+            "retrieval_mode": args.retrieval_mode,
+            "latency": percentiles(samples),
+        })
+    return results
+
+
+def flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(results: dict, baseline: dict) -> dict:
+    """
+    The ratio of every numeric result to the same result of a baseline run.
+    """
+    current, previous = flatten(results), flatten(baseline)
+    return {key: round(value / previous[key], 3) for key, value in current.items() if previous.get(key)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark ingestion, query latency and memory with no network")
+    parser.add_argument("--output", type=Path, help="write the results as JSON, otherwise print them")
+    parser.add_argument("--compare", type=Path, help="a previous --output file to compare against")
+    parser.add_argument("--repeat", type=int, default=1, help="times to repeat the fixture pages")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--retrieval-mode", choices=("vector", "lexical", "hybrid"), default="vector")
+    parser.add_argument("--cache", action="store_true", help="enable the query cache")
+    parser.add_argument("--tracemalloc", action="store_true", help="trace Python allocations, slows every phase down")
+    parser.add_argument("--wiki-latency", type=float, default=0.0, help="simulated seconds per wiki request")
+    parser.add_argument("--embed-latency", type=float, default=0.005, help="simulated seconds per embedding call")
+    parser.add_argument("--embed-per-text", type=float, default=0.0, help="simulated seconds per embedded text")
+    parser.add_argument("--rerank-latency", type=float, default=0.002, help="simulated seconds per reranker run")
+    parser.add_argument("--rerank-per-pair", type=float, default=0.0002, help="simulated seconds per reranked pair")
+    parser.add_argument("--llm-latency", type=float, default=0.02, help="simulated seconds per LLM call")
+    args = parser.parse_args()
+
+    report = {
+        "suite": "offline",
+        "version": SUITE_VERSION,
+        "environment": environment(),
+        "config": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()
+                   if key not in ("output", "compare")},
+        "results": run_suite(args),
+    }
+    if args.compare:
+        with open(args.compare, "r") as file:
+            baseline = json.load(file)
+        if baseline.get("config") != report["config"]:
+            print("Warning: the baseline ran with a different config", file=sys.stderr)
+        report["compared_to"] = {"commit": baseline["environment"].get("commit"),
+                                 "ratios": compare(report["results"], baseline["results"])}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+# Article-level data (links, redirects, revision) stored once per article, next to the paragraph chunks
+import sqlite3
+from hashlib import blake2b
+from pathlib import Path
+from threading import Lock
+from typing import Iterable, Optional, Sequence
+
+import numpy as np
+
+from modules.utils import json_dumps, json_loads
+
+ARTICLES_FILE = Path(__file__).parent.parent / "articles.sqlite"
+
+
+def article_id(title: str) -> int:
+    """
+    A stable integer ID for an article, derived from its title.
+
+    56 bits of a hash, so it fits the integer metadata of Chroma and SQLite and is the
+    same in every process without a lookup.
+
+    Args:
+        title (str): The title of the article.
+
+    Returns:
+        int: The article ID.
+    """
+    return int.from_bytes(blake2b(title.encode("utf-8"), digest_size=7).digest(), "big")
+
+
+class ArticleStore:
+    """
+    Stores the links, redirects and revision of every article once, keyed by article ID.
+
+    Paragraph chunks only carry the `article_id` of their article instead of a copy of its
+    data. Reads come from an in-memory dict loaded on first use, and reloaded when another
+    connection has written since. Opened with `read_only=True`, any number of worker
+    processes can share one file while a single writer updates it.
+    """
+    def __init__(self, path: Path = ARTICLES_FILE, read_only: bool = False) -> None:
+        """
+        Constructor for ArticleStore class.
+
+        Args:
+            path (Path): Path to the SQLite file.
+            read_only (bool, optional): Open the file read only, e.g. in query workers. Defaults to False.
+
+        Returns:
+            None
+        """
+        self.path = Path(path)
+        self.read_only = read_only
+        self._lock = Lock()
+        if read_only:
+            self.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.executescript(
+                """
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS articles (
+                    id INTEGER PRIMARY KEY, title TEXT NOT NULL, revision INTEGER NOT NULL, links BLOB NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS redirects (title TEXT PRIMARY KEY, target INTEGER NOT NULL);
+                CREATE INDEX IF NOT EXISTS redirects_target ON redirects (target);
+                CREATE TABLE IF NOT EXISTS staged_paragraphs (
+                    id TEXT PRIMARY KEY, document TEXT NOT NULL, metadata BLOB NOT NULL, embedding BLOB NOT NULL
+                );
+                """
+            )
+        self._articles = None
+        self._titles = None
+        self._data_version = None
+
+    def _load(self) -> dict:
+        # Called with the lock held. data_version changes when another connection commits
+        (data_version,) = self.db.execute("PRAGMA data_version").fetchone()
+        if self._articles is None or data_version != self._data_version:
+            articles = {
+                id: {"id": id, "title": title, "revision": revision, "links": json_loads(links), "redirects": []}
+                for id, title, revision, links in self.db.execute("SELECT id, title, revision, links FROM articles")
+            }
+            titles = {article["title"]: id for id, article in articles.items()}
+            for title, target in self.db.execute("SELECT title, target FROM redirects ORDER BY title"):
+                if target in articles:
+                    articles[target]["redirects"].append(title)
+                titles.setdefault(title, target)
+            self._articles, self._titles, self._data_version = articles, titles, data_version
+        return self._articles
+
+    def get(self, id: int) -> Optional[dict]:
+        """
+        The article with the given ID.
+
+        Args:
+            id (int): The article ID, e.g. the `article_id` metadata of a paragraph.
+
+        Returns:
+            Optional[dict]: The id, title, revision, links and redirects of the article, or None if unknown.
+        """
+        with self._lock:
+            return self._load().get(id)
+
+    def mget(self, ids: Sequence[int]) -> list[Optional[dict]]:
+        with self._lock:
+            articles = self._load()
+            return [articles.get(id) for id in ids]
+
+    def by_title(self, title: str) -> Optional[dict]:
+        """
+        The article with the given title, or the article a redirect with that title points to.
+        """
+        with self._lock:
+            articles = self._load()
+            return articles.get(self._titles.get(title))
+
+    def upsert(self, articles: Iterable[dict]) -> list[int]:
+        """
+        Writes the article-level data of processed articles.
+
+        Redirect pages, which have no sections, are stored as a redirect to the first of their
+        links, the target article, and are listed in its `redirects`.
+
+        Args:
+            articles (Iterable[dict]): Processed articles, with title, links, sections and optionally revision.
+
+        Returns:
+            list[int]: The IDs of the articles, in order.
+        """
+        rows, redirects, ids = [], [], []
+        for article in articles:
+            ids.append(article_id(article["title"]))
+            if article["sections"] is None:
+                if article["links"]:
+                    redirects.append((article["title"], article_id(article["links"][0])))
+                continue
+            rows.append((ids[-1], article["title"], article.get("revision") or 0, json_dumps(article["links"])))
+        with self._lock:
+            self.db.executemany("INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?)", rows)
+            self.db.executemany("INSERT OR REPLACE INTO redirects VALUES (?, ?)", redirects)
+            self.db.commit()
+            self._articles = None
+        return ids
+
+    def delete(self, titles: Sequence[str]) -> None:
+        """
+        Deletes the articles, and redirect pages, with the given titles.
+        """
+        ids = [(article_id(title),) for title in titles]
+        with self._lock:
+            self.db.executemany("DELETE FROM articles WHERE id = ?", ids)
+            self.db.executemany("DELETE FROM redirects WHERE title = ?", [(title,) for title in titles])
+            self.db.commit()
+            self._articles = None
+
+    def stage_paragraphs(self, ids: Sequence[str], documents: Sequence[str], metadatas: Sequence[dict], embeddings) -> None:
+        """
+        Keeps a copy of paragraphs that are about to be deleted from the vectorstore and added back,
+        see VectorDBManager.normalize_articles, so a run interrupted in between loses none of them.
+        """
+        rows = [
+            (id, document, json_dumps(metadata), np.asarray(embedding, dtype=np.float32).tobytes())
+            for id, document, metadata, embedding in zip(ids, documents, metadatas, embeddings)
+        ]
+        with self._lock:
+            self.db.executemany("INSERT OR REPLACE INTO staged_paragraphs VALUES (?, ?, ?, ?)", rows)
+            self.db.commit()
+
+    def staged_paragraphs(self) -> tuple[list, list, list, list]:
+        """
+        The ids, documents, metadatas and embeddings of the staged paragraphs.
+        """
+        with self._lock:
+            rows = self.db.execute("SELECT id, document, metadata, embedding FROM staged_paragraphs").fetchall()
+        return (
+            [id for id, _, _, _ in rows],
+            [document for _, document, _, _ in rows],
+            [json_loads(metadata) for _, _, metadata, _ in rows],
+            [np.frombuffer(embedding, dtype=np.float32) for _, _, _, embedding in rows],
+        )
+
+    def clear_staged(self) -> None:
+        with self._lock:
+            self.db.execute("DELETE FROM staged_paragraphs")
+            self.db.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.db.executescript("DELETE FROM articles; DELETE FROM redirects;")
+            self._articles = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._load())
@@ -0,0 +1,188 @@
+# On-disk BM25 inverted index over section content and titles
+import math
+import re
+import sqlite3
+from collections import Counter
+from heapq import nlargest
+from pathlib import Path
+from threading import Lock
+from typing import Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+BM25_FILE = Path(__file__).parent.parent / "bm25.sqlite"
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Lowercased word tokens, with possessives folded so "Kaladin's" matches "Kaladin".
+    """
+    return [token[:-2] if token.endswith("'s") else token for token in re.findall(r"\w[\w']*", text.lower().replace("\u2019", "'"))]
+
+
+class BM25Index:
+    """
+    A BM25 inverted index kept in SQLite.
+
+    Terms are interned to integer ids and a posting is a (term, document, term frequency)
+    row in a table without rowids, which SQLite stores as compact varints. A query only
+    reads the postings of its own terms, so lookups stay fast without loading the index.
+    Documents are parent sections, keyed by their docstore id, and their titles count
+    alongside the content.
+    """
+    def __init__(self, path: Path = BM25_FILE, k1: float = 1.5, b: float = 0.75, read_only: bool = False) -> None:
+        """
+        Constructor for BM25Index class.
+
+        Args:
+            path (Path): Path to the SQLite file.
+            k1 (float, optional): Term frequency saturation. Defaults to 1.5.
+            b (float, optional): Document length normalization. Defaults to 0.75.
+            read_only (bool, optional): Open the file read only, e.g. in query workers. Defaults to False.
+
+        Returns:
+            None
+        """
+        self.path = Path(path)
+        self.k1 = k1
+        self.b = b
+        self._lock = Lock()
+        if read_only:
+            self.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.executescript(
+                """
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS terms (id INTEGER PRIMARY KEY, term TEXT UNIQUE, df INTEGER);
+                CREATE TABLE IF NOT EXISTS documents (id INTEGER PRIMARY KEY, key TEXT UNIQUE, length INTEGER, terms BLOB);
+                CREATE TABLE IF NOT EXISTS postings (
+                    term INTEGER, document INTEGER, tf INTEGER, PRIMARY KEY (term, document)
+                ) WITHOUT ROWID;
+                """
+            )
+
+    @staticmethod
+    def document_text(document: Document) -> str:
+        metadata = document.metadata
+        return f"{metadata.get('parent_article', '')} {metadata.get('heading', '')} {document.page_content}"
+
+    def add(self, key_value_pairs: Sequence[tuple[str, Document]]) -> None:
+        """
+        Indexes documents, replacing the ones already indexed under the same key.
+
+        Args:
+            key_value_pairs (Sequence[tuple[str, Document]]): The docstore id and document of every section.
+
+        Returns:
+            None
+        """
+        self.delete([key for key, _ in key_value_pairs])
+        with self._lock:
+            for key, document in key_value_pairs:
+                counts = Counter(tokenize(self.document_text(document)))
+                self.db.executemany(
+                    "INSERT INTO terms (term, df) VALUES (?, 1) ON CONFLICT (term) DO UPDATE SET df = df + 1",
+                    [(term,) for term in counts],
+                )
+                term_ids = dict(self.db.execute(
+                    f"SELECT term, id FROM terms WHERE term IN ({','.join('?' * len(counts))})", list(counts)
+                ).fetchall()) if counts else {}
+                ids = np.array([term_ids[term] for term in counts], dtype=np.int64)
+                cursor = self.db.execute(
+                    "INSERT INTO documents (key, length, terms) VALUES (?, ?, ?)",
+                    (key, sum(counts.values()), ids.tobytes()),
+                )
+                self.db.executemany(
+                    "INSERT INTO postings VALUES (?, ?, ?)",
+                    [(term_ids[term], cursor.lastrowid, tf) for term, tf in counts.items()],
+                )
+            self.db.commit()
+
+    def delete(self, keys: Sequence[str]) -> None:
+        """
+        Removes documents from the index, ignoring keys that are not indexed.
+        """
+        with self._lock:
+            for key in keys:
+                row = self.db.execute("SELECT id, terms FROM documents WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    continue
+                document, terms = row
+                term_ids = np.frombuffer(terms, dtype=np.int64).tolist()
+                self.db.executemany("DELETE FROM postings WHERE term = ? AND document = ?", [(t, document) for t in term_ids])
+                self.db.executemany("UPDATE terms SET df = df - 1 WHERE id = ?", [(t,) for t in term_ids])
+                self.db.execute("DELETE FROM documents WHERE id = ?", (document,))
+            self.db.execute("DELETE FROM terms WHERE df <= 0")
+            self.db.commit()
+
+    def search(self, query: str, k: int = 4) -> list[tuple[str, float]]:
+        """
+        Scores the documents that share a term with the query.
+
+        Args:
+            query (str): The query.
+            k (int, optional): The number of results. Defaults to 4.
+
+        Returns:
+            list[tuple[str, float]]: The keys and BM25 scores of the best documents, best first.
+        """
+        terms = list(set(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            count, total = self.db.execute("SELECT COUNT(*), SUM(length) FROM documents").fetchone()
+            if not count:
+                return []
+            avgdl = total / count
+            scores = Counter()
+            for term_id, df in self.db.execute(
+                f"SELECT id, df FROM terms WHERE term IN ({','.join('?' * len(terms))})", terms
+            ).fetchall():
+                idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                postings = self.db.execute(
+                    "SELECT p.document, p.tf, d.length FROM postings p JOIN documents d ON d.id = p.document "
+                    "WHERE p.term = ?", (term_id,)
+                ).fetchall()
+                if not postings:
+                    continue
+                documents, tf, length = np.array(postings, dtype=np.float64).T
+                weights = idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avgdl))
+                for document, weight in zip(documents.astype(np.int64).tolist(), weights.tolist()):
+                    scores[document] += weight
+            best = nlargest(k, scores.items(), key=lambda item: item[1])
+            keys = dict(self.db.execute(
+                f"SELECT id, key FROM documents WHERE id IN ({','.join('?' * len(best))})", [d for d, _ in best]
+            ).fetchall()) if best else {}
+        return [(keys[document], score) for document, score in best]
+
+    def stats(self) -> dict:
+        """
+        Returns the number of documents, terms and postings and the size of the file.
+        """
+        with self._lock:
+            documents, terms, postings = (
+                self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ("documents", "terms", "postings")
+            )
+            (pages,), (page_size,) = self.db.execute("PRAGMA page_count").fetchone(), self.db.execute("PRAGMA page_size").fetchone()
+        return {"documents": documents, "terms": terms, "postings": postings, "bytes": pages * page_size}
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = 60) -> list[str]:
+    """
+    Fuses ranked lists of ids, each id scoring 1 / (k + rank) in every list it appears in.
+
+    Args:
+        rankings (Sequence[Sequence[str]]): The ids of every ranking, best first.
+        k (int, optional): Damps the weight of the top ranks. Defaults to 60.
+
+    Returns:
+        list[str]: Every id, best fused score first.
+    """
+    scores = Counter()
+    for ranking in rankings:
+        for rank, id in enumerate(ranking, 1):
+            scores[id] += 1 / (k + rank)
+    return [id for id, _ in scores.most_common()]
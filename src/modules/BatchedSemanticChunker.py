@@ -0,0 +1,203 @@
+# Semantic chunking that embeds sentences across many documents at once
+import copy
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Iterable, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_experimental.text_splitter import SemanticChunker
+
+
+def _sentences(chunker: SemanticChunker, text: str) -> tuple[list[str], list[str]]:
+    """
+    Splits a text into sentences and, when it will be chunked semantically, the
+    sentence windows to embed. Mirrors SemanticChunker.split_text and combine_sentences.
+    """
+    sentences = re.split(chunker.sentence_split_regex, text)
+    if len(sentences) == 1 or (chunker.breakpoint_threshold_type == "gradient" and len(sentences) == 2):
+        return sentences, []
+    b = chunker.buffer_size
+    combined = [" ".join(sentences[max(0, i - b):i + b + 1]) for i in range(len(sentences))]
+    return sentences, combined
+
+
+def cosine_distances(embeddings: np.ndarray) -> np.ndarray:
+    """
+    Cosine distance between every row and the next, like calculate_cosine_distances in one pass.
+    """
+    norms = np.linalg.norm(embeddings, axis=1)
+    # A stack of (1, d) @ (d, 1) products rounds exactly like cosine_similarity's np.dot, einsum
+    # does not, and equal distances must tie the same way
+    dots = np.matmul(embeddings[:-1, None, :], embeddings[1:, :, None])[:, 0, 0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        similarity = dots / (norms[:-1] * norms[1:])
+    similarity[np.isnan(similarity) | np.isinf(similarity)] = 0.0
+    return 1 - similarity
+
+
+def _spans(chunker: SemanticChunker, sentences: list[str], distances: Optional[list[float]]) -> list[tuple[int, int]]:
+    """
+    The sentence ranges of the chunks of one text, split at its breakpoints like SemanticChunker.split_text.
+    """
+    if distances is None:
+        return [(i, i + 1) for i in range(len(sentences))]
+    if chunker.number_of_chunks is not None:
+        threshold, breakpoint_array = chunker._threshold_from_clusters(distances), distances
+    else:
+        threshold, breakpoint_array = chunker._calculate_breakpoint_threshold(distances)
+
+    spans = []
+    start_index = 0
+    for index in np.flatnonzero(np.asarray(breakpoint_array) > threshold):
+        # Small chunks are merged into the next one
+        if chunker.min_chunk_size is not None and len(" ".join(sentences[start_index:index + 1])) < chunker.min_chunk_size:
+            continue
+        spans.append((start_index, index + 1))
+        start_index = index + 1
+    if start_index < len(sentences):
+        spans.append((start_index, len(sentences)))
+    return spans
+
+
+class BatchedSemanticChunker(SemanticChunker):
+    """
+    A SemanticChunker that splits many documents together.
+
+    The sentence windows of all documents go to the embedding model in batches of
+    `batch_size`, instead of one model call per document. Breakpoints are found with
+    vectorized NumPy, and sentence splitting and chunk assembly run in a pool of
+    `max_workers` processes. The chunks are the same as SemanticChunker's.
+
+    split_documents_with_embeddings also pools the window embeddings into a vector
+    per chunk, so chunks can be stored without embedding them again.
+    """
+    def __init__(self, embeddings: Embeddings, batch_size: int = 1024, max_workers: int = 1, **kwargs) -> None:
+        """
+        Constructor for BatchedSemanticChunker class.
+
+        Args:
+            embeddings (Embeddings): The embeddings used to find breakpoints.
+            batch_size (int, optional): The number of sentence windows per embedding call. Defaults to 1024.
+            max_workers (int, optional): The number of processes splitting and assembling, 1 keeps
+                everything in this process. Defaults to 1.
+            **kwargs: Passed on to SemanticChunker, e.g. breakpoint_threshold_type.
+
+        Returns:
+            None
+        """
+        super().__init__(embeddings, **kwargs)
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self._executor = None
+
+    def _map(self, function, *iterables) -> list:
+        # Workers get a copy without the embedding model
+        settings = copy.copy(self)
+        settings.embeddings = None
+        settings._executor = None
+        function = partial(function, settings)
+        if self.max_workers <= 1:
+            return list(map(function, *iterables))
+        if self._executor is None:
+            # Spawned, forking a process that holds a model and its threads is not safe
+            self._executor = ProcessPoolExecutor(self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+        chunksize = max(1, len(iterables[0]) // (self.max_workers * 4))
+        return list(self._executor.map(function, *iterables, chunksize=chunksize))
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def _split(self, texts: list[str], pool: bool = False) -> tuple[list[list[str]], Optional[list[np.ndarray]]]:
+        prepared = self._map(_sentences, texts)
+        windows = [window for _, combined in prepared for window in combined]
+        # Texts too short to chunk semantically have no windows, their sentences are embedded as they are
+        extra = [sentence for sentences, combined in prepared if not combined for sentence in sentences] if pool else []
+        inputs = windows + extra
+        vectors = []
+        for i in range(0, len(inputs), self.batch_size):
+            vectors.extend(self.embeddings.embed_documents(inputs[i:i + self.batch_size]))
+        vectors = np.asarray(vectors, dtype=np.float64)
+        # Distances of all windows at once, the pairs that span two texts are dropped below
+        distances = cosine_distances(vectors[:len(windows)]).tolist() if windows else []
+
+        per_text = []
+        offset = 0
+        for _, combined in prepared:
+            per_text.append(distances[offset:offset + len(combined) - 1] if combined else None)
+            offset += len(combined)
+        spans = self._map(_spans, [sentences for sentences, _ in prepared], per_text)
+        chunks = [[" ".join(sentences[a:b]) for a, b in text_spans] for (sentences, _), text_spans in zip(prepared, spans)]
+        if not pool:
+            return chunks, None
+
+        pooled = []
+        window_offset, extra_offset = 0, len(windows)
+        for (sentences, combined), text_spans in zip(prepared, spans):
+            if combined:
+                rows, window_offset = vectors[window_offset:window_offset + len(combined)], window_offset + len(combined)
+            else:
+                rows, extra_offset = vectors[extra_offset:extra_offset + len(sentences)], extra_offset + len(sentences)
+            pooled.append(np.stack([rows[a:b].mean(axis=0) for a, b in text_spans]))
+        return chunks, pooled
+
+    def split_texts(self, texts: list[str]) -> list[list[str]]:
+        """
+        Splits every text into chunks.
+
+        Args:
+            texts (list[str]): The texts to split.
+
+        Returns:
+            list[list[str]]: The chunks of every text.
+        """
+        return self._split(texts)[0]
+
+    def split_text(self, text: str) -> list[str]:
+        return self.split_texts([text])[0]
+
+    def _documents(self, texts: list[str], metadatas: Optional[list[dict]], chunks: list[list[str]]) -> list[Document]:
+        _metadatas = metadatas or [{}] * len(texts)
+        documents = []
+        for i, text_chunks in enumerate(chunks):
+            start_index = 0
+            for chunk in text_chunks:
+                metadata = copy.deepcopy(_metadatas[i])
+                if self._add_start_index:
+                    metadata["start_index"] = start_index
+                documents.append(Document(page_content=chunk, metadata=metadata))
+                start_index += len(chunk)
+        return documents
+
+    def create_documents(self, texts: list[str], metadatas: Optional[list[dict]] = None) -> list[Document]:
+        """Create documents from a list of texts."""
+        return self._documents(texts, metadatas, self.split_texts(texts))
+
+    def split_documents(self, documents: Iterable[Document]) -> list[Document]:
+        """Split documents."""
+        documents = list(documents)
+        return self.create_documents(
+            [doc.page_content for doc in documents], metadatas=[doc.metadata for doc in documents]
+        )
+
+    def split_documents_with_embeddings(self, documents: Iterable[Document]) -> tuple[list[Document], list[list[float]]]:
+        """
+        Splits documents like split_documents and also returns a vector for every chunk, the mean
+        of the sentence window embeddings it spans. Nothing is embedded twice.
+
+        Args:
+            documents (Iterable[Document]): The documents to split.
+
+        Returns:
+            tuple[list[Document], list[list[float]]]: The chunks and their vectors, in the same order.
+        """
+        documents = list(documents)
+        texts = [doc.page_content for doc in documents]
+        chunks, pooled = self._split(texts, pool=True)
+        vectors = [vector.tolist() for text_vectors in pooled for vector in text_vectors]
+        return self._documents(texts, [doc.metadata for doc in documents], chunks), vectors
@@ -0,0 +1,495 @@
+# Compact read-only vector store over a memory-mapped vector file, for query workers
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Iterable, Optional, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+from langchain_core.vectorstores.utils import maximal_marginal_relevance
+
+from modules.utils import json_dumps, json_loads
+
+COMPACT_DIR = Path(__file__).parent.parent / "compact_index"
+FILES = ("meta.json", "metadata.sqlite", "vectors.npy", "norms.npy", "scales.npy", "centroids.npy", "offsets.npy", "raw.npy")
+DTYPES = ("float32", "float16", "int8")
+SPACES = ("l2", "cosine", "ip")
+
+
+def kmeans(vectors: np.ndarray, clusters: int, iterations: int = 10, seed: int = 0) -> np.ndarray:
+    """
+    Lloyd's k-means, returns the centroids. Empty clusters are reseeded from random vectors.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assignment = nearest_centroids(vectors, centroids)
+        for cluster in range(clusters):
+            members = vectors[assignment == cluster]
+            centroids[cluster] = members.mean(axis=0) if len(members) else vectors[rng.integers(len(vectors))]
+    return centroids
+
+
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray, count: int = 1) -> np.ndarray:
+    # Squared L2 without the norms of the vectors, which do not change the order
+    distances = (centroids ** 2).sum(axis=1) - 2 * vectors @ centroids.T
+    if count == 1:
+        return distances.argmin(axis=1)
+    count = min(count, len(centroids))
+    return np.argpartition(distances, count - 1, axis=1)[:, :count]
+
+
+class CompactVectorStore(VectorStore):
+    """
+    A read-only langchain vectorstore over files written by `build`, e.g. from a Chroma collection.
+
+    Vectors live in one memory-mapped .npy file, as float32, float16 or int8 with a scale
+    per row, so every worker process maps the same pages through the OS page cache
+    instead of holding its own copy. Ids, texts and metadata are rows of a small SQLite
+    table that is only read for the hits. Search is exact over all rows, or with `nlist`
+    set at build time, over the `nprobe` closest of `nlist` k-means lists (IVF), whose
+    rows are stored together. Distances follow Chroma's: squared L2, 1 - cosine or 1 - dot.
+    Like Chroma, `get` reads rows by id or metadata filter, but adding and deleting raise.
+    """
+    read_only = True
+    READ_ONLY_MESSAGE = "CompactVectorStore is read only, rebuild it with VectorDBManager.export_compact"
+
+    def __init__(self, path: Path = COMPACT_DIR, embedding_function: Optional[Embeddings] = None, nprobe: int = 8) -> None:
+        """
+        Constructor for CompactVectorStore class.
+
+        Args:
+            path (Path): The directory written by `build`.
+            embedding_function (Embeddings, optional): Embeds queries, the model the vectors were made with.
+            nprobe (int, optional): The IVF lists searched per query, more is slower and closer to
+                exact search. Defaults to 8.
+
+        Returns:
+            None
+        """
+        self.path = Path(path)
+        self._embedding_function = embedding_function
+        self.nprobe = nprobe
+        with open(self.path / "meta.json", "rb") as file:
+            self.meta = json_loads(file.read())
+        self.space = self.meta["space"]
+        self.vectors = np.load(self.path / "vectors.npy", mmap_mode="r")
+        self.norms = np.load(self.path / "norms.npy", mmap_mode="r")
+        self.scales = np.load(self.path / "scales.npy", mmap_mode="r") if self.meta["dtype"] == "int8" else None
+        if self.meta["nlist"]:
+            self.centroids = np.load(self.path / "centroids.npy")
+            self.offsets = np.load(self.path / "offsets.npy")
+        else:
+            self.centroids = self.offsets = None
+        self._lock = Lock()
+        self.db = sqlite3.connect(f"file:{self.path / 'metadata.sqlite'}?mode=ro", uri=True, check_same_thread=False)
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self._embedding_function
+
+    @classmethod
+    def build(
+            cls,
+            path: Path,
+            batches: Iterable[tuple[list[str], Any, list[str], list[dict]]],
+            count: int,
+            dtype: str = "int8",
+            space: str = "l2",
+            nlist: int = 0,
+            sample_size: int = 65536
+        ) -> Path:
+        """
+        Writes a store from batches of `(ids, vectors, documents, metadatas)`, e.g. read from a collection.
+
+        Vectors are staged as float32 in `path` first, so at most one batch is held in memory.
+
+        Args:
+            path (Path): The directory to write, replacing the files of an earlier build.
+            batches (Iterable[tuple]): The rows, in batches.
+            count (int): The total number of rows in the batches.
+            dtype (str, optional): "float32", "float16" or "int8", how the vectors are stored. int8 is a
+                quarter of the size and the fastest to search, float16 keeps more precision but NumPy
+                converts it slowly. Defaults to "int8".
+            space (str, optional): "l2", "cosine" or "ip", the distance of the source collection. Defaults to "l2".
+            nlist (int, optional): The number of IVF lists, 0 for exact search only. Around sqrt(count)
+                is a good start. Defaults to 0.
+            sample_size (int, optional): The vectors k-means is fit on. Defaults to 65536.
+
+        Returns:
+            Path: The directory.
+        """
+        if dtype not in DTYPES:
+            raise ValueError(f"dtype must be one of {DTYPES}, not {dtype!r}")
+        if space not in SPACES:
+            raise ValueError(f"space must be one of {SPACES}, not {space!r}")
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in FILES:
+            (path / name).unlink(missing_ok=True)
+        db = sqlite3.connect(path / "metadata.sqlite")
+        db.executescript(
+            """
+            CREATE TABLE staging (raw INTEGER PRIMARY KEY, id TEXT, document TEXT, metadata BLOB);
+            CREATE TABLE rows (row INTEGER PRIMARY KEY, id TEXT, document TEXT, metadata BLOB);
+            """
+        )
+        raw, written = None, 0
+        for ids, vectors, documents, metadatas in batches:
+            vectors = np.asarray(vectors, dtype=np.float32)
+            if space == "cosine":
+                # Chroma compares normalized vectors in cosine space, quantization then shares one range
+                norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+                vectors = vectors / np.where(norms == 0, 1, norms)
+            if raw is None:
+                raw = np.lib.format.open_memmap(path / "raw.npy", mode="w+", dtype=np.float32, shape=(count, vectors.shape[1]))
+            raw[written:written + len(ids)] = vectors
+            db.executemany("INSERT INTO staging VALUES (?, ?, ?, ?)", [
+                (written + i, id, document, json_dumps(metadata or {}))
+                for i, (id, document, metadata) in enumerate(zip(ids, documents, metadatas))
+            ])
+            written += len(ids)
+        if written != count:
+            raise ValueError(f"Expected {count} rows, the batches held {written}")
+        dim = raw.shape[1] if raw is not None else 0
+
+        # IVF lists are contiguous, so probing a list reads one range of the vector file
+        order = np.arange(count)
+        if nlist and count:
+            nlist = min(nlist, count)
+            sample = raw[np.sort(np.random.default_rng(0).choice(count, min(sample_size, count), replace=False))]
+            centroids = kmeans(sample, nlist)
+            assignment = np.concatenate([nearest_centroids(raw[i:i + 65536], centroids) for i in range(0, count, 65536)])
+            order = np.argsort(assignment, kind="stable")
+            np.save(path / "centroids.npy", centroids)
+            np.save(path / "offsets.npy", np.searchsorted(assignment[order], np.arange(nlist + 1)).astype(np.int64))
+        else:
+            nlist = 0
+
+        vectors = np.lib.format.open_memmap(path / "vectors.npy", mode="w+", dtype=dtype, shape=(count, dim))
+        norms = np.lib.format.open_memmap(path / "norms.npy", mode="w+", dtype=np.float32, shape=(count,))
+        scales = np.lib.format.open_memmap(path / "scales.npy", mode="w+", dtype=np.float32, shape=(count,)) if dtype == "int8" else None
+        for start in range(0, count, 65536):
+            rows = raw[order[start:start + 65536]]
+            if dtype == "int8":
+                scale = np.abs(rows).max(axis=1) / 127
+                scale[scale == 0] = 1
+                codes = np.clip(np.rint(rows / scale[:, None]), -127, 127).astype(np.int8)
+                vectors[start:start + len(rows)] = codes
+                scales[start:start + len(rows)] = scale
+                stored = codes.astype(np.float32) * scale[:, None]
+            else:
+                vectors[start:start + len(rows)] = rows.astype(dtype)
+                stored = vectors[start:start + len(rows)].astype(np.float32)
+            # Of the stored vectors, so distances agree with the dot products they are combined with
+            norms[start:start + len(rows)] = (stored ** 2).sum(axis=1)
+        for array in (vectors, norms, scales):
+            if array is not None:
+                array.flush()
+        del raw
+        (path / "raw.npy").unlink(missing_ok=True)
+
+        db.execute("CREATE TABLE mapping (raw INTEGER PRIMARY KEY, row INTEGER)")
+        db.executemany("INSERT INTO mapping VALUES (?, ?)", ((int(r), row) for row, r in enumerate(order)))
+        db.executescript(
+            """
+            INSERT INTO rows SELECT mapping.row, id, document, metadata FROM staging JOIN mapping USING (raw);
+            DROP TABLE staging;
+            DROP TABLE mapping;
+            CREATE INDEX rows_id ON rows (id);
+            """
+        )
+        db.commit()
+        db.execute("VACUUM")
+        db.close()
+        with open(path / "meta.json", "wb") as file:
+            file.write(json_dumps({"count": count, "dim": dim, "dtype": dtype, "space": space, "nlist": nlist}))
+        return path
+
+    @classmethod
+    def from_texts(
+            cls,
+            texts: list[str],
+            embedding: Embeddings,
+            metadatas: Optional[list[dict]] = None,
+            ids: Optional[list[str]] = None,
+            path: Path = COMPACT_DIR,
+            **kwargs: Any
+        ) -> "CompactVectorStore":
+        """
+        Embeds `texts` and builds a store of them in `path`, see `build` for the other arguments.
+        """
+        ids = ids or [str(i) for i in range(len(texts))]
+        batch = (ids, embedding.embed_documents(texts), texts, metadatas or [{}] * len(texts))
+        build_kwargs = {key: kwargs.pop(key) for key in ("dtype", "space", "nlist") if key in kwargs}
+        cls.build(path, [batch], count=len(texts), **build_kwargs)
+        return cls(path, embedding, **kwargs)
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[list[dict]] = None, **kwargs: Any) -> list[str]:
+        raise NotImplementedError(self.READ_ONLY_MESSAGE)
+
+    def delete(self, ids: Optional[list[str]] = None, **kwargs: Any) -> Optional[bool]:
+        raise NotImplementedError(self.READ_ONLY_MESSAGE)
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return {
+            "l2": self._euclidean_relevance_score_fn,
+            "cosine": self._cosine_relevance_score_fn,
+            "ip": self._max_inner_product_relevance_score_fn,
+        }[self.space]
+
+    def _dots(self, start: int, stop: int, queries: np.ndarray) -> np.ndarray:
+        # Dot products of rows [start, stop) with every query, dequantizing one range at a time
+        dots = self.vectors[start:stop].astype(np.float32, copy=False) @ queries.T
+        if self.scales is not None:
+            dots *= self.scales[start:stop, None]
+        return dots
+
+    def _distances(self, start: int, stop: int, queries: np.ndarray, query_norms: np.ndarray) -> np.ndarray:
+        dots = self._dots(start, stop, queries)
+        if self.space == "l2":
+            return self.norms[start:stop, None] - 2 * dots + query_norms[None, :]
+        if self.space == "cosine":
+            return 1 - dots / np.sqrt(np.maximum(self.norms[start:stop, None], 1e-12))
+        return 1 - dots
+
+    def _ranges(self, queries: np.ndarray) -> list[list[tuple[int, int]]]:
+        # The row ranges every query searches: everything, or its nprobe closest IVF lists
+        if self.centroids is None:
+            return [[(0, len(self.vectors))]] * len(queries)
+        lists = nearest_centroids(queries, self.centroids, self.nprobe)
+        return [[(int(self.offsets[i]), int(self.offsets[i + 1])) for i in sorted(query_lists)] for query_lists in lists]
+
+    def search_vectors(
+            self,
+            query_vectors: Sequence[Sequence[float]],
+            k: int = 4,
+            filter: Optional[dict] = None,
+            chunk_size: int = 8192
+        ) -> list[list[tuple[int, float]]]:
+        """
+        The `k` closest rows of every query vector, closest first.
+
+        Args:
+            query_vectors (Sequence[Sequence[float]]): The embedded queries.
+            k (int, optional): The number of rows per query. Defaults to 4.
+            filter (dict, optional): Only rows whose metadata match, see `_filter_rows`.
+            chunk_size (int, optional): Rows dequantized at a time. Defaults to 8192.
+
+        Returns:
+            list[list[tuple[int, float]]]: The `(row, distance)` pairs of every query.
+        """
+        queries = np.asarray(query_vectors, dtype=np.float32).reshape(len(query_vectors), -1)
+        if self.space == "cosine":
+            norms = np.linalg.norm(queries, axis=1, keepdims=True)
+            queries = queries / np.where(norms == 0, 1, norms)
+        query_norms = (queries ** 2).sum(axis=1)
+        allowed = self._filter_rows(filter) if filter else None
+        # Queries probing the same ranges, always the case for exact search, share the matrix products
+        groups = {}
+        for i, ranges in enumerate(self._ranges(queries)):
+            groups.setdefault(tuple(ranges), []).append(i)
+        results = [None] * len(queries)
+        for ranges, members in groups.items():
+            best_rows, best_distances = [], []
+            for start, stop in ranges:
+                for chunk_start in range(start, stop, chunk_size):
+                    chunk_stop = min(chunk_start + chunk_size, stop)
+                    distances = self._distances(chunk_start, chunk_stop, queries[members], query_norms[members])
+                    if allowed is not None:
+                        distances[~allowed[chunk_start:chunk_stop]] = np.inf
+                    top = min(k, len(distances))
+                    rows = np.argpartition(distances, top - 1, axis=0)[:top]
+                    best_rows.append(rows + chunk_start)
+                    best_distances.append(np.take_along_axis(distances, rows, axis=0))
+            if not best_rows:
+                for i in members:
+                    results[i] = []
+                continue
+            rows, distances = np.concatenate(best_rows), np.concatenate(best_distances)
+            for column, i in enumerate(members):
+                order = np.argsort(distances[:, column], kind="stable")[:k]
+                results[i] = [(int(rows[j, column]), float(distances[j, column]))
+                              for j in order if np.isfinite(distances[j, column])]
+        return results
+
+    @staticmethod
+    def _filter_sql(filter: dict) -> tuple[str, list]:
+        """
+        A WHERE clause for a Chroma style metadata filter of `{key: value}`, `{key: {"$eq"|"$ne"|"$in"|"$nin": ...}}`
+        and `$and`/`$or` of those.
+        """
+        def clause(condition: dict) -> tuple[str, list]:
+            parts, params = [], []
+            for key, value in condition.items():
+                if key in ("$and", "$or"):
+                    subclauses = [clause(sub) for sub in value]
+                    parts.append("(" + f" {key[1:].upper()} ".join(sql for sql, _ in subclauses) + ")")
+                    params += [param for _, sub_params in subclauses for param in sub_params]
+                    continue
+                operator, operand = next(iter(value.items())) if isinstance(value, dict) else ("$eq", value)
+                field = "json_extract(metadata, ?)"
+                params.append(f'$."{key}"')
+                if operator in ("$in", "$nin"):
+                    parts.append(f"{field} {'NOT ' if operator == '$nin' else ''}IN ({','.join('?' * len(operand))})")
+                    params += list(operand)
+                elif operator in ("$eq", "$ne"):
+                    parts.append(f"{field} {'=' if operator == '$eq' else '!='} ?")
+                    params.append(operand)
+                else:
+                    raise ValueError(f"Unsupported filter operator {operator}")
+            return " AND ".join(parts) or "1", params
+
+        return clause(filter)
+
+    def _filter_rows(self, filter: dict) -> np.ndarray:
+        """
+        The rows matching a metadata filter, see `_filter_sql`, as a boolean mask.
+        """
+        sql, params = self._filter_sql(filter)
+        with self._lock:
+            rows = [row for (row,) in self.db.execute(f"SELECT row FROM rows WHERE {sql}", params)]
+        allowed = np.zeros(len(self.vectors), dtype=bool)
+        allowed[rows] = True
+        return allowed
+
+    def _rows_by_id(self, ids: Sequence[str]) -> list[int]:
+        # Through the rows_id index, in chunks below SQLite's limit on parameters
+        rows = []
+        with self._lock:
+            for i in range(0, len(ids), 500):
+                chunk = list(ids[i:i + 500])
+                rows += [row for (row,) in self.db.execute(
+                    f"SELECT row FROM rows WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                )]
+        return rows
+
+    def _documents(self, rows: Sequence[int]) -> dict[int, Document]:
+        found = {}
+        with self._lock:
+            for i in range(0, len(rows), 500):
+                chunk = [int(row) for row in rows[i:i + 500]]
+                for row, id, document, metadata in self.db.execute(
+                    f"SELECT row, id, document, metadata FROM rows WHERE row IN ({','.join('?' * len(chunk))})", chunk
+                ):
+                    found[row] = Document(id=id, page_content=document or "", metadata=json_loads(metadata))
+        return found
+
+    def similarity_search_with_score_by_vector(
+            self, embedding: list[float], k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+        ) -> list[tuple[Document, float]]:
+        hits = self.search_vectors([embedding], k=k, filter=filter)[0]
+        documents = self._documents([row for row, _ in hits])
+        return [(documents[row], distance) for row, distance in hits]
+
+    def similarity_search_with_score_by_vectors(
+            self, embeddings: Sequence[Sequence[float]], k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+        ) -> list[list[tuple[Document, float]]]:
+        """
+        `similarity_search_with_score_by_vector` for many query vectors, with one search and one metadata read.
+        """
+        hits = self.search_vectors(embeddings, k=k, filter=filter)
+        documents = self._documents(list({row for query_hits in hits for row, _ in query_hits}))
+        return [[(documents[row], distance) for row, distance in query_hits] for query_hits in hits]
+
+    def similarity_search_by_vector(
+            self, embedding: list[float], k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+        ) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k, filter=filter)]
+
+    def similarity_search_with_score(
+            self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any
+        ) -> list[tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self._embedding_function.embed_query(query), k=k, filter=filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, filter=filter)]
+
+    def _similarity_search_with_relevance_scores(
+            self, query: str, k: int = 4, **kwargs: Any
+        ) -> list[tuple[Document, float]]:
+        relevance = self._select_relevance_score_fn()
+        return [(doc, relevance(distance)) for doc, distance in self.similarity_search_with_score(query, k=k, **kwargs)]
+
+    def max_marginal_relevance_search_by_vector(
+            self,
+            embedding: list[float],
+            k: int = 4,
+            fetch_k: int = 20,
+            lambda_mult: float = 0.5,
+            filter: Optional[dict] = None,
+            **kwargs: Any
+        ) -> list[Document]:
+        hits = self.search_vectors([embedding], k=fetch_k, filter=filter)[0]
+        rows = [row for row, _ in hits]
+        candidates = np.stack([self._dequantize(row) for row in rows]) if rows else np.zeros((0, len(embedding)))
+        selected = maximal_marginal_relevance(np.asarray(embedding, dtype=np.float32), candidates, lambda_mult=lambda_mult, k=k)
+        documents = self._documents([rows[i] for i in selected])
+        return [documents[rows[i]] for i in selected]
+
+    def max_marginal_relevance_search(
+            self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, filter: Optional[dict] = None, **kwargs: Any
+        ) -> list[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self._embedding_function.embed_query(query), k=k, fetch_k=fetch_k, lambda_mult=lambda_mult, filter=filter
+        )
+
+    def _dequantize(self, row: int) -> np.ndarray:
+        vector = self.vectors[row].astype(np.float32)
+        return vector * self.scales[row] if self.scales is not None else vector
+
+    def get_by_ids(self, ids: Sequence[str], /) -> list[Document]:
+        return list(self._documents(self._rows_by_id(ids)).values())
+
+    def get(
+            self,
+            ids: Optional[Sequence[str]] = None,
+            where: Optional[dict] = None,
+            limit: Optional[int] = None,
+            offset: Optional[int] = None,
+            include: Sequence[str] = ("documents", "metadatas"),
+            **kwargs: Any
+        ) -> dict:
+        """
+        The rows with the given ids and matching the metadata filter, in the shape of Chroma's `get`.
+
+        Args:
+            ids (Sequence[str], optional): Only rows with these ids.
+            where (dict, optional): Only rows whose metadata match, see `_filter_sql`.
+            limit (int, optional): The number of rows returned.
+            offset (int, optional): The rows skipped first.
+            include (Sequence[str], optional): Any of "documents" and "metadatas". Defaults to both.
+
+        Returns:
+            dict: The "ids", and the "documents" and "metadatas" asked for, of the rows.
+        """
+        sql, params = self._filter_sql(where) if where else ("1", [])
+        query = f"SELECT row, id, document, metadata FROM rows WHERE {sql}"
+        with self._lock:
+            if ids is None:
+                found = self.db.execute(query, params).fetchall()
+            else:
+                # In chunks below SQLite's limit on parameters, through the rows_id index
+                found = []
+                for i in range(0, len(ids), 500):
+                    chunk = list(ids[i:i + 500])
+                    found += self.db.execute(f"{query} AND id IN ({','.join('?' * len(chunk))})", params + chunk).fetchall()
+        found = sorted(set(found))[offset or 0:None if limit is None else (offset or 0) + limit]
+        result = {"ids": [id for _, id, _, _ in found]}
+        if "documents" in include:
+            result["documents"] = [document for _, _, document, _ in found]
+        if "metadatas" in include:
+            result["metadatas"] = [json_loads(metadata) for _, _, _, metadata in found]
+        return result
+
+    def stats(self) -> dict:
+        """
+        The number of rows, how they are stored and searched, and the size of every file in bytes.
+        """
+        return {
+            **self.meta,
+            "nprobe": self.nprobe if self.meta["nlist"] else None,
+            "bytes": {file.name: file.stat().st_size for file in sorted(self.path.iterdir()) if file.is_file()},
+        }
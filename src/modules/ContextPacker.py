@@ -0,0 +1,106 @@
+# Assembles the LLM prompt context from reranked documents within a token budget
+from typing import Optional, Sequence
+
+from langchain_core.documents import Document
+
+from modules.Metrics import METRICS
+from modules.utils import estimate_tokens
+
+
+class ContextPacker:
+    """
+    Turns reranked documents into the context of the LLM prompt.
+
+    Documents are deduplicated by their parent id and content, ordered by rerank score and
+    added best first while they fit in `max_tokens`. Only the heading and the content of a
+    document go into the context, numbered so answers can cite them; the rest of its
+    metadata is left out. Tokens are estimated with `estimate_tokens`, no tokenizer is loaded.
+    """
+    def __init__(
+            self,
+            max_tokens: int = 2048,
+            id_key: str = "doc_id",
+            score_key: str = "relevance_score",
+            separator: str = "\n\n"
+        ) -> None:
+        """
+        Constructor for ContextPacker class.
+
+        Args:
+            max_tokens (int, optional): The estimated tokens the context may take. Defaults to 2048.
+            id_key (str, optional): The metadata key of the parent id. Defaults to "doc_id".
+            score_key (str, optional): The metadata key of the rerank score. Defaults to "relevance_score".
+            separator (str, optional): Put between documents. Defaults to a blank line.
+
+        Returns:
+            None
+        """
+        self.max_tokens = max_tokens
+        self.id_key = id_key
+        self.score_key = score_key
+        self.separator = separator
+
+    def rank(self, docs: Sequence[Document]) -> list[Document]:
+        """
+        The documents best first, each parent and each content only once.
+
+        Documents without a score keep their order, after the scored ones.
+        """
+        ordered = sorted(
+            docs,
+            key=lambda doc: (doc.metadata.get(self.score_key) is None, -(doc.metadata.get(self.score_key) or 0.0))
+        )
+        seen_ids, seen_contents, unique = set(), set(), []
+        for doc in ordered:
+            parent_id = doc.metadata.get(self.id_key)
+            content = " ".join(doc.page_content.split())
+            if (parent_id is not None and parent_id in seen_ids) or content in seen_contents:
+                continue
+            if parent_id is not None:
+                seen_ids.add(parent_id)
+            seen_contents.add(content)
+            unique.append(doc)
+        return unique
+
+    @staticmethod
+    def format(doc: Document, number: int) -> str:
+        heading = doc.metadata.get("heading")
+        header = f"[{number}] {heading}" if heading else f"[{number}]"
+        return f"{header}\n{doc.page_content.strip()}"
+
+    def pack(self, docs: Sequence[Document], max_tokens: Optional[int] = None) -> tuple[str, list[Document]]:
+        """
+        Packs the best documents into a context of at most `max_tokens` estimated tokens.
+
+        A document that does not fit is skipped and the next, shorter ones are tried. When
+        not even the best one fits, it is cut to the budget rather than sending no context.
+
+        Args:
+            docs (Sequence[Document]): The reranked documents.
+            max_tokens (int, optional): Overrides the budget of the packer.
+
+        Returns:
+            tuple[str, list[Document]]: The context and the documents in it, in the order they
+                are numbered, i.e. the sources of the answer.
+        """
+        budget = self.max_tokens if max_tokens is None else max_tokens
+        ranked = self.rank(docs)
+        blocks, included, used = [], [], 0
+        separator_tokens = estimate_tokens(self.separator)
+        for doc in ranked:
+            block = self.format(doc, len(included) + 1)
+            tokens = estimate_tokens(block) + (separator_tokens if blocks else 0)
+            if used + tokens > budget:
+                if blocks:
+                    continue
+                # About four characters per token, see estimate_tokens
+                block = block[:max(budget - 1, 0) * 4].rsplit(" ", 1)[0]
+                tokens = estimate_tokens(block)
+            blocks.append(block)
+            included.append(doc)
+            used += tokens
+        if METRICS.enabled:
+            METRICS.count("context.documents", len(included))
+            METRICS.count("context.documents_dropped", len(docs) - len(included))
+            METRICS.count("context.tokens", used)
+        return self.separator.join(blocks), included
@@ -1,9 +1,38 @@
 from langchain_core.documents import Document
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.runnables.config import run_in_executor
 from langchain.retrievers import MultiVectorRetriever
+from langchain.retrievers.multi_vector import SearchType
 from langchain_text_splitters import TextSplitter
-from typing import Union, Optional, Sequence, Any
+from typing import Optional, Sequence, Any, Iterable, Iterator, Literal
+import ast
 import uuid
 
+from modules.utils import open_file, batched
+from modules.BM25Index import reciprocal_rank_fusion
+from modules.Metrics import METRICS
+
+# Optional, only needed to save or load processed documents
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _literal_documents(node: ast.AST):
+    # ast.literal_eval that also accepts Document(...) calls with literal keyword arguments,
+    # the repr earlier versions wrote, so nothing in the file is executed
+    if isinstance(node, ast.Call):
+        if not (isinstance(node.func, ast.Name) and node.func.id == 'Document') or node.args \
+                or any(keyword.arg is None for keyword in node.keywords):
+            raise ValueError(f"Unexpected expression on line {node.lineno}, only Document(...) calls are read")
+        return Document(**{keyword.arg: ast.literal_eval(keyword.value) for keyword in node.keywords})
+    if isinstance(node, ast.List):
+        return [_literal_documents(element) for element in node.elts]
+    if isinstance(node, ast.Tuple):
+        return tuple(_literal_documents(element) for element in node.elts)
+    return ast.literal_eval(node)
+
 class CustomParentDocRetriever(MultiVectorRetriever):
     child_splitter: Any
     """The text splitter to use to create child documents."""
@@ -18,53 +47,270 @@ class CustomParentDocRetriever(MultiVectorRetriever):
     """Metadata fields to leave in child documents. If None, leave all parent document 
         metadata.
     """
+    chunk_embeddings: Optional[Any] = None
+    """A CachedEmbeddings the vectorstore embeds with. When set, the child splitter's
+        pooled chunk vectors are stored in its cache, so adding chunks embeds nothing again.
+    """
+    lexical_index: Optional[Any] = None
+    """A BM25Index over the parent documents, kept in sync when documents are added or deleted."""
+    retrieval_mode: Literal["vector", "lexical", "hybrid"] = "vector"
+    """Find parents by their chunks in the vectorstore, by BM25 over the lexical index, or by
+        fusing both rankings. lexical and hybrid need a lexical_index.
+    """
+    rrf_k: int = 60
+    """The k of reciprocal rank fusion in hybrid mode."""
+
     def _to_document(self, data) -> Document:
         return Document(page_content=data['content'], metadata=data['metadata'])
     
-    def save_txt(self, data: Union[list, set], filename: str) -> None:
-        with open(filename + '.txt', 'w') as file:
-            file.write(str(data))
-    
-    def load_txt(self, filename: str) -> list[dict]:
-        with open(filename + '.txt', 'r') as file:
-            return eval(file.read())
-    
+    def save_records(self, records: Iterable[tuple[Optional[str], Document]], filename: str) -> None:
+        """
+        Streams documents to a msgpack file, one `{id, page_content, metadata}` map per document.
+
+        A `.gz` or `.zst` suffix compresses the file.
+        """
+        if msgpack is None:
+            raise ImportError("msgpack is required to save processed documents")
+        packer = msgpack.Packer()
+        with open_file(filename, 'wb') as file:
+            for id, doc in records:
+                file.write(packer.pack({'id': id, 'page_content': doc.page_content, 'metadata': doc.metadata}))
+
+    def iter_records(self, filename: str) -> Iterator[tuple[Optional[str], Document]]:
+        """
+        Yields the `(id, document)` pairs of a file written by save_records without loading it whole.
+        """
+        if msgpack is None:
+            raise ImportError("msgpack is required to load processed documents")
+        with open_file(filename, 'rb') as file:
+            for record in msgpack.Unpacker(file, raw=False):
+                yield record['id'], Document(page_content=record['page_content'], metadata=record['metadata'])
+
+    def convert_txt(self, prefix: str = 'semantic', suffix: str = '.msgpack', encoding: Optional[str] = None) -> None:
+        """
+        One time migration of the `{prefix}_docs.txt` and `{prefix}_full_docs.txt` files written by
+        earlier versions to save_records files. They are parsed, not evaluated: only literals and
+        `Document(...)` calls with literal arguments are accepted, anything else raises ValueError.
+        They were written in the platform's default encoding, e.g. pass "cp1252" for files from Windows.
+        """
+        for name, with_ids in ((f'{prefix}_docs', False), (f'{prefix}_full_docs', True)):
+            with open(name + '.txt', 'r', encoding=encoding) as file:
+                data = _literal_documents(ast.parse(file.read(), mode='eval').body)
+            self.save_records(data if with_ids else ((None, doc) for doc in data), name + suffix)
+
     def load_processed(
             self,
-            load_prefix = 'semantic'):
-        docs = self.load_txt(f'{load_prefix}_docs')
-        full_docs = self.load_txt(f'{load_prefix}_full_docs')
-        self.vectorstore.add_documents(docs)
-        self.docstore.mset(full_docs)
-        
+            load_prefix = 'semantic',
+            suffix = '.msgpack',
+            batch_size = 1000):
+        """
+        Streams the chunks and parents saved by _split_docs_for_adding into the vectorstore and docstore,
+        `batch_size` documents at a time.
+        """
+        self._check_writable()
+        docs = (doc for _, doc in self.iter_records(f'{load_prefix}_docs{suffix}'))
+        for batch in batched(docs, batch_size):
+            self.vectorstore.add_documents(batch)
+        for batch in batched(self.iter_records(f'{load_prefix}_full_docs{suffix}'), batch_size):
+            self.docstore.mset(batch)
+            if self.lexical_index is not None:
+                self.lexical_index.add(batch)
 
     def _split_docs_for_adding(
             self,
             documents,
             save=True,
-            save_prefix = 'semantic'
+            save_prefix = 'semantic',
+            suffix = '.msgpack'
         ):
         # feed semantic splitter to custom ParentDocumentRetriever
         if not isinstance(documents[0], Document):
             documents = [self._to_document(doc) for doc in documents]
-        full_docs = []
-        docs = []
-        for i, doc in enumerate(documents):
-            id = str(uuid.uuid4())
-            full_docs.append((id, doc))
-            
-            chunks = self.child_splitter.split_documents([doc])
-            for child in chunks:
-                if not child.page_content.startswith(f"{child.metadata['parent_article']} - "):
-                    child.page_content = f"{child.metadata['parent_article']} - {child.page_content}"
-                child.metadata['doc_id'] = id
-                docs.append(child)
+        full_docs = [(str(uuid.uuid4()), doc) for doc in documents]
+        # One call for all documents, so batching splitters embed across them. Chunks copy the
+        # metadata of their parent, doc_id included
+        parents = [
+            Document(page_content=doc.page_content, metadata={**doc.metadata, 'doc_id': id})
+            for id, doc in full_docs
+        ]
+        if self.chunk_embeddings is not None:
+            docs, vectors = self.child_splitter.split_documents_with_embeddings(parents)
+        else:
+            docs = self.child_splitter.split_documents(parents)
+        for child in docs:
+            if not child.page_content.startswith(f"{child.metadata['parent_article']} - "):
+                child.page_content = f"{child.metadata['parent_article']} - {child.page_content}"
+        if self.chunk_embeddings is not None:
+            # Keyed by the final chunk text, which is what the vectorstore embeds
+            self.chunk_embeddings.remember([child.page_content for child in docs], vectors)
         if save:
-            self.save_txt(full_docs, f'{save_prefix}_full_docs')
-            self.save_txt(docs, f'{save_prefix}_docs')
+            self.save_records(full_docs, f'{save_prefix}_full_docs{suffix}')
+            self.save_records(((None, doc) for doc in docs), f'{save_prefix}_docs{suffix}')
         return docs, full_docs
 
-    def add_documents(self, documents):
-        docs, full_docs = self._split_docs_for_adding(documents)
-        self.vectorstore.add_documents(docs)
-        self.docstore.mset(full_docs)
\ No newline at end of file
+    def _check_writable(self) -> None:
+        # Before any splitting or docstore write, so a read-only vectorstore leaves nothing half done
+        if getattr(self.vectorstore, 'read_only', False):
+            raise NotImplementedError(getattr(
+                self.vectorstore, 'READ_ONLY_MESSAGE', f"{type(self.vectorstore).__name__} is read only"
+            ))
+
+    def add_documents(self, documents, save=True) -> list[str]:
+        self._check_writable()
+        with METRICS.span("add.split"):
+            docs, full_docs = self._split_docs_for_adding(documents, save=save)
+        # Embeds the chunks, unless their pooled vectors are cached
+        with METRICS.span("add.vectorstore"):
+            self.vectorstore.add_documents(docs)
+        with METRICS.span("add.docstore"):
+            self.docstore.mset(full_docs)
+        if self.lexical_index is not None:
+            with METRICS.span("add.lexical_index"):
+                self.lexical_index.add(full_docs)
+        METRICS.count("add.parents", len(full_docs))
+        METRICS.count("add.chunks", len(docs))
+        return [id for id, _ in full_docs]
+
+    def delete_documents(self, parent_ids: list[str]) -> None:
+        """Removes parent documents and all of their child chunks."""
+        if not parent_ids:
+            return
+        self._check_writable()
+        children = self.vectorstore.get(where={self.id_key: {"$in": parent_ids}})
+        if children['ids']:
+            self.vectorstore.delete(ids=children['ids'])
+        self.docstore.mdelete(parent_ids)
+        if self.lexical_index is not None:
+            self.lexical_index.delete(parent_ids)
+
+    def _vector_ids(self, query: str) -> dict[str, Optional[float]]:
+        # The parent ids of the closest chunks, in the order MultiVectorRetriever returns them, with the
+        # distance of their closest chunk when the search reports it
+        if self.search_type == SearchType.mmr:
+            hits = [(d, None) for d in self.vectorstore.max_marginal_relevance_search(query, **self.search_kwargs)]
+        elif self.search_type == SearchType.similarity_score_threshold:
+            hits = [(d, None) for d, _ in self.vectorstore.similarity_search_with_relevance_scores(query, **self.search_kwargs)]
+        else:
+            hits = self.vectorstore.similarity_search_with_score(query, **self.search_kwargs)
+        return self._parent_distances((d.metadata, distance) for d, distance in hits)
+
+    def _parent_distances(self, hits: Iterable[tuple[dict, Optional[float]]]) -> dict[str, Optional[float]]:
+        ids = {}
+        for metadata, distance in hits:
+            if self.id_key in metadata and metadata[self.id_key] not in ids:
+                ids[metadata[self.id_key]] = distance
+        return ids
+
+    def _with_distances(self, docs: list[Optional[Document]], distances: dict[str, Optional[float]]) -> list[Document]:
+        # Copies, the docstore may hand out the documents it caches. Parents are stamped with their id,
+        # which ContextPacker dedupes on, and rerankers can skip queries whose closest parent is clearly
+        # ahead, see BatchedFlashrankRerank.skip_margin
+        return [
+            Document(page_content=d.page_content, metadata={
+                **d.metadata, self.id_key: id, **({"vector_distance": distance} if distance is not None else {})
+            })
+            for d, (id, distance) in zip(docs, distances.items()) if d is not None
+        ]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list[Document]:
+        if self.retrieval_mode != "lexical":
+            # Embeds the query, unless it is cached
+            with METRICS.span("retrieve.vector_search"):
+                vector_ids = self._vector_ids(query)
+        if self.retrieval_mode != "vector":
+            # Entity lookups like "Kaladin's spren" match exact terms, no embedding call needed
+            with METRICS.span("retrieve.lexical_search"):
+                lexical_ids = [key for key, _ in self.lexical_index.search(query, k=self.search_kwargs.get('k', 4))]
+        with METRICS.span("retrieve.docstore"):
+            if self.retrieval_mode == "vector":
+                docs = self._with_distances(self.docstore.mget(list(vector_ids)), vector_ids)
+            else:
+                ids = lexical_ids if self.retrieval_mode == "lexical" else reciprocal_rank_fusion([list(vector_ids), lexical_ids], k=self.rrf_k)
+                # Fused and BM25 rankings have no vector distances
+                docs = self._with_distances(self.docstore.mget(ids), dict.fromkeys(ids))
+        METRICS.count("retrieve.documents", len(docs))
+        return docs
+
+    def _vector_ids_batch(self, query_vectors: list[list[float]]) -> list[dict[str, Optional[float]]]:
+        # The parent ids of the closest chunks of every query vector, one collection query for all of them
+        k = self.search_kwargs.get('k', 4)
+        collection = getattr(self.vectorstore, '_collection', None)
+        if collection is not None:
+            results = collection.query(
+                query_embeddings=query_vectors, n_results=k,
+                where=self.search_kwargs.get('filter'), include=['metadatas', 'distances']
+            )
+            hits = [zip(metadatas, distances) for metadatas, distances in zip(results['metadatas'], results['distances'])]
+        elif hasattr(self.vectorstore, 'similarity_search_with_score_by_vectors'):
+            # e.g. CompactVectorStore, which searches all query vectors at once
+            hits = [
+                [(d.metadata, distance) for d, distance in query_hits]
+                for query_hits in self.vectorstore.similarity_search_with_score_by_vectors(query_vectors, **self.search_kwargs)
+            ]
+        elif hasattr(self.vectorstore, 'similarity_search_with_score_by_vector'):
+            hits = [
+                [(d.metadata, distance) for d, distance in self.vectorstore.similarity_search_with_score_by_vector(vector, **self.search_kwargs)]
+                for vector in query_vectors
+            ]
+        else:
+            hits = [
+                [(d.metadata, None) for d in self.vectorstore.similarity_search_by_vector(vector, **self.search_kwargs)]
+                for vector in query_vectors
+            ]
+        return [self._parent_distances(query_hits) for query_hits in hits]
+
+    def batch_relevant_documents(
+            self,
+            queries: Sequence[str],
+            query_vectors: Optional[list[list[float]]] = None
+        ) -> list[list[Document]]:
+        """
+        Retrieves the parents of many queries at once, with one vectorstore query for all of them and
+        one docstore read.
+
+        Args:
+            queries (Sequence[str]): The queries.
+            query_vectors (list[list[float]], optional): The embedded queries. Embedded in one call
+                when not given and the retrieval mode needs them.
+
+        Returns:
+            list[list[Document]]: The parents of every query, as `invoke` would return them.
+        """
+        if self.search_type != SearchType.similarity:
+            # MMR and score thresholds are per query in langchain
+            return [self.invoke(query) for query in queries]
+        k = self.search_kwargs.get('k', 4)
+        rankings = [{} for _ in queries]
+        if self.retrieval_mode != "lexical":
+            with METRICS.span("retrieve.vector_search"):
+                if query_vectors is None:
+                    embeddings = self.vectorstore.embeddings
+                    query_vectors = (embeddings.embed_queries(list(queries)) if hasattr(embeddings, 'embed_queries')
+                                     else [embeddings.embed_query(query) for query in queries])
+                rankings = self._vector_ids_batch(query_vectors)
+        if self.retrieval_mode != "vector":
+            with METRICS.span("retrieve.lexical_search"):
+                lexical = [[key for key, _ in self.lexical_index.search(query, k=k)] for query in queries]
+            # Fused and BM25 rankings have no vector distances
+            if self.retrieval_mode == "lexical":
+                rankings = [dict.fromkeys(ranking) for ranking in lexical]
+            else:
+                rankings = [dict.fromkeys(reciprocal_rank_fusion([list(v), l], k=self.rrf_k)) for v, l in zip(rankings, lexical)]
+        ids = list(dict.fromkeys(id for ranking in rankings for id in ranking))
+        with METRICS.span("retrieve.docstore"):
+            parents = dict(zip(ids, self.docstore.mget(ids)))
+        results = [self._with_distances([parents[id] for id in ranking], ranking) for ranking in rankings]
+        METRICS.count("retrieve.documents", sum(len(docs) for docs in results))
+        return results
+
+    async def _aget_relevant_documents(
+            self,
+            query: str,
+            *,
+            run_manager: AsyncCallbackManagerForRetrieverRun
+        ) -> list[Document]:
+        # The sync path in every mode, so async callers get the same documents, with their vector
+        # distances, as perform_rag. The vectorstore and lexical index are synchronous, keep them off the event loop
+        return await run_in_executor(
+            None, self._get_relevant_documents, query, run_manager=run_manager.get_sync()
+        )
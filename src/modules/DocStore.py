@@ -0,0 +1,122 @@
+# Disk-backed parent document store for CustomParentDocRetriever
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Iterator, Optional, Sequence
+
+from langchain_core.documents import Document
+from langchain_core.stores import BaseStore
+
+from modules.utils import json_dumps, json_loads
+
+DOCSTORE_FILE = Path(__file__).parent.parent / "docstore.sqlite"
+
+
+class SQLiteDocStore(BaseStore[str, Document]):
+    """
+    Stores parent documents in SQLite and loads them lazily.
+
+    Only the parents a query hits are read from disk, and the most recently used
+    ones are kept in an LRU cache. Opened with `read_only=True`, any number of
+    worker processes can share one file while a single writer updates it.
+    """
+    def __init__(self, path: Path = DOCSTORE_FILE, read_only: bool = False, cache_size: int = 1024) -> None:
+        """
+        Constructor for SQLiteDocStore class.
+
+        Args:
+            path (Path): Path to the SQLite file.
+            read_only (bool, optional): Open the file read only, e.g. in query workers. Defaults to False.
+            cache_size (int, optional): The number of parent documents kept in memory. Defaults to 1024.
+
+        Returns:
+            None
+        """
+        self.path = Path(path)
+        self.read_only = read_only
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        if read_only:
+            self.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.executescript(
+                """
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, document BLOB);
+                """
+            )
+        self._data_version = None
+        self._writes = 0
+
+    def _remember(self, key: str, document: Document) -> None:
+        self._cache[key] = document
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def mget(self, keys: Sequence[str]) -> list[Optional[Document]]:
+        with self._lock:
+            # data_version changes when another connection commits, drop what may be stale
+            (data_version,) = self.db.execute("PRAGMA data_version").fetchone()
+            if data_version != self._data_version:
+                self._cache.clear()
+                self._data_version = data_version
+            found = {}
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    found[key] = self._cache[key]
+            missing = list({key for key in keys if key not in found})
+            for i in range(0, len(missing), 500):
+                chunk = missing[i:i + 500]
+                rows = self.db.execute(
+                    f"SELECT id, document FROM documents WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                )
+                for key, blob in rows:
+                    data = json_loads(blob)
+                    found[key] = Document(page_content=data["page_content"], metadata=data["metadata"])
+                    self._remember(key, found[key])
+        return [found.get(key) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, Document]]) -> None:
+        rows = [
+            (key, json_dumps({"page_content": document.page_content, "metadata": document.metadata}))
+            for key, document in key_value_pairs
+        ]
+        with self._lock:
+            self.db.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?)", rows)
+            self.db.commit()
+            self._writes += 1
+            for key, _ in rows:
+                self._cache.pop(key, None)
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        with self._lock:
+            self.db.executemany("DELETE FROM documents WHERE id = ?", [(key,) for key in keys])
+            self.db.commit()
+            self._writes += 1
+            for key in keys:
+                self._cache.pop(key, None)
+
+    def version(self) -> tuple[int, int]:
+        """
+        Changes whenever documents are written, by this connection or by another process.
+        """
+        with self._lock:
+            (data_version,) = self.db.execute("PRAGMA data_version").fetchone()
+            return data_version, self._writes
+
+    def yield_keys(self, prefix: Optional[str] = None) -> Iterator[str]:
+        with self._lock:
+            if prefix:
+                # A plain comparison, LIKE would read % and _ in the prefix as wildcards
+                keys = self.db.execute(
+                    "SELECT id FROM documents WHERE substr(id, 1, length(?)) = ?", (prefix, prefix)
+                ).fetchall()
+            else:
+                keys = self.db.execute("SELECT id FROM documents").fetchall()
+        for (key,) in keys:
+            yield key
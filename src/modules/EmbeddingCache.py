@@ -0,0 +1,286 @@
+# Persistent embedding cache shared by Chroma, langchain and the semantic chunker
+import sqlite3
+import time
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from modules.Metrics import METRICS
+from modules.utils import estimate_tokens
+
+if TYPE_CHECKING:
+    from chromadb import Documents, EmbeddingFunction
+    from chromadb import Embeddings as ChromaEmbeddings
+
+CACHE_DIR = Path(__file__).parent.parent / "embedding_cache"
+
+
+class EmbeddingCache:
+    """
+    Caches embeddings on disk, keyed by (model name, text hash).
+
+    The index lives in SQLite and the vectors in one memory-mapped array per model,
+    so lookups only touch the rows they need and several processes can share the
+    vectors through the OS page cache. Once a model holds more than `max_entries`
+    vectors, the least recently used ones are evicted and their slots reused.
+    """
+    def __init__(self, cache_dir: Path = CACHE_DIR, max_entries: int = 1_000_000, dtype: str = "float32") -> None:
+        """
+        Constructor for EmbeddingCache class.
+
+        Args:
+            cache_dir (Path): Directory of the SQLite index and the vector files.
+            max_entries (int, optional): Maximum number of vectors kept per model. Defaults to 1,000,000.
+            dtype (str, optional): "float32", or "float16" to halve the size on disk. Defaults to "float32".
+
+        Returns:
+            None
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._arrays = {}
+
+        self.db = sqlite3.connect(self.cache_dir / "index.sqlite", check_same_thread=False)
+        self.db.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS models (model TEXT PRIMARY KEY, dim INTEGER, next_slot INTEGER);
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT, hash TEXT, slot INTEGER, last_used INTEGER, PRIMARY KEY (model, hash)
+            );
+            CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (model, last_used);
+            CREATE TABLE IF NOT EXISTS free_slots (model TEXT, slot INTEGER);
+            """
+        )
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return sha256(text.encode("utf-8")).hexdigest()
+
+    def _array(self, model: str, dim: int, size: int = 0) -> np.memmap:
+        """
+        Opens the vector file of a model, growing it to hold at least `size` vectors.
+        """
+        array = self._arrays.get(model)
+        if array is not None and array.shape[0] >= size:
+            return array
+        path = self.cache_dir / f"{sha256(model.encode('utf-8')).hexdigest()[:16]}.{self.dtype.name}"
+        row_bytes = dim * self.dtype.itemsize
+        current = path.stat().st_size // row_bytes if path.exists() else 0
+        if current < size:
+            # Grow geometrically so appends stay cheap
+            with open(path, "ab") as file:
+                file.truncate(max(size, 2 * current, 1024) * row_bytes)
+            current = path.stat().st_size // row_bytes
+        array = np.memmap(path, dtype=self.dtype, mode="r+", shape=(current, dim))
+        self._arrays[model] = array
+        return array
+
+    def get_many(self, model: str, texts: list[str]) -> list[Optional[np.ndarray]]:
+        """
+        Looks up the cached embeddings of `texts`.
+
+        Args:
+            model (str): The embedding model name.
+            texts (list[str]): The texts to look up.
+
+        Returns:
+            list[Optional[np.ndarray]]: The embedding of every text, or None when it is not cached.
+        """
+        hashes = [self.text_hash(text) for text in texts]
+        with self._lock:
+            row = self.db.execute("SELECT dim FROM models WHERE model = ?", (model,)).fetchone()
+            if row is None:
+                self.misses += len(texts)
+                return [None] * len(texts)
+            slots = {}
+            unique = list(set(hashes))
+            for i in range(0, len(unique), 500):
+                chunk = unique[i:i + 500]
+                slots.update(self.db.execute(
+                    f"SELECT hash, slot FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})",
+                    (model, *chunk),
+                ).fetchall())
+            if slots:
+                now = time.time_ns()
+                self.db.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                    [(now, model, text_hash) for text_hash in slots],
+                )
+                self.db.commit()
+            # Another process may have grown the file since it was opened
+            array = self._array(model, row[0], max(slots.values(), default=-1) + 1)
+            vectors = [np.array(array[slots[h]], dtype=np.float32) if h in slots else None for h in hashes]
+        found = sum(vector is not None for vector in vectors)
+        self.hits += found
+        self.misses += len(texts) - found
+        return vectors
+
+    def put_many(self, model: str, texts: list[str], vectors: list) -> None:
+        """
+        Stores the embeddings of `texts`, evicting the least recently used ones past `max_entries`.
+
+        Args:
+            model (str): The embedding model name.
+            texts (list[str]): The embedded texts.
+            vectors (list): The embedding of every text.
+
+        Returns:
+            None
+        """
+        entries = dict(zip((self.text_hash(text) for text in texts), vectors))
+        if not entries:
+            return
+        dim = len(next(iter(entries.values())))
+        with self._lock:
+            self.db.execute("INSERT OR IGNORE INTO models VALUES (?, ?, 0)", (model, dim))
+            known = set()
+            hashes = list(entries)
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                known.update(h for (h,) in self.db.execute(
+                    f"SELECT hash FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})",
+                    (model, *chunk),
+                ))
+            new = [h for h in hashes if h not in known]
+            if not new:
+                self.db.commit()
+                return
+
+            # Reuse evicted slots first, then append
+            free = [slot for (slot,) in self.db.execute(
+                "SELECT slot FROM free_slots WHERE model = ? LIMIT ?", (model, len(new))
+            )]
+            self.db.executemany("DELETE FROM free_slots WHERE model = ? AND slot = ?", [(model, s) for s in free])
+            (next_slot,) = self.db.execute("SELECT next_slot FROM models WHERE model = ?", (model,)).fetchone()
+            appended = list(range(next_slot, next_slot + len(new) - len(free)))
+            slots = free + appended
+            array = self._array(model, dim, next_slot + len(appended))
+            array[slots] = np.asarray([entries[h] for h in new], dtype=self.dtype)
+            array.flush()
+
+            now = time.time_ns()
+            self.db.executemany(
+                "INSERT INTO embeddings VALUES (?, ?, ?, ?)", [(model, h, s, now) for h, s in zip(new, slots)]
+            )
+            self.db.execute("UPDATE models SET next_slot = ? WHERE model = ?", (next_slot + len(appended), model))
+            self._evict(model)
+            self.db.commit()
+
+    def _evict(self, model: str) -> None:
+        (count,) = self.db.execute("SELECT COUNT(*) FROM embeddings WHERE model = ?", (model,)).fetchone()
+        if count <= self.max_entries:
+            return
+        evicted = self.db.execute(
+            "SELECT hash, slot FROM embeddings WHERE model = ? ORDER BY last_used LIMIT ?",
+            (model, count - self.max_entries),
+        ).fetchall()
+        self.db.executemany("DELETE FROM embeddings WHERE model = ? AND hash = ?", [(model, h) for h, _ in evicted])
+        self.db.executemany("INSERT INTO free_slots VALUES (?, ?)", [(model, s) for _, s in evicted])
+
+    def embed(self, model: str, texts: list[str], embed_fn: Callable[[list[str]], list]) -> list[list[float]]:
+        """
+        Returns the embeddings of `texts`, calling `embed_fn` only for the texts that are not cached.
+
+        Args:
+            model (str): The embedding model name.
+            texts (list[str]): The texts to embed.
+            embed_fn (Callable[[list[str]], list]): Embeds a list of texts.
+
+        Returns:
+            list[list[float]]: The embedding of every text.
+        """
+        vectors = self.get_many(model, texts)
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        METRICS.count("embeddings.cache_hits", len(texts) - len(missing))
+        if missing:
+            if METRICS.enabled:
+                METRICS.count("embeddings.texts_sent", len(missing))
+                METRICS.count("embeddings.tokens_sent", sum(estimate_tokens(text) for text in missing))
+            with METRICS.span("embeddings.call"):
+                computed = dict(zip(missing, embed_fn(missing)))
+            self.put_many(model, list(computed), list(computed.values()))
+            vectors = [computed[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return [list(map(float, vector)) for vector in vectors]
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters of this process and the number of cached vectors per model.
+        """
+        with self._lock:
+            entries = dict(self.db.execute("SELECT model, COUNT(*) FROM embeddings GROUP BY model"))
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+        }
+
+
+def model_name(embeddings, default: str = "default") -> str:
+    """
+    Best effort name of the model behind a langchain embeddings object or Chroma embedding function.
+    """
+    for attribute in ("model", "model_name", "_model_name"):
+        name = getattr(embeddings, attribute, None)
+        if isinstance(name, str):
+            return name
+    return default
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Langchain embeddings that go through an EmbeddingCache before the wrapped embeddings.
+    """
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model: str = None) -> None:
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model or model_name(embeddings)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.cache.embed(self.model, texts, self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> list[float]:
+        # Some models embed queries differently, keep them apart from documents
+        return self.cache.embed(f"{self.model}:query", [text], lambda texts: [self.embeddings.embed_query(texts[0])])[0]
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embeds many queries with one call for the ones that are not cached, sharing the cache of `embed_query`.
+
+        The call goes through the batched `embed_documents` of the wrapped embeddings, which matches
+        `embed_query` for the OpenAI and sentence-transformers models used here.
+        """
+        return self.cache.embed(f"{self.model}:query", texts, self.embeddings.embed_documents)
+
+    def remember(self, texts: list[str], vectors: list) -> None:
+        """
+        Stores vectors computed elsewhere, e.g. pooled by a chunker, as the embeddings of `texts`.
+        """
+        self.cache.put_many(self.model, texts, vectors)
+
+
+class CachedEmbeddingFunction:
+    """
+    A Chroma embedding function that goes through an EmbeddingCache before the wrapped function.
+
+    Chroma's EmbeddingFunction is a protocol, so this only matches its `__call__` signature
+    and importing the cache does not import chromadb.
+    """
+    def __init__(self, embedding_function: "EmbeddingFunction", cache: EmbeddingCache, model: str = None) -> None:
+        self.embedding_function = embedding_function
+        self.cache = cache
+        self.model = model or model_name(embedding_function)
+
+    def __call__(self, input: "Documents") -> "ChromaEmbeddings":
+        return self.cache.embed(self.model, list(input), self.embedding_function)
@@ -0,0 +1,285 @@
+# Keyword extraction for paragraph metadata, batched and cached through the LLM or offline
+import json
+import logging
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+from typing import Any, Callable, Optional
+
+import numpy as np
+
+from modules.utils import batched
+
+KEYWORD_CACHE = Path(__file__).parent.parent / "keyword_cache.sqlite"
+
+PROMPT = """
+    For the following paragraph, extract a list of keywords that will be used as metadata when the paragraph is stored in a vector database. The keywords will be used to help return accurate results when the database is queried. the list must look like this "keyword1, keyword 2, keyword 3, ..."
+
+    Here is the paragraph:
+    ```
+    {content}
+    ```
+    """
+
+BATCH_PROMPT = """
+    For each of the following paragraphs, extract a list of keywords that will be used as metadata when the paragraph is stored in a vector database. The keywords will be used to help return accurate results when the database is queried.
+
+    Answer with only a JSON object that maps every paragraph id to its keywords, as one string that looks like this "keyword1, keyword 2, keyword 3, ...". For example: {{"0": "keyword1, keyword 2", "1": "keyword3, keyword 4"}}
+
+    Here are the paragraphs:
+    {paragraphs}
+    """
+
+
+class KeywordExtractor:
+    """
+    Extracts keywords for many paragraphs per LLM call and caches them by content hash.
+
+    The cache file is opened, and created, on the first extraction.
+    """
+    def __init__(
+        self,
+        call: Callable[[str], Any],
+        cache_file: Path = KEYWORD_CACHE,
+        batch_size: int = 20,
+        max_workers: int = 4
+    ) -> None:
+        """
+        Constructor for KeywordExtractor class.
+
+        Args:
+            call (Callable[[str], Any]): Sends a prompt to the LLM, e.g. VectorDBManager.call_prompt_in_rate.
+                Its rate limit also caps the concurrent calls made here.
+            cache_file (Path, optional): The SQLite file keywords are persisted in.
+            batch_size (int, optional): The number of paragraphs packed in one prompt. Defaults to 20.
+            max_workers (int, optional): The number of prompts in flight. Defaults to 4.
+
+        Returns:
+            None
+        """
+        self.call = call
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.logger = logging.getLogger(__name__)
+        self.cache_file = cache_file
+        self._lock = Lock()
+
+    @cached_property
+    def db(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.cache_file, check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS keywords (hash TEXT PRIMARY KEY, keywords TEXT)")
+        return db
+
+    @staticmethod
+    def content_hash(content: str) -> str:
+        return sha256(content.encode("utf-8")).hexdigest()
+
+    def _prompt(self, prompt: str) -> str:
+        response = self.call(prompt)
+        # Gemini responses carry the generated text in .text
+        return getattr(response, "text", response)
+
+    @staticmethod
+    def _parse(text: str) -> dict:
+        """
+        Reads the JSON object out of a response, ignoring code fences or text around it.
+        """
+        start, end = text.find("{"), text.rfind("}")
+        if start == -1 or end == -1:
+            raise ValueError("No JSON object in response")
+        return json.loads(text[start:end + 1])
+
+    def _extract_one(self, content: str) -> Optional[str]:
+        try:
+            return self._prompt(PROMPT.format(content=content)).strip()
+        except Exception as e:
+            self.logger.error(f"Keyword extraction failed - {e}")
+            return None
+
+    def _extract_batch(self, contents: list[str]) -> dict[int, str]:
+        """
+        Extracts the keywords of a batch in one prompt, retrying paragraphs missing from the answer one by one.
+
+        Returns:
+            dict[int, str]: The keywords of every paragraph that succeeded, by position in `contents`.
+        """
+        paragraphs = "\n".join(f"[{i}]\n```\n{content}\n```" for i, content in enumerate(contents))
+        try:
+            parsed = self._parse(self._prompt(BATCH_PROMPT.format(paragraphs=paragraphs)))
+        except Exception as e:
+            self.logger.error(f"Batched keyword extraction failed, retrying paragraphs one by one - {e}")
+            parsed = {}
+
+        results = {}
+        for i, content in enumerate(contents):
+            keywords = parsed.get(str(i))
+            if isinstance(keywords, list):
+                keywords = ", ".join(map(str, keywords))
+            if not keywords:
+                keywords = self._extract_one(content)
+            if keywords:
+                results[i] = keywords
+        return results
+
+    def extract(self, contents: list[str]) -> list[str]:
+        """
+        Returns the keywords of every paragraph, from the cache when possible.
+
+        Paragraphs that could not be processed get an empty string and are retried on the next call.
+
+        Args:
+            contents (list[str]): The paragraphs.
+
+        Returns:
+            list[str]: The keywords of every paragraph, like "keyword1, keyword 2, keyword 3".
+        """
+        hashes = [self.content_hash(content) for content in contents]
+        with self._lock:
+            cached = {}
+            unique = list(set(hashes))
+            for i in range(0, len(unique), 500):
+                chunk = unique[i:i + 500]
+                cached.update(self.db.execute(
+                    f"SELECT hash, keywords FROM keywords WHERE hash IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall())
+
+        todo = list({h: content for h, content in zip(hashes, contents) if h not in cached}.items())
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            batches = list(batched(todo, self.batch_size))
+            for batch, results in zip(batches, executor.map(self._extract_batch, [[c for _, c in b] for b in batches])):
+                found = {batch[i][0]: keywords for i, keywords in results.items()}
+                with self._lock:
+                    self.db.executemany("INSERT OR REPLACE INTO keywords VALUES (?, ?)", found.items())
+                    self.db.commit()
+                cached.update(found)
+        return [cached.get(h, "") for h in hashes]
+
+
+class StatisticalKeywordExtractor:
+    """
+    Extracts keywords offline by TF-IDF over the whole section corpus.
+
+    A drop in for KeywordExtractor.extract that needs no network: the corpus is
+    vectorized once into a sparse matrix and the highest weighted terms of every
+    row become its keywords. Like RAKE, phrases win over the single words they contain.
+
+    Call `fit` with every section of the corpus first, so document frequencies are
+    corpus-wide. Without it, every `extract` call is fitted on its own paragraphs.
+    """
+    def __init__(self, top_k: int = 10, ngram_range: tuple = (1, 2), min_df: int = 1, max_df: float = 0.5) -> None:
+        """
+        Constructor for StatisticalKeywordExtractor class.
+
+        Args:
+            top_k (int, optional): The number of keywords per paragraph. Defaults to 10.
+            ngram_range (tuple, optional): The lengths of the candidate phrases. Defaults to (1, 2).
+            min_df (int, optional): Ignore terms found in fewer paragraphs. Defaults to 1.
+            max_df (float, optional): Ignore terms found in a larger share of paragraphs. Defaults to 0.5.
+
+        Returns:
+            None
+        """
+        # Optional and slow to import, only loaded for the offline extractor
+        try:
+            from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS, TfidfVectorizer
+        except ImportError:
+            raise ImportError("scikit-learn is required for offline keyword extraction")
+        self.stop_words = ENGLISH_STOP_WORDS
+        self.top_k = top_k
+        self.ngram_range = ngram_range
+        self.min_df = min_df
+        self.max_df = max_df
+        self._vectorizer_class = TfidfVectorizer
+        self.vectorizer = None
+        self.terms = None
+        self.fitted = False
+
+    def candidates(self, text: str) -> list[str]:
+        """
+        Candidate keywords of a text: word n-grams that, like in RAKE, never span punctuation or stop words.
+        """
+        min_n, max_n = self.ngram_range
+        terms = []
+        for fragment in re.split(r"[^\w\s'-]+", text.lower()):
+            run = []
+            for word in re.findall(r"\w[\w'-]*", fragment) + [None]:
+                if word is not None and word not in self.stop_words and not word.isdigit():
+                    run.append(word)
+                    continue
+                for n in range(min_n, max_n + 1):
+                    terms.extend(" ".join(run[i:i + n]) for i in range(len(run) - n + 1))
+                run = []
+        return terms
+
+    def _fit(self, corpus: list[str]):
+        # A fraction max_df of a small corpus can fall under min_df and prune every term, so it is
+        # clamped to a document count of at least min_df
+        max_df = self.max_df
+        if isinstance(max_df, float):
+            max_df = max(self.min_df, int(max_df * len(corpus)))
+        vectorizer = self._vectorizer_class(analyzer=self.candidates, min_df=self.min_df, max_df=max_df, sublinear_tf=True)
+        try:
+            vectorizer.fit(corpus)
+        except ValueError:
+            # No candidate terms at all, e.g. paragraphs of stop words or numbers
+            return None, np.array([], dtype=object)
+        return vectorizer, vectorizer.get_feature_names_out()
+
+    def fit(self, corpus: list[str]) -> "StatisticalKeywordExtractor":
+        """
+        Learns the vocabulary and document frequencies, e.g. from every section of the corpus.
+        """
+        self.vectorizer, self.terms = self._fit(corpus)
+        self.fitted = True
+        return self
+
+    def extract(self, contents: list[str]) -> list[str]:
+        """
+        Returns the keywords of every paragraph.
+
+        Without a prior `fit`, the document frequencies come from `contents` alone. After one,
+        paragraphs with none of the fitted terms are fitted on their own instead of left empty.
+
+        Args:
+            contents (list[str]): The paragraphs.
+
+        Returns:
+            list[str]: The keywords of every paragraph, like "keyword1, keyword 2, keyword 3".
+        """
+        if not contents:
+            return []
+        if not self.fitted:
+            return self._keywords(contents, *self._fit(contents))
+        keywords = self._keywords(contents, self.vectorizer, self.terms)
+        unseen = [i for i, keyword in enumerate(keywords) if not keyword]
+        if unseen:
+            local = [contents[i] for i in unseen]
+            for i, keyword in zip(unseen, self._keywords(local, *self._fit(local))):
+                keywords[i] = keyword
+        return keywords
+
+    def _keywords(self, contents: list[str], vectorizer, terms) -> list[str]:
+        if vectorizer is None:
+            return [""] * len(contents)
+        matrix = vectorizer.transform(contents).tocsr()
+        keywords = []
+        for row in range(matrix.shape[0]):
+            start, end = matrix.indptr[row], matrix.indptr[row + 1]
+            columns, weights = matrix.indices[start:end], matrix.data[start:end]
+            # Over-select so phrases can replace the words they contain
+            order = np.argsort(-weights)[:self.top_k * 2]
+            chosen = []
+            for term in terms[columns[order]]:
+                words = term.split()
+                if len(words) == 1 and any(term in phrase.split() for phrase in chosen):
+                    continue
+                chosen = [keyword for keyword in chosen if keyword not in words]
+                chosen.append(term)
+                if len(chosen) == self.top_k:
+                    break
+            keywords.append(", ".join(chosen))
+        return keywords
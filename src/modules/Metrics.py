@@ -0,0 +1,127 @@
+# Timing spans and counters for the pipeline stages, exported as JSON or Prometheus text
+import re
+import timeit
+from collections import deque
+from contextlib import nullcontext
+from os import environ
+from threading import Lock
+
+import numpy as np
+
+_DISABLED = nullcontext()
+
+
+class _Span:
+    __slots__ = ("metrics", "name", "start_time")
+
+    def __init__(self, metrics: "Metrics", name: str) -> None:
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self) -> "_Span":
+        self.start_time = timeit.default_timer()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.metrics.observe(self.name, timeit.default_timer() - self.start_time)
+
+
+class Metrics:
+    """
+    Timing spans and counters of the pipeline stages, shared by the whole process.
+
+    Disabled unless the KB_CHAT_METRICS environment variable is 1. While disabled, `span`
+    returns one shared no-op context manager and `count` returns at once, so instrumented
+    code only pays a method call. A span keeps its count, sum and maximum and its last
+    `reservoir` durations for quantiles.
+    """
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, enabled: bool = False, reservoir: int = 2048) -> None:
+        self.enabled = enabled
+        self.reservoir = reservoir
+        self._lock = Lock()
+        self.spans = {}
+        self.counters = {}
+
+    def enable(self) -> None:
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self.spans = {}
+            self.counters = {}
+
+    def span(self, name: str):
+        """
+        Times the block as `name`, e.g. `with METRICS.span("rag.llm"):`.
+        """
+        if not self.enabled:
+            return _DISABLED
+        return _Span(self, name)
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            span = self.spans.get(name)
+            if span is None:
+                span = self.spans[name] = {"count": 0, "sum": 0.0, "max": 0.0, "samples": deque(maxlen=self.reservoir)}
+            span["count"] += 1
+            span["sum"] += seconds
+            span["max"] = max(span["max"], seconds)
+            span["samples"].append(seconds)
+
+    def count(self, name: str, value: float = 1) -> None:
+        """
+        Adds `value` to the counter `name`, e.g. tokens sent or documents retrieved.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_json(self) -> dict:
+        """
+        Every span with its count, total and mean, max and quantile milliseconds, and every counter.
+        """
+        with self._lock:
+            spans = {name: (span["count"], span["sum"], span["max"], list(span["samples"])) for name, span in self.spans.items()}
+            counters = dict(self.counters)
+        report = {}
+        for name, (count, total, maximum, samples) in sorted(spans.items()):
+            quantiles = np.quantile(samples, self.QUANTILES) * 1000
+            report[name] = {
+                "count": count,
+                "total_seconds": round(total, 6),
+                "mean_ms": round(total / count * 1000, 3),
+                "max_ms": round(maximum * 1000, 3),
+                **{f"p{round(q * 100)}_ms": round(float(value), 3) for q, value in zip(self.QUANTILES, quantiles)},
+            }
+        return {"spans": report, "counters": dict(sorted(counters.items()))}
+
+    def to_prometheus(self, prefix: str = "kbchat") -> str:
+        """
+        The spans as one summary, labelled by span name, and every counter, in the Prometheus text format.
+        """
+        with self._lock:
+            spans = {name: (span["count"], span["sum"], list(span["samples"])) for name, span in self.spans.items()}
+            counters = dict(self.counters)
+        lines = [
+            f"# HELP {prefix}_span_seconds Time spent in a pipeline stage.",
+            f"# TYPE {prefix}_span_seconds summary",
+        ]
+        for name, (count, total, samples) in sorted(spans.items()):
+            for q, value in zip(self.QUANTILES, np.quantile(samples, self.QUANTILES)):
+                lines.append(f'{prefix}_span_seconds{{span="{name}",quantile="{q}"}} {value:.9g}')
+            lines.append(f'{prefix}_span_seconds_sum{{span="{name}"}} {total:.9g}')
+            lines.append(f'{prefix}_span_seconds_count{{span="{name}"}} {count}')
+        for name, value in sorted(counters.items()):
+            metric = f"{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {value:.9g}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics(enabled=environ.get("KB_CHAT_METRICS") == "1")
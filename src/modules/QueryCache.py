@@ -0,0 +1,187 @@
+# Exact and near-duplicate query cache for RAGPipeline.perform_rag
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable, Optional
+
+import numpy as np
+
+from modules.BM25Index import tokenize
+
+# Dropped from the key terms, so rewording a question keeps its terms
+QUESTION_WORDS = frozenset((
+    "a an and about are as at be by can could describe did do does explain for from how i in is it me of on or "
+    "please tell that the their them there they this to was were what when where which who whom whose why will with you"
+).split())
+
+
+def normalize_query(query: str) -> str:
+    """
+    Folds case, unicode forms, whitespace and trailing punctuation, so trivially different queries match.
+    """
+    query = unicodedata.normalize("NFKC", query).casefold()
+    return re.sub(r"\s+", " ", query).strip(" ?!.")
+
+
+def key_terms(query: str) -> frozenset:
+    """
+    The words of a query that name what it asks about, e.g. {"kaladin", "spren"} for "Who is Kaladin's spren?".
+    """
+    return frozenset(token for token in tokenize(unicodedata.normalize("NFKC", query)) if token not in QUESTION_WORDS)
+
+
+class QueryCache:
+    """
+    Caches the retrieved documents and answer of a query at two levels.
+
+    The first level matches the normalized query exactly. The second level is off unless
+    a `threshold` is given: on a miss it then embeds the query and matches a cached query
+    whose embedding has a cosine similarity of at least `threshold` and that has the same
+    key terms, as embeddings of questions about different entities are often just as close,
+    e.g. "Who is Kaladin's father?" and "Who is Shallan's father?". On the entity-swap pairs of
+    benchmarks.query_cache, similarity alone falsely hit 1% of them at 0.95 and 15% at 0.9, and
+    none with the key term check, which kept every paraphrase hit. Entries expire after `ttl` seconds, the least
+    recently used are evicted past `max_entries`, and everything is dropped when
+    `version()` changes, e.g. because documents were added to or deleted from the index.
+    """
+    def __init__(
+        self,
+        embed_query: Optional[Callable[[str], list]] = None,
+        version: Optional[Callable[[], Hashable]] = None,
+        threshold: Optional[float] = None,
+        ttl: float = 3600,
+        max_entries: int = 1024
+    ) -> None:
+        """
+        Constructor for QueryCache class.
+
+        Args:
+            embed_query (Callable[[str], list], optional): Embeds a query for the near-duplicate level,
+                e.g. the vectorstore's embed_query.
+            version (Callable[[], Hashable], optional): Returns a value that changes whenever the index
+                changes, e.g. SQLiteDocStore.version.
+            threshold (float, optional): The cosine similarity a near-duplicate needs, e.g. 0.95. Defaults to
+                None, only exact matches hit.
+            ttl (float, optional): Seconds an entry stays valid. Defaults to 3600.
+            max_entries (int, optional): The number of entries kept. Defaults to 1024.
+
+        Returns:
+            None
+        """
+        self.embed_query = embed_query
+        self.version = version
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self._version = version() if version is not None else None
+        self._matrix = None
+        self.counters = dict.fromkeys(
+            ("exact_hits", "semantic_hits", "misses", "evictions", "expirations", "invalidations"), 0
+        )
+
+    def _check_version(self) -> None:
+        if self.version is None:
+            return
+        version = self.version()
+        if version != self._version:
+            if self._entries:
+                self.counters["invalidations"] += 1
+            self._entries.clear()
+            self._matrix = None
+            self._version = version
+
+    def _embed(self, query: str) -> Optional[np.ndarray]:
+        if self.embed_query is None or self.threshold is None:
+            return None
+        vector = np.asarray(self.embed_query(query), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _live(self, key: str, now: float) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is not None and now - entry["created"] > self.ttl:
+            del self._entries[key]
+            self._matrix = None
+            self.counters["expirations"] += 1
+            return None
+        return entry
+
+    def get(self, query: str) -> Optional[tuple[list, Any]]:
+        """
+        Looks up a query.
+
+        Args:
+            query (str): The query.
+
+        Returns:
+            Optional[tuple[list, Any]]: The cached documents and answer, or None on a miss.
+        """
+        key = normalize_query(query)
+        terms = key_terms(query)
+        with self._lock:
+            self._check_version()
+            now = time.monotonic()
+            entry = self._live(key, now)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.counters["exact_hits"] += 1
+                return entry["docs"], entry["answer"]
+        # Embedding may be a network call, keep it outside the lock
+        vector = self._embed(query)
+        with self._lock:
+            if vector is not None and self._entries:
+                if self._matrix is None:
+                    self._matrix = (list(self._entries), np.stack([e["vector"] for e in self._entries.values()]))
+                keys, matrix = self._matrix
+                similarities = matrix @ vector
+                close = np.flatnonzero(similarities >= self.threshold)
+                for i in close[np.argsort(-similarities[close])]:
+                    if self._entries.get(keys[i], {}).get("terms") != terms:
+                        continue
+                    entry = self._live(keys[i], now)
+                    if entry is not None:
+                        self._entries.move_to_end(keys[i])
+                        self.counters["semantic_hits"] += 1
+                        return entry["docs"], entry["answer"]
+                    break
+            self.counters["misses"] += 1
+            return None
+
+    def put(self, query: str, docs: list, answer: Any) -> None:
+        """
+        Caches the documents retrieved for a query and its answer.
+        """
+        key = normalize_query(query)
+        vector = self._embed(query)
+        with self._lock:
+            self._check_version()
+            self._entries[key] = {
+                "docs": docs, "answer": answer, "vector": vector, "terms": key_terms(query), "created": time.monotonic()
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+            self._matrix = None
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    def stats(self) -> dict:
+        """
+        Returns the hit, miss and eviction counters, the hit rate of every level and the number of entries.
+        """
+        lookups = self.counters["exact_hits"] + self.counters["semantic_hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "exact_hit_rate": self.counters["exact_hits"] / lookups if lookups else 0.0,
+            "semantic_hit_rate": self.counters["semantic_hits"] / lookups if lookups else 0.0,
+            "hit_rate": (lookups - self.counters["misses"]) / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+        }
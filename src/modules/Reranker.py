@@ -0,0 +1,245 @@
+# Flashrank reranking of the candidates of many queries per model run
+from collections import OrderedDict
+from functools import lru_cache
+from hashlib import blake2b
+from threading import Lock
+from typing import Optional, Sequence
+
+import numpy as np
+from langchain.retrievers.document_compressors import FlashrankRerank
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import Document
+from pydantic import PrivateAttr
+
+from modules.Metrics import METRICS
+
+DEFAULT_MODEL_NAME = "ms-marco-MultiBERT-L-12"
+
+
+@lru_cache(maxsize=None)
+def shared_ranker(model_name: str = DEFAULT_MODEL_NAME):
+    """
+    One flashrank Ranker per model for the whole process, loaded on first use.
+    """
+    from flashrank import Ranker
+    return Ranker(model_name=model_name)
+
+
+class _ScoreRequest:
+    __slots__ = ("pairs", "scores", "error", "done")
+
+    def __init__(self, pairs: list[list[str]]) -> None:
+        self.pairs = pairs
+        self.scores = None
+        self.error = None
+        self.done = False
+
+
+class BatchedFlashrankRerank(FlashrankRerank):
+    """
+    A FlashrankRerank that scores the (query, document) pairs of many queries together.
+
+    Pairs go through the cross-encoder in batches of `batch_size`, however many queries
+    they come from, and each query keeps its `top_n` like FlashrankRerank. Scores match
+    per-query reranking up to float rounding, as padding differs between batches.
+    Listwise (LLM) rankers cannot mix queries and are run one query at a time.
+
+    Queries reranked from several threads at once share model runs: while one run is in
+    progress, the pairs of the queries that arrive queue up and go through the next run
+    together, so an idle reranker adds no wait. Scores are cached per (query, document),
+    only the first `max_candidates` candidates of a query are scored, and a query whose
+    closest parent leads the next by `skip_margin` keeps its vector order without a run.
+    """
+    batch_size: int = 256
+    """Number of query-document pairs per model run."""
+    max_candidates: Optional[int] = None
+    """Number of candidates scored per query, in retrieval order. All of them when None."""
+    skip_margin: Optional[float] = None
+    """Relative vector distance lead of the closest candidate over the next that skips reranking,
+        e.g. 0.2 when it is 20% closer. Needs the vector_distance the parent retriever sets in
+        vector mode, and skipped queries keep their vector order without a relevance_score.
+        Never skips when None."""
+    share_runs: bool = True
+    """Score the pairs of queries reranked from several threads at once in shared model runs."""
+    score_cache_size: int = 8192
+    """Number of (query, document) scores kept, least recently used evicted first. 0 disables it."""
+
+    _score_cache: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    _cache_lock: Lock = PrivateAttr(default_factory=Lock)
+    _queue: list = PrivateAttr(default_factory=list)
+    _queue_lock: Lock = PrivateAttr(default_factory=Lock)
+    _run_lock: Lock = PrivateAttr(default_factory=Lock)
+
+    @classmethod
+    def shared(cls, model: str = DEFAULT_MODEL_NAME, warm_up: bool = True, **kwargs) -> "BatchedFlashrankRerank":
+        """
+        A reranker over the process-wide Ranker of `model`, see `shared_ranker`.
+
+        Args:
+            model (str, optional): The flashrank model. Defaults to DEFAULT_MODEL_NAME.
+            warm_up (bool, optional): Score a pair now, so the first query does not pay for
+                the ONNX session to settle. Defaults to True.
+            **kwargs: Fields of the reranker, e.g. top_n or skip_margin.
+
+        Returns:
+            BatchedFlashrankRerank: The reranker.
+        """
+        reranker = cls(client=shared_ranker(model), model=model, **kwargs)
+        if warm_up and getattr(reranker.client, "llm_model", None) is None:
+            reranker._run([["warm up", "warm up"]])
+        return reranker
+
+    def _run(self, pairs: list[list[str]]) -> np.ndarray:
+        # The pairwise path of flashrank.Ranker.rerank, for pairs of any number of queries
+        scores = []
+        for i in range(0, len(pairs), self.batch_size):
+            encoded = self.client.tokenizer.encode_batch(pairs[i:i + self.batch_size])
+            input_ids = np.array([e.ids for e in encoded])
+            token_type_ids = np.array([e.type_ids for e in encoded])
+            attention_mask = np.array([e.attention_mask for e in encoded])
+            onnx_input = {"input_ids": input_ids.astype(np.int64), "attention_mask": attention_mask.astype(np.int64)}
+            if not np.all(token_type_ids == 0):
+                onnx_input["token_type_ids"] = token_type_ids.astype(np.int64)
+            logits = self.client.session.run(None, onnx_input)[0]
+            if logits.shape[1] == 1:
+                scores.append(1 / (1 + np.exp(-logits.flatten())))
+            else:
+                exp_logits = np.exp(logits)
+                scores.append(exp_logits[:, 1] / np.sum(exp_logits, axis=1))
+        return np.concatenate(scores) if scores else np.array([])
+
+    def _run_shared(self, pairs: list[list[str]]) -> np.ndarray:
+        # Whoever gets the run lock scores everything queued so far, its own pairs included unless
+        # the previous holder already did
+        if not self.share_runs:
+            METRICS.count("rerank.runs")
+            return self._run(pairs)
+        request = _ScoreRequest(pairs)
+        with self._queue_lock:
+            self._queue.append(request)
+        with self._run_lock:
+            if not request.done:
+                with self._queue_lock:
+                    requests, self._queue = self._queue, []
+                METRICS.count("rerank.runs")
+                METRICS.count("rerank.batched_queries", len(requests))
+                try:
+                    scores = self._run([pair for r in requests for pair in r.pairs])
+                except Exception as e:
+                    scores = None
+                    for r in requests:
+                        r.error = e
+                offset = 0
+                for r in requests:
+                    if scores is not None:
+                        r.scores = scores[offset:offset + len(r.pairs)]
+                        offset += len(r.pairs)
+                    r.done = True
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    @staticmethod
+    def _key(pair: list[str]) -> bytes:
+        return blake2b(f"{pair[0]}\0{pair[1]}".encode("utf-8"), digest_size=16).digest()
+
+    def _score(self, pairs: list[list[str]]) -> np.ndarray:
+        """
+        The relevance score of every (query, passage) pair, from the cache or the model.
+        """
+        if not self.score_cache_size:
+            return self._run_shared(pairs) if pairs else np.array([])
+        keys = [self._key(pair) for pair in pairs]
+        scores = np.empty(len(pairs), dtype=np.float32)
+        missing = {}
+        with self._cache_lock:
+            for i, key in enumerate(keys):
+                score = self._score_cache.get(key)
+                if score is None:
+                    missing.setdefault(key, []).append(i)
+                else:
+                    self._score_cache.move_to_end(key)
+                    scores[i] = score
+        METRICS.count("rerank.cache_hits", len(pairs) - sum(len(rows) for rows in missing.values()))
+        if missing:
+            computed = self._run_shared([pairs[rows[0]] for rows in missing.values()])
+            with self._cache_lock:
+                for (key, rows), score in zip(missing.items(), computed):
+                    scores[rows] = score
+                    self._score_cache[key] = float(score)
+                    self._score_cache.move_to_end(key)
+                while len(self._score_cache) > self.score_cache_size:
+                    self._score_cache.popitem(last=False)
+        return scores
+
+    def clear_scores(self) -> None:
+        with self._cache_lock:
+            self._score_cache.clear()
+
+    def _clear_lead(self, docs: Sequence[Document]) -> bool:
+        # Whether the closest candidate is far enough ahead of the next to trust the vector order
+        if self.skip_margin is None or len(docs) < 2:
+            return False
+        first, second = (doc.metadata.get("vector_distance") for doc in docs[:2])
+        if first is None or second is None or second <= 0:
+            return False
+        return (second - first) / second >= self.skip_margin
+
+    def compress_documents_batch(
+        self,
+        documents: Sequence[Sequence[Document]],
+        queries: Sequence[str],
+    ) -> list[list[Document]]:
+        """
+        Reranks the candidates of every query.
+
+        Args:
+            documents (Sequence[Sequence[Document]]): The candidates of every query.
+            queries (Sequence[str]): The queries.
+
+        Returns:
+            list[list[Document]]: The best `top_n` candidates of every query, with their relevance_score.
+        """
+        if getattr(self.client, "llm_model", None) is not None:
+            return [list(super(BatchedFlashrankRerank, self).compress_documents(docs, query))
+                    for docs, query in zip(documents, queries)]
+        documents = [list(docs[:self.max_candidates]) for docs in documents]
+        skipped = [self._clear_lead(docs) for docs in documents]
+        METRICS.count("rerank.skipped", sum(skipped))
+        scores = self._score([
+            [query, doc.page_content]
+            for query, docs, skip in zip(queries, documents, skipped) if not skip for doc in docs
+        ])
+        results = []
+        offset = 0
+        for docs, skip in zip(documents, skipped):
+            if skip:
+                results.append([
+                    Document(page_content=doc.page_content, metadata={self.prefix_metadata + "id": i, **doc.metadata})
+                    for i, doc in enumerate(docs[:self.top_n])
+                ])
+                continue
+            doc_scores = scores[offset:offset + len(docs)]
+            offset += len(docs)
+            # Stable, so ties keep their retrieval order like in flashrank
+            order = sorted(range(len(docs)), key=lambda i: doc_scores[i], reverse=True)[:self.top_n]
+            results.append([
+                Document(
+                    page_content=docs[i].page_content,
+                    metadata={
+                        self.prefix_metadata + "id": i,
+                        self.prefix_metadata + "relevance_score": doc_scores[i],
+                        **docs[i].metadata,
+                    },
+                )
+                for i in order if doc_scores[i] >= self.score_threshold
+            ])
+        return results
+
+    def compress_documents(
+        self,
+        documents: Sequence[Document],
+        query: str,
+        callbacks: Optional[Callbacks] = None,
+    ) -> Sequence[Document]:
+        return self.compress_documents_batch([documents], [query])[0]
@@ -1,10 +1,19 @@
 from mwclient import Site
 import mwparserfromhell as mwp
-import json
+import bz2
+import time
+import xml.etree.ElementTree as ElementTree
+from hashlib import sha256
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 from re import match
-from typing import List, Dict, Any, Tuple, Union
+from typing import List, Dict, Any, Tuple, Union, Iterable
 from langchain_core.documents import Document
 
+from modules.utils import open_file, json_dumps, json_loads
+from modules.Metrics import METRICS
+
 import logging
 import logging.config 
 logging.basicConfig(
@@ -13,14 +22,80 @@ logging.basicConfig(
     filename="../data/KB_chat.log"
 )
 
+class WikiPage:
+	"""
+	A page fetched through SourceManager.fetch_pages.
+
+	Exposes the parts of mwclient's Page used by get_sections, without making any further requests.
+	Like there, `name` is the full title and `page_title` the title without its namespace prefix.
+	"""
+	def __init__(
+		self, title: str, text: str = "", revision: int = 0, redirect_target: str = None, exists: bool = True,
+		namespace: int = 0, requested_title: str = None
+	) -> None:
+		self.name = title
+		# The title as passed to fetch_pages, before the wiki normalized it
+		self.requested_title = requested_title or title
+		self.page_title = title[title.find(':') + 1:] if namespace else title
+		self.namespace = namespace
+		self.revision = revision
+		self.exists = exists
+		self.redirect = redirect_target is not None
+		self.redirect_target = redirect_target
+		self._text = text
+
+	def text(self, section: int = None) -> str:
+		"""
+		Get the wikitext of the page, or of a specific section.
+		"""
+		if section is None:
+			return self._text
+		return str(mwp.parse(self._text).get_sections()[int(section)])
+
+	def redirects_to(self):
+		"""
+		Get the redirect target page, or None if the page is not a redirect.
+		"""
+		if not self.redirect:
+			return None
+		return WikiPage(self.redirect_target)
+
+	@property
+	def content_hash(self) -> str:
+		"""
+		SHA-256 of the wikitext, or of the redirect target for redirects.
+		"""
+		content = f"#REDIRECT [[{self.redirect_target}]]" if self.redirect else self._text
+		return sha256(content.encode('utf-8')).hexdigest()
+
+	def __repr__(self) -> str:
+		return f"<WikiPage '{self.name}'>"
+
+
 class SourceManager:
-	def __init__(self, wiki_endpoint: str = "coppermind.net", text_splitter = None) -> None:
+	def __init__(
+		self,
+		wiki_endpoint: str = "coppermind.net",
+		text_splitter = None,
+		scheme: str = "https",
+		batch_size: int = 50,
+		max_workers: int = 4,
+		request_interval: float = 0.25,
+		keyword_extractor = None
+	) -> None:
 			"""
 			Constructor for SourceManager class.
 
 			Args:
 				wiki_endpoint (str, optional): The wiki endpoint URL. Defaults to "coppermind.net".
 				text_splitter (optional): The text splitter to use for splitting the text into smaller chunks.
+				scheme (str, optional): The URL scheme of the wiki endpoint. Defaults to "https".
+				batch_size (int, optional): The number of titles requested per API call in fetch_pages. Defaults to 50.
+				max_workers (int, optional): The number of concurrent API calls in fetch_pages. Defaults to 4.
+				request_interval (float, optional): The minimum number of seconds between the start of two
+					API calls in fetch_pages. Defaults to 0.25.
+				keyword_extractor (optional): Extracts the keywords of a list of sections when get_sections
+					is called with keywords=True, e.g. a KeywordExtractor.
 
 			Returns:
 				None
@@ -42,6 +117,17 @@ class SourceManager:
 			
 			# Set the text splitter
 			self.text_splitter = text_splitter
+
+			# Set the keyword extractor
+			self.keyword_extractor = keyword_extractor
+
+			# Set the batched retrieval limits
+			self.scheme = scheme
+			self.batch_size = batch_size
+			self.max_workers = max_workers
+			self.request_interval = request_interval
+			self._request_lock = Lock()
+			self._next_request = 0.0
 			
 			# Get the logger for the current module
 			self.logger = logging.getLogger(__name__) 
@@ -59,7 +145,7 @@ class SourceManager:
 		"""
 		for i in range(retries):
 			try:
-				self.site = Site(self.wiki_endpoint, clients_useragent=self.user_agent)
+				self.site = Site(self.wiki_endpoint, clients_useragent=self.user_agent, scheme=self.scheme)
 				self.logger.info(f"MWClient Connected with {self.wiki_endpoint}")
 				print(f"MWClient Connected with {self.wiki_endpoint}")
 				return	
@@ -70,6 +156,22 @@ class SourceManager:
 		print(f"MWClient unable to connect with {self.wiki_endpoint}")
 		
 
+	def iter_json(self, filename: str = "pages.jsonl"):
+		"""Streams data from a JSONLines file, one entry at a time.
+
+		Files ending in .gz or .zst are decompressed on the fly.
+
+		Args:
+			filename (str): The name of the JSONLines file. Defaults to "pages.jsonl".
+
+		Yields:
+			dict: The entries of the file, in order.
+		"""
+		with open_file(filename, 'rb') as file:
+			for line in file:
+				if line.strip():
+					yield json_loads(line)
+
 	def load_json(self, filename: str = "pages.jsonl") -> list[dict]:
 		"""Loads data from a JSONLines file, or creates an empty one if it doesn't exist.
 
@@ -81,33 +183,32 @@ class SourceManager:
 		"""
 		data: list[dict] = []
 		try:
-			with open(filename, 'r') as file:
-				for line in file:
-					data.append(json.loads(line))
+			data.extend(self.iter_json(filename))
 		except FileNotFoundError:
 			# File doesn't exist, create an empty one
-			with open(filename, 'w') as file:
+			with open_file(filename, 'wb') as file:
 				pass  # Do nothing, just create the file
 
 		return data
 
-	def save_json(self, data: Union[list, set], filename: str = "articles.jsonl") -> None:
+	def save_json(self, data: Iterable, filename: str = "articles.jsonl", append: bool = False) -> None:
 		"""
 		Save data to a JSON file.
 
+		Files ending in .gz or .zst are compressed on the fly.
+
 		Args:
-			data (Union[list, set]): The data to save. If it is a set, it will be converted to a list.
+			data (Iterable): The data to save, e.g. a list, a set or a generator.
 			filename (str, optional): The name of the file to save the data to. Defaults to "articles.jsonl".
+			append (bool, optional): Whether to append to the file instead of overwriting it. Defaults to False.
 
 		Returns:
 			None
 		"""
 		try:
-			with open(filename, 'w') as file:
-				if isinstance(data, set):
-					data = list(data)
+			with open_file(filename, 'ab' if append else 'wb') as file:
 				for entry in data:
-					file.write(json.dumps(entry) +'\n')
+					file.write(json_dumps(entry) + b'\n')
 				self.logger.info(f"{filename} saved")
 				print(f"{filename} saved")
 		except Exception as e:
@@ -131,6 +232,51 @@ class SourceManager:
 		return page.name, page
 
 
+	def dump_pages(self, filename: str, namespaces: Tuple[int, ...] = (0,)):
+		"""
+		Stream the pages of a MediaWiki XML dump (pages-articles.xml or .xml.bz2) in constant memory.
+
+		Args:
+			filename (str): The path of the dump.
+			namespaces (Tuple[int, ...], optional): The namespaces to keep. Defaults to (0,), the articles.
+
+		Yields:
+			WikiPage: The latest revision of every page in the kept namespaces, ready for get_sections.
+		"""
+		opener = bz2.open if str(filename).endswith('.bz2') else open
+		with opener(filename, 'rb') as file:
+			context = ElementTree.iterparse(file, events=('start', 'end'))
+			_, root = next(context)
+			path, page = [root.tag], {}
+			for event, elem in context:
+				tag = elem.tag.rsplit('}', 1)[-1]  # drop the export schema namespace
+				if event == 'start':
+					path.append(tag)
+					continue
+				path.pop()
+				parent = path[-1] if path else None
+				if parent == 'page' and tag in ('title', 'ns', 'id'):
+					page[tag] = elem.text or ''
+				elif parent == 'page' and tag == 'redirect':
+					page['redirect'] = elem.get('title')
+				elif parent == 'revision' and tag in ('id', 'text'):
+					page[f'revision_{tag}'] = elem.text or ''
+				elif tag == 'page':
+					# Drop everything parsed so far so memory stays flat
+					root.clear()
+					ns = int(page.get('ns') or 0)
+					if ns in namespaces:
+						# The name keeps its namespace prefix, so Talk:Tanavast and Tanavast stay apart
+						# when several namespaces are kept
+						yield WikiPage(
+							page['title'],
+							text=page.get('revision_text', ''),
+							revision=int(page.get('revision_id') or 0),
+							redirect_target=page.get('redirect'),
+							namespace=ns,
+						)
+					page = {}
+
 	def wiki_parse_pages(
 		self, page_titles: List[str], load: bool = False, update: bool = False
 	) -> List[Dict[str, List]]:
@@ -161,29 +307,159 @@ class SourceManager:
 
 		return self.pages
 
+	def _throttle(self) -> None:
+		"""
+		Block until at least `request_interval` seconds have passed since the previous API call started.
+		"""
+		with self._request_lock:
+			now = time.monotonic()
+			if self._next_request > now:
+				time.sleep(self._next_request - now)
+				now = self._next_request
+			self._next_request = now + self.request_interval
+
+	def _fetch_batch(self, titles: List[str], content: bool = True) -> List[WikiPage]:
+		"""
+		Fetch the latest revision of several pages with a single query, resolving redirects.
+
+		Args:
+		    titles (List[str]): The titles of the pages to fetch. At most 50 for most wikis.
+		    content (bool, optional): Whether to fetch the wikitext, or only the revision ids. Defaults to True.
+
+		Returns:
+		    List[WikiPage]: One page per title, in the same order as `titles`. Their name is the normalized
+		        full title and their requested_title the title as passed, mapped through the `normalized` list.
+		"""
+		params = {
+			'prop': 'info|revisions' if content else 'info',
+			'titles': '|'.join(titles),
+			'redirects': '',
+		}
+		if content:
+			params.update(rvprop='ids|content', rvslots='main')
+		normalized, redirects, infos = {}, {}, {}
+		while True:
+			self._throttle()
+			with METRICS.span("wiki.request"):
+				result = self.site.get('query', **params)
+			METRICS.count("wiki.requests")
+			query = result.get('query', {})
+			normalized.update((item['from'], item['to']) for item in query.get('normalized', []))
+			redirects.update((item['from'], item['to']) for item in query.get('redirects', []))
+			for info in query.get('pages', {}).values():
+				# Large batches are split over continuations, keep the entry that carries the content
+				if 'revisions' in info or info['title'] not in infos:
+					infos[info['title']] = info
+			if 'continue' not in result:
+				break
+			params.update(result['continue'])
+
+		pages = []
+		for title in titles:
+			name = normalized.get(title, title)
+			if name in redirects:
+				# The revision is the target's, a changed target only costs a hash comparison in sync_pages
+				target = redirects[name]
+				revision = infos.get(target, {}).get('lastrevid', 0)
+				pages.append(WikiPage(name, revision=revision, redirect_target=target, requested_title=title))
+				continue
+			info = infos.get(name, {})
+			text = ''
+			if info.get('revisions'):
+				rev = info['revisions'][0]
+				text = rev['slots']['main']['*'] if 'slots' in rev else rev['*']
+			pages.append(WikiPage(
+				name, text=text, revision=info.get('lastrevid', 0), exists='missing' not in info,
+				namespace=info.get('ns', 0), requested_title=title
+			))
+		self.logger.info(f"Fetched {len(pages)} pages")
+		return pages
+
+	def fetch_pages(self, page_titles: List[str], content: bool = True):
+		"""
+		Fetch pages in batches over a bounded thread pool and yield them in the order of `page_titles`.
+
+		Args:
+		    page_titles (List[str]): The titles of the pages to fetch.
+		    content (bool, optional): Whether to fetch the wikitext, or only the revision ids. Defaults to True.
+
+		Yields:
+		    WikiPage: The fetched pages, ready for get_sections.
+		"""
+		if self.site is None:
+			self._init_mwclient()
+		batches = [page_titles[i:i + self.batch_size] for i in range(0, len(page_titles), self.batch_size)]
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			pending = deque()
+			for batch in batches:
+				pending.append(executor.submit(self._fetch_batch, batch, content))
+				# Only keep max_workers batches in flight, yield the oldest once it's done
+				if len(pending) >= self.max_workers:
+					yield from pending.popleft().result()
+			while pending:
+				yield from pending.popleft().result()
+
+
+	def _redirect_target(self, page, parsed) -> Union[str, None]:
+		"""
+		Resolve the redirect target of a page from its already parsed wikitext.
+
+		Args:
+		    page (mwclient.page.Page): The page to check.
+		    parsed (mwp.wikicode.Wikicode): The parsed wikitext of the page.
+
+		Returns:
+		    Union[str, None]: The title of the target article, or None if the page is not a redirect.
+		"""
+		if not page.redirect:
+			return None
+		links = parsed.filter_wikilinks()
+		if not links:
+			# Fall back to asking the API
+			target = page.redirects_to()
+			return target.name if target is not None else None
+		title = str(links[0].title).split('#')[0].replace('_', ' ').strip()
+		return title[:1].upper() + title[1:]
 
 	# convert sections into documents w/ metadata
-	def get_sections(self, page, keywords: bool=False):
+	def get_sections(self, page, keywords: bool=False, single_fetch: bool=True):
 		"""
 		Parse the sections of a page and return them as a list of dictionaries with content and metadata.
 
 		Args:
 		    page (mwp.Page): The page to parse.
 		    keywords (bool, optional): Whether to extract keywords from the sections. Defaults to False.
+		    single_fetch (bool, optional): Whether to fetch and parse the wikitext once and split the sections
+		        locally. If False, every section is requested from the wiki separately. Defaults to True.
 
 		Returns:
 		    List[Dict[str, Union[str, Dict]]]: A list of dictionaries with content and metadata for each section.
 		"""
 		sections = []
-		article_title = page.page_title
+		# The full title, so pages of other namespaces do not merge with their main namespace article
+		article_title = page.name
 		self.logger.info(f"Procssing {article_title}")
 		print(f"Procssing {article_title}")
-		headings = [article_title] + [str(heading.title).strip() for heading in mwp.parse(page.text()).filter_headings()]
-		parsed = mwp.parse(page.text())
+		# Prefetched pages already hold their text, others are requested here
+		with METRICS.span("sections.fetch"):
+			text = page.text()
+		with METRICS.span("sections.parse"):
+			parsed = mwp.parse(text)
+			headings = [article_title] + [str(heading.title).strip() for heading in parsed.filter_headings()]
+			wiki_sections = parsed.get_sections()
+		METRICS.count("sections.pages")
+
+		if single_fetch:
+			# Split sections from the one Wikicode tree, section i matches page.text(section=i)
+			parent_article = self._redirect_target(page, parsed)
+			section_content = lambda i: wiki_sections[i].strip_code()
+		else:
+			redirect = page.redirects_to()
+			parent_article = redirect.name if redirect is not None else None
+			section_content = lambda i: mwp.parse(page.text(section=i)).strip_code()
 
-		if page.redirects_to() is not None:
+		if parent_article is not None:
 			doc = {}
-			parent_article = page.redirects_to().page_title
 			doc['content'] = parent_article
 			doc['metadata'] = {
 				'heading': f"Redirects to {parent_article}",
@@ -193,27 +469,14 @@ class SourceManager:
 			}
 			sections.append(doc)
 		else:
-			for i in range(len(parsed.get_sections()) - 1): # skip the last section "Notes", it's not useful
-				content = mwp.parse(page.text(section=i)).strip_code()
-				keywords = ''
-				if keywords:
-					prompt = f"""
-						For the following paragraph, extract a list of keywords that will be used as metadata when the paragraph is stored in a vector database. The keywords will be used to help return accurate results when the database is queried. the list must look like this "keyword1, keyword 2, keyword 3, ..."
-
-						Here is the paragraph:
-						```
-						{content}
-						```
-						"""
-					# response = model.generate(prompt)
-					response = call_prompt_in_rate(prompt)
-					try:
-						keywords = response.text
-					except Exception as e:
-						print(e)
-						print(f"{i}, {j}", content)
-						keywords=""
-						continue
+			with METRICS.span("sections.strip_code"):
+				contents = [section_content(i) for i in range(len(wiki_sections) - 1)] # skip the last section "Notes", it's not useful
+			section_keywords = [''] * len(contents)
+			if keywords and self.keyword_extractor is not None:
+				# One batched, cached extraction for the whole page
+				with METRICS.span("sections.keywords"):
+					section_keywords = self.keyword_extractor.extract(contents)
+			for i, (content, content_keywords) in enumerate(zip(contents, section_keywords)):
 				if self.text_splitter is not None:
 					chunks = self.text_splitter.split_text(content)
 					for chunk in chunks:
@@ -223,7 +486,7 @@ class SourceManager:
 							'heading': headings[i],
 							'order': i, 
 							'parent_article': article_title,
-							'keywords': keywords
+							'keywords': content_keywords
 							}
 						sections.append(doc)
 				else:
@@ -233,19 +496,110 @@ class SourceManager:
 						'heading': headings[i],
 						'order': i, 
 						'parent_article': article_title,
-						'keywords': keywords
+						'keywords': content_keywords
 						}
 					sections.append(doc)
+		METRICS.count("sections.sections", len(sections))
 		return sections
 
-	def prep_data_vector(self, page_titles, save=False):
+	def prep_data_vector(self, page_titles, save=False, batched=True):
 		self._init_mwclient()
-		pages = self.wiki_parse_pages(page_titles)
+		if batched:
+			pages = self.fetch_pages(page_titles)
+		else:
+			pages = (page['page'] for page in self.wiki_parse_pages(page_titles))
 		for page in pages:
-			self.data.extend(self.get_sections(page['page']))
+			self.data.extend(self.get_sections(page))
 		if save: self.save_json(self.data, 'sectioned_articles.jsonl')
 		return self.data
     
+	def prep_data_dump(self, filename: str, namespaces: Tuple[int, ...] = (0,), save=False):
+		"""
+		Section every page of a MediaWiki XML dump, without calling the wiki API.
+
+		Args:
+			filename (str): The path of the dump.
+			namespaces (Tuple[int, ...], optional): The namespaces to keep. Defaults to (0,), the articles.
+			save (bool, optional): Whether to save the sections to "sectioned_articles.jsonl". Defaults to False.
+
+		Returns:
+			List[Dict[str, Any]]: The section dicts, as produced by get_sections.
+		"""
+		for page in self.dump_pages(filename, namespaces):
+			self.data.extend(self.get_sections(page))
+		if save: self.save_json(self.data, 'sectioned_articles.jsonl')
+		return self.data
+
+	def load_manifest(self, filename: str = "manifest.jsonl") -> Dict[str, Dict]:
+		"""
+		Load the manifest of ingested articles.
+
+		Args:
+		    filename (str, optional): The name of the JSONLines manifest file. Defaults to "manifest.jsonl".
+
+		Returns:
+		    Dict[str, Dict]: The manifest entries (title, revision, hash and doc_ids), keyed by title.
+		"""
+		return {entry['title']: entry for entry in self.load_json(filename)}
+
+	def save_manifest(self, manifest: Dict[str, Dict], filename: str = "manifest.jsonl") -> None:
+		"""
+		Save the manifest of ingested articles.
+
+		Args:
+		    manifest (Dict[str, Dict]): The manifest entries, keyed by title.
+		    filename (str, optional): The name of the JSONLines manifest file. Defaults to "manifest.jsonl".
+
+		Returns:
+		    None
+		"""
+		self.save_json(list(manifest.values()), filename)
+
+	def sync_pages(
+		self, page_titles: List[str], manifest: Dict[str, Dict]
+	) -> Tuple[Dict[str, List[Dict]], List[str], Dict[str, Dict]]:
+		"""
+		Compare the wiki against the manifest and section only the new or changed pages.
+
+		Revision ids are compared first with a cheap info query, the wikitext is only fetched for pages
+		whose revision differs, and a page whose content hash is unchanged (e.g. a null edit) is not sectioned.
+		Manifest titles missing from `page_titles` are only checked for deletion, with the same info query.
+		Results and manifest entries are keyed by the titles as passed, not as normalized by the wiki.
+
+		Args:
+		    page_titles (List[str]): The titles of the pages to sync.
+		    manifest (Dict[str, Dict]): The current manifest, see load_manifest.
+
+		Returns:
+		    Tuple[Dict[str, List[Dict]], List[str], Dict[str, Dict]]: The sections of every new or changed page
+		        keyed by title, the titles in the manifest that no longer exist on the wiki, and the new
+		        manifest entries for the fetched pages.
+		"""
+		if self.site is None:
+			self._init_mwclient()
+		outdated, deleted = [], []
+		requested = set(page_titles)
+		unlisted = [title for title in manifest if title not in requested]
+		# Everything is keyed by the title as requested, which the wiki may have normalized or redirected
+		for page in self.fetch_pages(list(page_titles) + unlisted, content=False):
+			title = page.requested_title
+			entry = manifest.get(title)
+			if not page.exists:
+				if entry is not None:
+					deleted.append(title)
+			elif title in requested and (entry is None or entry['revision'] != page.revision):
+				outdated.append(title)
+		self.logger.info(f"Sync: {len(outdated)} outdated and {len(deleted)} deleted of {len(page_titles)} pages")
+
+		changed, entries = {}, {}
+		for page in self.fetch_pages(outdated):
+			title = page.requested_title
+			entry = manifest.get(title, {})
+			entries[title] = {**entry, 'title': title, 'revision': page.revision, 'hash': page.content_hash}
+			if entry.get('hash') != page.content_hash:
+				changed[title] = self.get_sections(page)
+		return changed, deleted, entries
+
 	def to_documents(self, data=None):
 		data = data or self.data
 		return [Document(page_content=doc['content'], metadata=doc['metadata']) for doc in data]
@@ -1,57 +1,134 @@
 # Initialize and handle Chroma DB and wrap it in langchain
 import uuid
-from random import randint
-from os import environ
+import timeit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cached_property
+from hashlib import sha256
 from pathlib import Path
 
-import chromadb
-from chromadb.config import Settings
-import chromadb.utils.embedding_functions as embedding_fns
-
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain_openai import OpenAIEmbeddings
-from langchain_chroma import Chroma
-from langchain.chains.query_constructor.base import AttributeInfo
-
 from ratelimit import limits, RateLimitException, sleep_and_retry
 from backoff import on_exception, expo
-import google.api_core.exceptions as google_exceptions
 
-from modules.utils import load_config
-load_config()
-from google.generativeai import GenerativeModel, configure
-configure(api_key=environ["GOOGLE_API_KEY"])
+from modules.utils import load_config, estimate_tokens, STARTUP
+from modules.Metrics import METRICS
+from modules.EmbeddingCache import EmbeddingCache, CachedEmbeddings, CachedEmbeddingFunction, CACHE_DIR
+from modules.KeywordExtractor import KeywordExtractor, StatisticalKeywordExtractor
+from modules.CompactVectorStore import CompactVectorStore, COMPACT_DIR
+from modules.ArticleStore import ArticleStore, ARTICLES_FILE, article_id
 
 DB_DIR = Path(__file__).parent.parent / "chroma"
+NAMESPACE_UUID = uuid.UUID('f81d4fae-7dec-11d0-a765-00a0c91e6bf6')
+
+
+def _resource_exhausted(exception: Exception) -> bool:
+    # Imported on the first failure, so loading this module does not import the Google SDK
+    from google.api_core.exceptions import ResourceExhausted
+    return isinstance(exception, ResourceExhausted)
+
+
+def _transient_embedding_error(exception: Exception) -> bool:
+    # Rate limits, timeouts and dropped connections are worth a retry, bad input or auth is not
+    if isinstance(exception, (TimeoutError, ConnectionError)):
+        return True
+    try:
+        import openai
+    except ImportError:
+        return False
+    return isinstance(exception, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError))
+
 
 class VectorDBManager:
     """
     Manages the VectorDB and wraps it with Langchain.
+
+    The Chroma client, collection, embedding cache, keyword extractor and Gemini model are
+    created, and their SDKs imported, on first use, so constructing a manager is cheap.
     """
-    def __init__(self, db_dir: Path = DB_DIR) -> None:
+    def __init__(
+            self,
+            db_dir: Path = DB_DIR,
+            cache_dir: Path = CACHE_DIR,
+            keyword_mode: str = "llm",
+            compact_dir: Path = COMPACT_DIR,
+            articles_file: Path = ARTICLES_FILE,
+            config: dict = None
+        ) -> None:
         """
         Constructor for VectorDBManager class.
 
         Args:
             db_dir (Path): Path to the database directory.
+            cache_dir (Path): Path to the embedding cache directory.
+            keyword_mode (str): "llm" to extract keywords with Gemini, or "tfidf" to extract them
+                offline. The offline extractor is fitted on the paragraphs of every call, call
+                `keyword_extractor.fit` with the whole corpus first for corpus-wide keywords.
+            compact_dir (Path): Path to the directory collections are exported to for the compact
+                backend, one subdirectory per collection.
+            articles_file (Path): Path to the article store, see ArticleStore.
+            config (dict, optional): The configuration, e.g. as loaded by RAGPipeline. Loaded from
+                config.yml when not given.
 
         Returns:
             None
         """
+        self.config = config if config is not None else load_config()
         self.db_dir = db_dir
-        
-        self.chroma_client = chromadb.PersistentClient(
-            path=str(db_dir),
-            settings=Settings(allow_reset=True)
+        self.cache_dir = cache_dir
+        self.compact_dir = compact_dir
+        self.articles_file = articles_file
+        self.keyword_mode = keyword_mode
+
+    @cached_property
+    def chroma_client(self):
+        with STARTUP.time("imports", "chromadb"):
+            import chromadb
+            from chromadb.config import Settings
+        with STARTUP.time("models", "chroma_client"):
+            return chromadb.PersistentClient(
+                path=str(self.db_dir),
+                settings=Settings(allow_reset=True)
+            )
+
+    @cached_property
+    def embedding_cache(self) -> EmbeddingCache:
+        # Every embedding goes through the cache, keyed by model name and text hash
+        return EmbeddingCache(self.cache_dir)
+
+    @cached_property
+    def articles(self) -> ArticleStore:
+        # Links, redirects and revision of every article, referenced by the article_id of its paragraphs
+        return ArticleStore(self.articles_file)
+
+    @cached_property
+    def keyword_extractor(self):
+        if self.keyword_mode == "tfidf":
+            return StatisticalKeywordExtractor()
+        return KeywordExtractor(self.call_prompt_in_rate)
+
+    @cached_property
+    def chroma_embedding_function(self) -> CachedEmbeddingFunction:
+        with STARTUP.time("imports", "chromadb.utils.embedding_functions"):
+            import chromadb.utils.embedding_functions as embedding_fns
+        return CachedEmbeddingFunction(
+            embedding_fns.OpenAIEmbeddingFunction(api_key=self.config["OPENAI_API_KEY"]),
+            self.embedding_cache
         )
-        self.chroma_embedding_function = embedding_fns.OpenAIEmbeddingFunction(api_key=environ["OPENAI_API_KEY"])
-        self.collection = self.chroma_client.get_or_create_collection("coppermind", embedding_function=self.chroma_embedding_function)
 
-        self.model = GenerativeModel(model_name="gemini-1.5-flash")
+    @cached_property
+    def collection(self):
+        return self.chroma_client.get_or_create_collection("coppermind", embedding_function=self.chroma_embedding_function)
+
+    @cached_property
+    def model(self):
+        with STARTUP.time("imports", "google.generativeai"):
+            from google.generativeai import GenerativeModel, configure
+        with STARTUP.time("models", "gemini"):
+            configure(api_key=self.config["GOOGLE_API_KEY"])
+            return GenerativeModel(model_name="gemini-1.5-flash")
 
     def fresh_db(self) -> None:
         """
-        Resets the database.
+        Resets the database and the article store.
 
         Args:
             None
@@ -60,24 +137,88 @@ class VectorDBManager:
             None
         """
         self.chroma_client.reset()
+        self.articles.clear()
         self.collection = self.chroma_client.get_or_create_collection("coppermind", embedding_function=self.chroma_embedding_function)
 
-    def _init_langchaindb(self) -> None:
+    def _init_langchaindb(self, embeddings=None, collection_name: str = "coppermind", collection_metadata: dict = None) -> None:
         """
         Initializes the LangchainDB.
 
         Args:
-            None
+            embeddings (Embeddings, optional): Embeds chunks and queries. Defaults to cached OpenAI embeddings.
+            collection_name (str, optional): The Chroma collection. Defaults to "coppermind".
+            collection_metadata (dict, optional): Passed to Chroma when the collection is created,
+                e.g. {"hnsw:space": "cosine"}.
 
         Returns:
             None
         """
+        with STARTUP.time("imports", "langchain_chroma"):
+            from langchain_chroma import Chroma
+            from langchain_openai import OpenAIEmbeddings
         self.langdb = Chroma(
-            collection_name="coppermind",
-            embedding_function=OpenAIEmbeddings(),
+            collection_name=collection_name,
+            embedding_function=embeddings or CachedEmbeddings(OpenAIEmbeddings(), self.embedding_cache),
             client=self.chroma_client,
+            collection_metadata=collection_metadata,
         )
 
+    def _init_compactdb(self, embeddings=None, collection_name: str = "coppermind", nprobe: int = 8) -> None:
+        """
+        Initializes the LangchainDB from a collection exported by `export_compact`, without Chroma.
+
+        Meant for read-only query workers: the vectors are memory-mapped and shared between processes.
+
+        Args:
+            embeddings (Embeddings, optional): Embeds queries. Defaults to cached OpenAI embeddings.
+            collection_name (str, optional): The exported collection. Defaults to "coppermind".
+            nprobe (int, optional): The IVF lists searched per query, when exported with lists. Defaults to 8.
+
+        Returns:
+            None
+        """
+        if embeddings is None:
+            with STARTUP.time("imports", "langchain_openai"):
+                from langchain_openai import OpenAIEmbeddings
+            embeddings = CachedEmbeddings(OpenAIEmbeddings(), self.embedding_cache)
+        with STARTUP.time("models", "compact_vectorstore"):
+            self.langdb = CompactVectorStore(self.compact_dir / collection_name, embeddings, nprobe=nprobe)
+
+    def export_compact(
+            self,
+            collection_name: str = "coppermind",
+            dtype: str = "int8",
+            nlist: int = 0,
+            batch_size: int = 5000
+        ) -> dict:
+        """
+        Exports a Chroma collection to the compact backend, see CompactVectorStore.
+
+        Run it after ingesting, the export is a snapshot and does not follow later changes.
+
+        Args:
+            collection_name (str, optional): The collection to export. Defaults to "coppermind".
+            dtype (str, optional): "float32", "float16" or "int8". Defaults to "int8".
+            nlist (int, optional): The number of IVF lists, 0 for exact search. Defaults to 0.
+            batch_size (int, optional): The rows read from Chroma at a time. Defaults to 5000.
+
+        Returns:
+            dict: The stats of the exported store.
+        """
+        collection = self.chroma_client.get_collection(collection_name)
+        count = collection.count()
+
+        def batches():
+            for offset in range(0, count, batch_size):
+                rows = collection.get(include=["embeddings", "documents", "metadatas"], limit=batch_size, offset=offset)
+                yield rows["ids"], rows["embeddings"], rows["documents"], rows["metadatas"]
+
+        path = CompactVectorStore.build(
+            self.compact_dir / collection_name, batches(), count, dtype=dtype,
+            space=(collection.metadata or {}).get("hnsw:space", "l2"), nlist=nlist
+        )
+        return CompactVectorStore(path).stats()
+
     def _init_metadata_field_info(self) -> None:
         """
         Initializes the metadata field info.
@@ -88,15 +229,14 @@ class VectorDBManager:
         Returns:
             None
         """
+        from langchain.chains.query_constructor.base import AttributeInfo
+
+        # No article field: paragraphs reference their article by a hashed article_id that a query
+        # cannot produce, resolve titles with `articles.by_title` and filter on its ID instead
         self.metadata_field_info = [
-            AttributeInfo(
-                name="article_title",
-                description="title of parent article",
-                type="string",
-            ),
             AttributeInfo(
                 name="paragraph_header",
-                description="header in article_title under which content was located",
+                description="header in the parent article under which content was located",
                 type="string",
             ),
             AttributeInfo(
@@ -104,11 +244,6 @@ class VectorDBManager:
                 description="order of paragraph under the paragraph_header",
                 type="integer",
             ),
-            AttributeInfo(
-                name="links",
-                description="list of article_titles that are directly related to the parent article",
-                type="string",
-            ),
         ]
         self.doc_content_description = "paragraph of an article from the coppermind, a knowledgebase for everything in the literary universe of the Cosmere, written by Brandon Sanderson"
 
@@ -116,7 +251,8 @@ class VectorDBManager:
     # rate is 1 QPS.
     @sleep_and_retry  # If there are more requests to this function than rate, sleep shortly
     @on_exception(
-        expo, google_exceptions.ResourceExhausted, max_tries=10  # if we receive exceptions from Google API, retry
+        # if we receive ResourceExhausted from Google API, retry
+        expo, Exception, max_tries=10, giveup=lambda e: not _resource_exhausted(e)
     )
     @limits(calls=40, period=MINUTE)
     def call_prompt_in_rate(self, prompt: str) -> str:
@@ -133,13 +269,183 @@ class VectorDBManager:
         return self.model.generate_content(prompt)
 
 
-    def ingest_articles(self, data, with_keywords=False):
-        """Ingests structured article data into ChromaDB."""
-        namespace_uuid = uuid.UUID('f81d4fae-7dec-11d0-a765-00a0c91e6bf6')
+    @staticmethod
+    def paragraph_id(article_title: str, paragraph: dict) -> str:
+        """
+        Builds a deterministic ID from the article title, the paragraph position and a hash of its content.
+
+        Args:
+            article_title (str): The title of the parent article.
+            paragraph (dict): The paragraph, with title, order and content.
+
+        Returns:
+            str: The paragraph ID.
+        """
+        content_hash = sha256(paragraph['content'].encode('utf-8')).hexdigest()
+        return str(uuid.uuid5(NAMESPACE_UUID, f"{article_title}_{paragraph['title']}_{paragraph['order']}_{content_hash}"))
+
+    def existing_ids(self, ids: list[str], batch_size: int = 1000) -> set[str]:
+        """
+        Returns the subset of `ids` already stored in the collection.
+
+        Args:
+            ids (list[str]): The IDs to look up.
+            batch_size (int, optional): The number of IDs per lookup. Defaults to 1000.
+
+        Returns:
+            set[str]: The stored IDs.
+        """
+        existing = set()
+        for i in range(0, len(ids), batch_size):
+            existing.update(self.collection.get(ids=ids[i:i + batch_size], include=[])['ids'])
+        return existing
+
+    @staticmethod
+    def _articles_where(titles: list[str]) -> dict:
+        # Paragraphs ingested before the article store carry the title instead of the ID
+        return {"$or": [
+            {"article_id": {"$in": [article_id(title) for title in titles]}},
+            {"article_title": {"$in": list(titles)}},
+        ]}
+
+    def article_paragraph_ids(self, titles: list[str], batch_size: int = 100) -> set[str]:
+        """
+        Returns the IDs of every paragraph stored for the given articles.
+
+        Args:
+            titles (list[str]): The titles of the articles.
+            batch_size (int, optional): The number of articles per lookup. Defaults to 100.
+
+        Returns:
+            set[str]: The stored paragraph IDs.
+        """
+        ids = set()
+        for i in range(0, len(titles), batch_size):
+            ids.update(self.collection.get(where=self._articles_where(titles[i:i + batch_size]), include=[])['ids'])
+        return ids
+
+    def delete_articles(self, titles: list[str]) -> None:
+        """
+        Deletes every paragraph of the given articles, and their entries in the article store.
+
+        Args:
+            titles (list[str]): The titles of the articles to delete.
+
+        Returns:
+            None
+        """
+        if titles:
+            self.collection.delete(where=self._articles_where(titles))
+            self.articles.delete(titles)
+
+    def normalize_articles(self, batch_size: int = 1000) -> int:
+        """
+        Moves the article title and links that older ingests copied into every paragraph to the
+        article store, and leaves paragraphs with only their `article_id`.
+
+        Chroma merges metadata on update, so the rewritten paragraphs are deleted and added again
+        with their stored embeddings. They are staged in the article store first, and a run
+        interrupted between the two is completed by the next call. Articles already in the store
+        keep their entry. Redirect pages were never stored with paragraphs, ingest them again to
+        fill in the redirects.
+
+        Args:
+            batch_size (int, optional): The paragraphs rewritten at a time. Defaults to 1000.
+
+        Returns:
+            int: The number of paragraphs rewritten.
+        """
+        staged = self.articles.staged_paragraphs()
+        if staged[0]:
+            # Left by an interrupted run, which may have deleted the paragraphs without adding them back
+            self._replace_paragraphs(*staged)
+        # Chroma's $ne also matches paragraphs without the key, the ones already rewritten
+        rows = self.collection.get(where={"article_title": {"$ne": ""}}, include=["metadatas"])
+        ids = [id for id, metadata in zip(rows["ids"], rows["metadatas"]) if "article_title" in metadata]
+        for i in range(0, len(ids), batch_size):
+            rows = self.collection.get(ids=ids[i:i + batch_size], include=["embeddings", "documents", "metadatas"])
+            articles = {}
+            metadatas = []
+            for metadata in rows["metadatas"]:
+                metadata = dict(metadata)
+                title = metadata.pop("article_title")
+                links = metadata.pop("links", "")
+                if self.articles.by_title(title) is None:
+                    articles.setdefault(title, {"title": title, "links": links.split(", ") if links else [], "sections": []})
+                metadatas.append({"article_id": article_id(title), **metadata})
+            self.articles.upsert(articles.values())
+            self.articles.stage_paragraphs(rows["ids"], rows["documents"], metadatas, rows["embeddings"])
+            self._replace_paragraphs(rows["ids"], rows["documents"], metadatas, rows["embeddings"])
+        return len(ids)
+
+    def _replace_paragraphs(self, ids: list[str], documents: list[str], metadatas: list[dict], embeddings) -> None:
+        # Deleting first drops the metadata keys an upsert would keep, the staged copy covers the gap
+        existing = list(self.existing_ids(ids))
+        if existing:
+            self.collection.delete(ids=existing)
+        self.collection.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+        self.articles.clear_staged()
+
+    @staticmethod
+    def token_batches(documents: list[str], max_tokens: int = 100_000, max_size: int = 2048) -> list[list[int]]:
+        """
+        Groups document indices into batches that stay under a token budget.
+
+        Args:
+            documents (list[str]): The documents to batch.
+            max_tokens (int, optional): Estimated tokens per batch. Defaults to 100,000.
+            max_size (int, optional): Documents per batch, OpenAI accepts up to 2048 inputs. Defaults to 2048.
+
+        Returns:
+            list[list[int]]: The indices of the documents in every batch.
+        """
+        batches, batch, tokens = [], [], 0
+        for i, document in enumerate(documents):
+            count = estimate_tokens(document)
+            if batch and (tokens + count > max_tokens or len(batch) >= max_size):
+                batches.append(batch)
+                batch, tokens = [], 0
+            batch.append(i)
+            tokens += count
+        if batch:
+            batches.append(batch)
+        return batches
+
+    @on_exception(
+        # retry a batch that failed on a transient error with exponential backoff
+        expo, Exception, max_tries=5, giveup=lambda e: not _transient_embedding_error(e)
+    )
+    def _embed_batch(self, documents: list[str]) -> list:
+        """
+        Embeds one batch of documents with the collection's embedding function.
+        """
+        with METRICS.span("ingest.embed_batch"):
+            return self.chroma_embedding_function(documents)
+
+    def ingest_articles(self, data, with_keywords=False, batch_tokens=100_000, max_workers=4):
+        """
+        Ingests structured article data into ChromaDB.
+
+        Links, redirects and revision are written once per article to the article store, and
+        paragraphs only reference their article by `article_id`. IDs are derived from the content,
+        so paragraphs that are already stored are skipped before any keyword or embedding call,
+        and re-ingesting unchanged data is a no-op. Stored paragraphs of an ingested article that are
+        not among its new sections, e.g. the old text of an edited section, are deleted once the new
+        ones are written.
+        New paragraphs are embedded in token-budgeted batches on a bounded thread pool and
+        every batch is written as soon as it is embedded, so an interrupted ingest resumes
+        after the last written batch. Batches are retried on rate limits, timeouts and connection
+        errors only, any other failure cancels the batches not started yet and is raised.
+        """
         documents = []
         metadatas = []
         ids = []
 
+        data = list(data)
+        with METRICS.span("ingest.articles"):
+            self.articles.upsert(data)
+
+        paragraphs = {}
         for article in data:
             if article["sections"] is None:
                 continue
@@ -153,42 +459,65 @@ class VectorDBManager:
                 #     "paragraph_order": 0,
                 #     "links": ', '.join(article["links"]),
                 # })
-                # ids.append(str(uuid.uuid5(namespace_uuid, article['title'])))
+                # ids.append(str(uuid.uuid5(NAMESPACE_UUID, article['title'])))
             else:
                 for paragraph in article["sections"]:
-                    keywords = ""
-                    if with_keywords:
-                        content = paragraph['content']
-                        prompt = f"""
-                            For the following paragraph, extract a list of keywords that will be used as metadata when the paragraph is stored in a vector database. The keywords will be used to help return accurate results when the database is queried. the list must look like this "keyword1, keyword 2, keyword 3, ..."
-
-                            Here is the paragraph:
-                            ```
-                            {content}
-                            ```
-                            """
-                        # response = model.generate(prompt)
-                        response = self.call_prompt_in_rate(prompt)
-                        try:
-                            keywords = response.text
-                            # keywords = response.content
-                        except Exception as e:
-                            print(e)
-                            print(f"{i}, {j}", content)
-                            keywords=""
-                            continue
-                    documents.append(paragraph["content"])
-                    metadatas.append({
-                        "article_title": article["title"],
-                        "paragraph_header": paragraph['title'],
-                        "paragraph_order": paragraph["order"],
-                        "links": ', '.join(article["links"]),
-                        "keywords": keywords,
-                    })
-                    ids.append(str(uuid.uuid5(namespace_uuid, f"{paragraph['title']}_{paragraph['order']}_{randint(0,10000)}")))  # Create unique IDs
-
-        self.collection.add(
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids 
-        )
+                    paragraphs.setdefault(self.paragraph_id(article["title"], paragraph), (article, paragraph))
+
+        # Identical content has an identical ID, so stored paragraphs never need embedding again
+        with METRICS.span("ingest.existing_ids"):
+            existing = self.existing_ids(list(paragraphs))
+            titles = list({article["title"]: None for article in data})
+            stale = list(self.article_paragraph_ids(titles) - set(paragraphs))
+        new_paragraphs = [(paragraph_id, pair) for paragraph_id, pair in paragraphs.items() if paragraph_id not in existing]
+        METRICS.count("ingest.paragraphs_skipped", len(paragraphs) - len(new_paragraphs))
+        keywords = [""] * len(new_paragraphs)
+        if with_keywords:
+            with METRICS.span("ingest.keywords"):
+                keywords = self.keyword_extractor.extract([paragraph["content"] for _, (_, paragraph) in new_paragraphs])
+        for (paragraph_id, (article, paragraph)), paragraph_keywords in zip(new_paragraphs, keywords):
+            documents.append(paragraph["content"])
+            metadatas.append({
+                "article_id": article_id(article["title"]),
+                "paragraph_header": paragraph['title'],
+                "paragraph_order": paragraph["order"],
+                "keywords": paragraph_keywords,
+            })
+            ids.append(paragraph_id)
+
+        if ids:
+            self._write_paragraphs(documents, metadatas, ids, batch_tokens, max_workers)
+        # Only after the new paragraphs are written, so an interrupted ingest never loses an article
+        if stale:
+            with METRICS.span("ingest.delete_stale"):
+                self.collection.delete(ids=stale)
+            METRICS.count("ingest.paragraphs_deleted", len(stale))
+
+    def _write_paragraphs(self, documents: list[str], metadatas: list[dict], ids: list[str], batch_tokens: int, max_workers: int) -> None:
+        batches = self.token_batches(documents, max_tokens=batch_tokens)
+        start_time = timeit.default_timer()
+        written = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self._embed_batch, [documents[i] for i in batch]): batch
+                for batch in batches
+            }
+            try:
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    with METRICS.span("ingest.upsert"):
+                        self.collection.upsert(
+                            documents=[documents[i] for i in batch],
+                            metadatas=[metadatas[i] for i in batch],
+                            embeddings=future.result(),
+                            ids=[ids[i] for i in batch]
+                        )
+                    written += len(batch)
+                    METRICS.count("ingest.paragraphs", len(batch))
+                    elapsed = timeit.default_timer() - start_time
+                    print(f"Ingested {written}/{len(ids)} paragraphs ({written / elapsed:.1f} paragraphs/s)")
+            except BaseException:
+                # Batches not started yet are dropped, written ones are kept and skipped on the next ingest
+                for future in futures:
+                    future.cancel()
+                raise
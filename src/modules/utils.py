@@ -1,7 +1,23 @@
-
+import gzip
+import io
+import json
+import timeit
+from contextlib import contextmanager
+from itertools import islice
 from os import environ
 from yaml import safe_load
 from pathlib import Path
+from threading import Lock
+
+# Optional faster codecs, fall back to the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 def load_config(file_path: str = str(Path(__file__).parent.parent.parent / "config.yml")):
     """
@@ -11,6 +27,7 @@ def load_config(file_path: str = str(Path(__file__).parent.parent.parent / "conf
     environment variables. The configuration file iskept separately for ease of access, and is expected to be in YAML format.
 
     :param file_path: Path to configuration file. Default: '../config.yml'
+    :return: The configuration, to pass on instead of loading it again.
     """
     # Open the configuration file
     with open(file_path, 'r') as file:
@@ -18,3 +35,94 @@ def load_config(file_path: str = str(Path(__file__).parent.parent.parent / "conf
         config = safe_load(file)
         # Update the environment variables with the configuration values
         environ.update(config)
+    return config
+
+def open_file(filename, mode: str = 'rb'):
+    """
+    Open a file in binary mode, compressing or decompressing it based on its extension.
+
+    `.gz` files use gzip and `.zst` files use zstandard, anything else is opened as is.
+    Appending adds a new gzip member or zstd frame, which are read back as one stream.
+
+    :param filename: Path of the file.
+    :param mode: One of 'rb', 'wb' or 'ab'. Default: 'rb'
+    """
+    filename = str(filename)
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode, compresslevel=6)
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("zstandard is required to read or write .zst files")
+        if 'r' in mode:
+            reader = zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True)
+            return io.BufferedReader(reader)
+        return zstandard.ZstdCompressor().stream_writer(open(filename, mode))
+    return open(filename, mode)
+
+def json_dumps(entry) -> bytes:
+    """
+    Serialize one JSON line, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(entry)
+    return json.dumps(entry).encode('utf-8')
+
+def json_loads(line: bytes):
+    """
+    Deserialize one JSON line, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+def batched(iterable, size: int):
+    """
+    Yield lists of `size` items from `iterable`, the last one may be shorter.
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token count estimate, about four characters per token for English text.
+    """
+    return len(text) // 4 + 1
+
+class StartupTimer:
+    """
+    Records how long startup takes, split into imports and model or client loading.
+
+    Heavy modules are imported and components built on first use, each step timed
+    under a name. Only the first import of a module is slow, later ones add nothing.
+    """
+    def __init__(self):
+        self.timings = {"imports": {}, "models": {}}
+        self._lock = Lock()
+
+    def record(self, kind: str, name: str, seconds: float) -> None:
+        with self._lock:
+            self.timings[kind][name] = self.timings[kind].get(name, 0.0) + seconds
+
+    @contextmanager
+    def time(self, kind: str, name: str):
+        """
+        Times the block as `name` under `kind`, "imports" or "models".
+        """
+        start_time = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.record(kind, name, timeit.default_timer() - start_time)
+
+    def report(self) -> dict:
+        """
+        Returns the seconds of every import and model, and the totals of both.
+        """
+        with self._lock:
+            report = {kind: {name: round(seconds, 3) for name, seconds in timings.items()}
+                      for kind, timings in self.timings.items()}
+            report.update({f"{kind}_seconds": round(sum(timings.values()), 3) for kind, timings in self.timings.items()})
+        return report
+
+STARTUP = StartupTimer()